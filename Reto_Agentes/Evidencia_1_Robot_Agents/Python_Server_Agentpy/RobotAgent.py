@@ -1,7 +1,10 @@
 import agentpy as ap
 import json
 import random
+import numpy as np
 from owlready2 import *
+from grid_perception import GridPerception, to_dicts, to_json
+from world import WorldState
 
 # Create the ontology
 onto = get_ontology("file://onto.owl")
@@ -95,11 +98,15 @@ class RobotAgent(ap.Agent):
         print(f"Updating state with perception: {perception_json}")
         perception = json.loads(perception_json)
         self.onto_robot.id = perception["id"]
-        self.perception_data = perception["position"]
+        self.perceive(perception["position"], stored_state)
+        print(f"State updated. Robot ID: {self.onto_robot.id}, Holding: {self.is_holding_box}, Perception: {self.perception_data}")
+
+    def perceive(self, perception_data, stored_state=None):
+        # perception_data is {"F": code, ...}, from the model without json
+        self.perception_data = perception_data
         if stored_state:
             #self.is_holding_box = stored_state["is_holding_box"]
             self.movements = stored_state["movements"]
-        print(f"State updated. Robot ID: {self.onto_robot.id}, Holding: {self.is_holding_box}, Perception: {self.perception_data}")
 
     def check_rule(self, rule):
         for key, value in rule.items():
@@ -176,6 +183,12 @@ class RobotAgent(ap.Agent):
         action = self.perceive_and_act()
         return self.act(action)
 
+    def decide(self, perception_data, stored_state=None):
+        # the action for the perception the model already computed. the
+        # robot's state only changes with act(), once the model applied it
+        self.perceive(perception_data, stored_state)
+        return self.perceive_and_act()
+
 class ObjectStackingModel(ap.Model):
     def setup(self):
         self.num_robots = 5
@@ -195,39 +208,36 @@ class ObjectStackingModel(ap.Model):
 
         self.stacks = {}
 
+        # the grid in arrays, kept in step with self.grid. the objects are
+        # always the same agents, a grabbed one travels with its robot
+        self.world = WorldState((self.grid_size, self.grid_size))
+        for robot in self.robots:
+            self.world.add_robot(robot.id, self.grid.positions[robot])
+        for obj in self.objects:
+            self.world.add_object(obj.id, self.grid.positions[obj])
+        self.objects_by_id = {obj.id: obj for obj in self.objects}
+        self.carried = {}
+        self.perception = GridPerception(self.world)
+
         self.data = {
             'steps_to_completion': None,
             'robot_movements': {robot.onto_robot.id: 0 for robot in self.robots}
         }
 
-    def get_perception(self, robot):
-        x, y = self.grid.positions[robot]
-        directions = {'F': (0, 1), 'B': (0, -1), 'L': (-1, 0), 'R': (1, 0)}
-
-        perception = {}
-        for direction, (dx, dy) in directions.items():
-            new_x, new_y = x + dx, y + dy
-
-            if 0 <= new_x < self.grid_size and 0 <= new_y < self.grid_size:
-                cell_content = self.grid.agents[new_x, new_y]  # Changed this line
-                if not cell_content:
-                    perception[direction] = 0
-                elif any(isinstance(agent, RobotAgent) for agent in cell_content):
-                    perception[direction] = 2
-                elif len(cell_content) == 1:
-                    perception[direction] = 1
-                else:
-                    perception[direction] = 3
-            else:
-                perception[direction] = 2
+    def perceive_all(self):
+        # structured array with the id and F, B, L, R codes of every robot, in the order of self.robots
+        ids = [robot.onto_robot.id for robot in self.robots]
+        positions = np.array([self.world.positions[robot.id] for robot in self.robots])
+        return self.perception.perceive(ids, positions)
 
-        return json.dumps({
-            "id": robot.onto_robot.id,
-            "position": perception
-        })
+    def get_perception(self, robot):
+        # the json Unity posts for one robot
+        index = self.robots.index(robot)
+        return to_json(self.perceive_all()[index])
 
     def update_environment(self, robot, action):
-        current_pos = self.grid.positions[robot]
+        # True when the action was applied to the grid
+        current_pos = self.world.positions[robot.id]
 
         if action.startswith("move_"):
             direction = action.split("_")[1]
@@ -237,36 +247,34 @@ class ObjectStackingModel(ap.Model):
             dx, dy = {'F': (0, 1), 'B': (0, -1), 'L': (-1, 0), 'R': (1, 0)}[direction]
             new_pos = (current_pos[0] + dx, current_pos[1] + dy)
 
-            if (0 <= new_pos[0] < self.grid_size and 
-                0 <= new_pos[1] < self.grid_size and 
-                len(self.grid.agents[new_pos]) == 0):
+            if self.world.is_free(new_pos):
                 self.grid.move_to(robot, new_pos)
+                self.world.move_robot(robot.id, new_pos)
                 self.data['robot_movements'][robot.onto_robot.id] += 1
+                return True
 
         elif action.startswith("grab_"):
             direction = action.split("_")[1]
             dx, dy = {'F': (0, 1), 'B': (0, -1), 'L': (-1, 0), 'R': (1, 0)}[direction]
             grab_pos = (current_pos[0] + dx, current_pos[1] + dy)
 
-            if (0 <= grab_pos[0] < self.grid_size and 
-                0 <= grab_pos[1] < self.grid_size):
-                objects_at_pos = [agent for agent in self.grid.agents[grab_pos] if agent in self.objects]
-                if objects_at_pos:
-                    grabbed_object = objects_at_pos[0]
-                    self.grid.remove_agents(grabbed_object)
-                    robot.onto_robot.is_holding = [onto.Object()]
+            grabbed_id = self.world.take_object(grab_pos) if self.world.inside(grab_pos) else None
+            if grabbed_id is not None:
+                grabbed_object = self.objects_by_id[grabbed_id]
+                self.grid.remove_agents(grabbed_object)
+                self.carried[robot.id] = grabbed_object
+                robot.onto_robot.is_holding = [onto.Object()]
+                return True
 
         elif action.startswith("drop_"):
             direction = action.split("_")[1]
             dx, dy = {'F': (0, 1), 'B': (0, -1), 'L': (-1, 0), 'R': (1, 0)}[direction]
             drop_pos = (current_pos[0] + dx, current_pos[1] + dy)
 
-            if (0 <= drop_pos[0] < self.grid_size and 
-                0 <= drop_pos[1] < self.grid_size and 
-                robot.onto_robot.is_holding):
-                new_object = ap.Agent(self)
-                self.grid.add_agents(new_object, positions=[drop_pos])
-                self.objects.append(new_object)
+            if self.world.inside(drop_pos) and robot.id in self.carried:
+                dropped_object = self.carried.pop(robot.id)
+                self.grid.add_agents(dropped_object, positions=[drop_pos])
+                self.world.add_object(dropped_object.id, drop_pos)
                 robot.onto_robot.is_holding = []
 
                 stack_key = f"{drop_pos[0]},{drop_pos[1]}"
@@ -274,23 +282,27 @@ class ObjectStackingModel(ap.Model):
                     self.stacks[stack_key] = 1
                 else:
                     self.stacks[stack_key] += 1
+                return True
+
+        return False
+
+    def step_robots(self):
+        # one perception pass for all the robots. a robot may act on a cell
+        # an earlier robot changed this step, update_environment rejects that
+        # action and the robot keeps its state
+        for robot, perception in zip(self.robots, to_dicts(self.perceive_all())):
+            action = robot.decide(perception)
+            if self.update_environment(robot, action):
+                robot.act(action)
 
     def step(self):
         self.current_step += 1
-
-        for robot in self.robots:
-            perception_json = self.get_perception(robot)
-            action = robot.step(perception_json)
-            self.update_environment(robot, action)
+        self.step_robots()
 
         if self.check_end_condition():
             self.stop()
         self.current_step += 1
-
-        for robot in self.robots:
-            perception_json = self.get_perception(robot)
-            action = robot.step(perception_json)
-            self.update_environment(robot, action)
+        self.step_robots()
 
         if self.check_end_condition():
             self.stop()
@@ -0,0 +1,112 @@
+# Benchmark of the robots' perception: the loop of the old
+# ObjectStackingModel.get_perception, four cell lookups and an isinstance scan
+# per robot plus the json round trip to RobotAgent.update_state, against one
+# GridPerception pass for all the robots. The grid is a dict of agent lists
+# like ap.Grid.agents, so it runs without agentpy.
+#
+#   python bench_perception.py --sizes 10 50 200 1000 --robots 5 50 500
+
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from grid_perception import OFFSETS, GridPerception, to_dicts
+from world import WorldState
+
+
+class Robot:
+    pass
+
+
+class Box:
+    pass
+
+
+def make_world(size, robots, objects, seed):
+    rng = random.Random(seed)
+    cells = rng.sample([(x, y) for x in range(size) for y in range(size)], robots + objects)
+    grid = {}
+    world = WorldState((size, size))
+    positions = []
+    for i, pos in enumerate(cells[:robots]):
+        grid[pos] = [Robot()]
+        world.add_robot(i, pos)
+        positions.append(pos)
+    agent_id = robots
+    for pos in cells[robots:]:
+        # a third of the objects are stacks of two
+        grid[pos] = [Box() for _ in range(2 if rng.random() < 1 / 3 else 1)]
+        for _ in grid[pos]:
+            world.add_object(agent_id, pos)
+            agent_id += 1
+    return grid, GridPerception(world), positions
+
+
+def loop_perception(grid, size, robot_id, pos):
+    x, y = pos
+    perception = {}
+    for direction, (dx, dy) in OFFSETS.items():
+        new_x, new_y = x + dx, y + dy
+        if 0 <= new_x < size and 0 <= new_y < size:
+            cell_content = grid.get((new_x, new_y), [])
+            if not cell_content:
+                perception[direction] = 0
+            elif any(isinstance(agent, Robot) for agent in cell_content):
+                perception[direction] = 2
+            elif len(cell_content) == 1:
+                perception[direction] = 1
+            else:
+                perception[direction] = 3
+        else:
+            perception[direction] = 2
+    return json.dumps({"id": robot_id, "position": perception})
+
+
+def run_loop(grid, size, positions):
+    return [json.loads(loop_perception(grid, size, i, pos))["position"] for i, pos in enumerate(positions)]
+
+
+def run_vectorized(perception, ids, positions):
+    return to_dicts(perception.perceive(ids, positions))
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="perception of all the robots, loop against numpy")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 200, 1000])
+    parser.add_argument('--robots', type=int, nargs='+', default=[5, 50, 500])
+    parser.add_argument('--density', type=float, default=0.2, help="fraction of the cells with objects")
+    parser.add_argument('--repeat', type=int, default=200, help="steps timed per case")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # numpy ms includes the dicts the robots get, pass ms is perceive() alone
+    print(f"{'grid':>6} {'robots':>6} {'loop ms':>9} {'numpy ms':>9} {'pass ms':>9} {'speedup':>8}")
+    for size in args.sizes:
+        for robots in args.robots:
+            objects = int(args.density * size * size)
+            if robots + objects > size * size:
+                continue
+            grid, perception, positions = make_world(size, robots, objects, args.seed)
+            ids = np.arange(robots)
+            array = np.array(positions)
+
+            loop_time, expected = timed(lambda: run_loop(grid, size, positions), args.repeat)
+            numpy_time, result = timed(lambda: run_vectorized(perception, ids, array), args.repeat)
+            assert result == expected, "the numpy perception differs from the loop"
+            pass_time, _ = timed(lambda: perception.perceive(ids, array), args.repeat)
+
+            print(f"{size:>6} {robots:>6} {1000 * loop_time:>9.3f} {1000 * numpy_time:>9.3f} {1000 * pass_time:>9.3f} "
+                  f"{loop_time / numpy_time:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import json
+
+import numpy as np
+
+from world import ROBOT
+
+# Perception codes of the four cells around a robot, the same Unity posts to /gmrs
+FREE = 0
+BOX = 1
+BLOCKED = 2  # a robot or the edge of the grid
+STACK = 3
+
+DIRECTIONS = ('F', 'B', 'L', 'R')
+OFFSETS = {'F': (0, 1), 'B': (0, -1), 'L': (-1, 0), 'R': (1, 0)}
+
+# one row per robot: its id and the code it sees in every direction
+PERCEPTION_DTYPE = np.dtype([('id', np.int32)] + [(direction, np.int8) for direction in DIRECTIONS])
+
+
+class GridPerception:
+    # Computes what all the robots see in one numpy pass over the arrays of a
+    # world.WorldState, instead of looking up the agents of four cells per
+    # robot. The border of WALL cells makes the edges BLOCKED without bounds
+    # checks, and a pass only reads the cells around the robots.
+    def __init__(self, world):
+        self.world = world
+        self.offsets = np.array([OFFSETS[direction] for direction in DIRECTIONS]) + 1
+
+    def perceive(self, ids, positions):
+        # structured array with the id and the F, B, L, R codes of every
+        # robot, positions is a (n, 2) array of their cells
+        positions = np.asarray(positions, np.intp).reshape(-1, 2)
+        x = positions[:, 0, None] + self.offsets[:, 0]
+        y = positions[:, 1, None] + self.offsets[:, 1]
+        heights = self.world.heights[x, y]
+        # no object is FREE and one is BOX, the codes are the heights
+        codes = np.where(heights > 1, STACK, heights).astype(np.int8)
+        codes[self.world.cells[x, y] >= ROBOT] = BLOCKED
+
+        perception = np.empty(len(positions), PERCEPTION_DTYPE)
+        perception['id'] = ids
+        for i, direction in enumerate(DIRECTIONS):
+            perception[direction] = codes[:, i]
+        return perception
+
+
+def to_dict(row):
+    # {"F": 0, "B": 2, ...}, what the robots keep and Unity sends as "position"
+    return {direction: int(row[direction]) for direction in DIRECTIONS}
+
+
+def to_dicts(perception):
+    # to_dict of every row, one conversion of the whole array
+    return [dict(zip(DIRECTIONS, row[1:])) for row in perception.tolist()]
+
+
+def to_json(row):
+    # the format of the HTTP edge, {"id": 0, "position": {"F": 0, ...}}
+    return json.dumps({"id": int(row['id']), "position": to_dict(row)})
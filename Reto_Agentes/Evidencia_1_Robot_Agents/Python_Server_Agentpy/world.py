@@ -0,0 +1,65 @@
+import numpy as np
+
+# What is on a cell of the world
+EMPTY = 0
+OBJECT = 1
+ROBOT = 2
+WALL = 3  # the border around the grid
+
+
+class WorldState:
+    # The world of ObjectStackingModel in arrays: what is on every cell (int8)
+    # and how many objects are stacked on it (int16), with a border of WALL
+    # cells around the grid, plus the cell of every agent by its id and the
+    # ids stacked on every cell. Moves, grabs and drops are a few array and
+    # dict writes, no agent list is searched. The model applies every change
+    # to its ap.Grid too, which stays for the visualization.
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.cells = np.full((self.shape[0] + 2, self.shape[1] + 2), WALL, np.int8)
+        self.cells[1:-1, 1:-1] = EMPTY
+        self.heights = np.zeros(self.cells.shape, np.int16)
+        self.positions = {}
+        self.stacked = {}
+
+    def inside(self, pos):
+        return 0 <= pos[0] < self.shape[0] and 0 <= pos[1] < self.shape[1]
+
+    def is_free(self, pos):
+        return self.inside(pos) and self.cells[pos[0] + 1, pos[1] + 1] == EMPTY
+
+    def height(self, pos):
+        return int(self.heights[pos[0] + 1, pos[1] + 1]) if self.inside(pos) else 0
+
+    def add_robot(self, agent_id, pos):
+        self.positions[agent_id] = tuple(pos)
+        self.cells[pos[0] + 1, pos[1] + 1] = ROBOT
+
+    def move_robot(self, agent_id, pos):
+        old = self.positions[agent_id]
+        # a robot can end up on objects dropped by Unity's side, they stay
+        self.cells[old[0] + 1, old[1] + 1] = OBJECT if self.heights[old[0] + 1, old[1] + 1] else EMPTY
+        self.add_robot(agent_id, pos)
+
+    def add_object(self, agent_id, pos):
+        pos = tuple(pos)
+        self.positions[agent_id] = pos
+        self.stacked.setdefault(pos, []).append(agent_id)
+        self.heights[pos[0] + 1, pos[1] + 1] += 1
+        if self.cells[pos[0] + 1, pos[1] + 1] == EMPTY:
+            self.cells[pos[0] + 1, pos[1] + 1] = OBJECT
+
+    def take_object(self, pos):
+        # id of the top object of the cell, None when there is none
+        stack = self.stacked.get(tuple(pos))
+        if not stack:
+            return None
+
+        agent_id = stack.pop()
+        if not stack:
+            del self.stacked[tuple(pos)]
+        del self.positions[agent_id]
+        self.heights[pos[0] + 1, pos[1] + 1] -= 1
+        if not self.heights[pos[0] + 1, pos[1] + 1] and self.cells[pos[0] + 1, pos[1] + 1] == OBJECT:
+            self.cells[pos[0] + 1, pos[1] + 1] = EMPTY
+        return agent_id
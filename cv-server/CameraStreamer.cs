@@ -1,4 +1,5 @@
 using UnityEngine;
+using System;
 using System.Collections;
 using System.Net.Sockets;
 using System.Net.Http.Headers;
@@ -18,6 +19,50 @@ public class CameraStreamer : MonoBehaviour
     [Header("Configuraciones")] [Tooltip("Puerto del servidor de python")]
     public int serverPort = 5000;
 
+    [Header("Protocolo")] [Tooltip("Enviar el encabezado binario v2 (id de camara, numero de frame y timestamp) en lugar de solo la longitud")]
+    public bool useFramedProtocol = false;
+
+    [Header("Protocolo")] [Tooltip("Id de la camara que se envia en el encabezado v2")]
+    public int cameraId = 0;
+
+    [Header("Protocolo")] [Tooltip("Pedir al servidor las detecciones de cada frame (solo con el encabezado v2)")]
+    public bool receiveDetections = false;
+
+    // una deteccion tal como la manda el servidor, ver detections.py
+    public struct Detection
+    {
+        public float x1, y1, x2, y2;
+        public float confidence;
+        public int classId;
+        public int trackId;
+    }
+
+    // detecciones del ultimo frame respondido por el servidor
+    public Detection[] latestDetections = new Detection[0];
+
+    // numero de frame al que corresponden latestDetections
+    public uint latestDetectionsSequence;
+
+    // false mientras el servidor sigue cargando el modelo, las respuestas llegan sin detecciones
+    public bool serverReady = false;
+
+    // encabezado v2, ver framing.py en el servidor
+    // magic (4) | version (1) | flags (1) | camera id (2) | length (4) | sequence (4) | timestamp us (8)
+    private static readonly byte[] frameMagic = { (byte)'C', (byte)'V', (byte)'F', (byte)'R' };
+    private const int frameHeaderSize = 24;
+    private static readonly DateTime unixEpoch = new DateTime(1970, 1, 1, 0, 0, 0, DateTimeKind.Utc);
+
+    // respuesta del servidor: magic "CVDT" (4) | sequence (4) | count (2) | flags (2) | count * 7 float32
+    private const byte flagResultsBinary = 0x01;
+    private const int resultNotReady = 0x01;
+    private const int resultHeaderSize = 12;
+    private const int resultRowSize = 7 * 4;
+    private byte[] resultBuffer = new byte[64 * 1024];
+    private int resultBytes = 0;
+
+    // numero de frame, el servidor lo usa para contar frames perdidos
+    private uint frameSequence = 0;
+
     // textura donde se va a renderizar la camara
     private RenderTexture renderTexture;
 
@@ -62,10 +107,62 @@ public class CameraStreamer : MonoBehaviour
         // si la conexion con el servidor esta establecida, capturar y enviar frame
         if (client.Connected)
         {
+            if (useFramedProtocol && receiveDetections)
+            {
+                ReadDetections();
+            }
+
             StartCoroutine(CaptureAndSendFrame());
         }
     }
 
+    void ReadDetections()
+    {
+        // leer solo lo que ya llego, sin bloquear el frame
+        while (stream.DataAvailable)
+        {
+            if (resultBytes == resultBuffer.Length)
+            {
+                Array.Resize(ref resultBuffer, resultBuffer.Length * 2);
+            }
+            resultBytes += stream.Read(resultBuffer, resultBytes, resultBuffer.Length - resultBytes);
+        }
+
+        // procesar todas las respuestas completas
+        int offset = 0;
+        while (resultBytes - offset >= resultHeaderSize)
+        {
+            int count = BitConverter.ToUInt16(resultBuffer, offset + 8);
+            int size = resultHeaderSize + count * resultRowSize;
+            if (resultBytes - offset < size)
+            {
+                break;
+            }
+
+            var dets = new Detection[count];
+            for (int i = 0; i < count; i++)
+            {
+                int row = offset + resultHeaderSize + i * resultRowSize;
+                dets[i].x1 = BitConverter.ToSingle(resultBuffer, row);
+                dets[i].y1 = BitConverter.ToSingle(resultBuffer, row + 4);
+                dets[i].x2 = BitConverter.ToSingle(resultBuffer, row + 8);
+                dets[i].y2 = BitConverter.ToSingle(resultBuffer, row + 12);
+                dets[i].confidence = BitConverter.ToSingle(resultBuffer, row + 16);
+                dets[i].classId = (int)BitConverter.ToSingle(resultBuffer, row + 20);
+                dets[i].trackId = (int)BitConverter.ToSingle(resultBuffer, row + 24);
+            }
+
+            latestDetectionsSequence = BitConverter.ToUInt32(resultBuffer, offset + 4);
+            serverReady = (BitConverter.ToUInt16(resultBuffer, offset + 10) & resultNotReady) == 0;
+            latestDetections = dets;
+            offset += size;
+        }
+
+        // mover al inicio lo que quedo de una respuesta incompleta
+        Buffer.BlockCopy(resultBuffer, offset, resultBuffer, 0, resultBytes - offset);
+        resultBytes -= offset;
+    }
+
     IEnumerator CaptureAndSendFrame()
     {
         yield return new WaitForEndOfFrame();
@@ -80,14 +177,42 @@ public class CameraStreamer : MonoBehaviour
         // convertir textura a bytes en formato jpg
         byte[] bytes = texture2D.EncodeToJPG();
 
-        // enviar cantidad de bytes en la imagen
-        var length = System.Text.Encoding.UTF8.GetBytes(bytes.Length.ToString());
-        stream.Write(length, 0, length.Length);
+        if (useFramedProtocol)
+        {
+            // enviar encabezado v2
+            byte[] header = BuildFrameHeader(bytes.Length);
+            stream.Write(header, 0, header.Length);
+        }
+        else
+        {
+            // enviar cantidad de bytes en la imagen
+            var length = System.Text.Encoding.UTF8.GetBytes(bytes.Length.ToString());
+            stream.Write(length, 0, length.Length);
+        }
 
         // enviar bytes de la imagen
         stream.Write(bytes, 0, bytes.Length);
     }
 
+    byte[] BuildFrameHeader(int length)
+    {
+        byte[] header = new byte[frameHeaderSize];
+
+        // timestamp de captura en microsegundos desde epoch
+        long timestamp = (DateTime.UtcNow.Ticks - unixEpoch.Ticks) / 10;
+
+        // BitConverter escribe en little endian, igual que el servidor
+        Buffer.BlockCopy(frameMagic, 0, header, 0, 4);
+        header[4] = 2;
+        header[5] = receiveDetections ? flagResultsBinary : (byte)0;
+        Buffer.BlockCopy(BitConverter.GetBytes((ushort)cameraId), 0, header, 6, 2);
+        Buffer.BlockCopy(BitConverter.GetBytes((uint)length), 0, header, 8, 4);
+        Buffer.BlockCopy(BitConverter.GetBytes(frameSequence++), 0, header, 12, 4);
+        Buffer.BlockCopy(BitConverter.GetBytes((ulong)timestamp), 0, header, 16, 8);
+
+        return header;
+    }
+
     void OnApplicationQuit()
     {
         if (client != null && client.Connected)
@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flow import FlowControl
+from framing import (
+    ENCODING_JPEG,
+    HEADER_V2,
+    HEADER_V3_EXTENSION,
+    LEGACY_HEADER_SIZE,
+    MAGIC,
+    VERSION,
+    VERSION_RAW,
+    Frame,
+    StreamStats,
+    split_legacy_header,
+    unpack_extension,
+    unpack_header,
+)
+
+
+class AsyncFrameReader:
+    # same framing and timings as framing.FrameReceiver but reading from an asyncio stream
+    def __init__(self, reader, camera_id=None):
+        self.reader = reader
+        self.camera_id = camera_id
+        self.protocol = None
+        self.sequence = 0
+
+        self.header_time = 0.0
+        self.payload_time = 0.0
+
+    async def receive(self):
+        # returns the next Frame or None when the client disconnects
+        try:
+            head = b''
+            if self.protocol is None:
+                head = await self.reader.readexactly(len(MAGIC))
+                self.protocol = VERSION if head == MAGIC else 1
+
+            if self.protocol == VERSION:
+                header = head + await self.reader.readexactly(HEADER_V2.size - len(head))
+                start = time.perf_counter()
+                camera_id, data_len, sequence, timestamp, flags, version = unpack_header(header)
+
+                encoding, width, height = ENCODING_JPEG, 0, 0
+                if version == VERSION_RAW:
+                    extension = await self.reader.readexactly(HEADER_V3_EXTENSION.size)
+                    encoding, width, height = unpack_extension(extension, data_len)
+                parsed = time.perf_counter()
+
+                # readexactly hands back its own bytes object, so the payload
+                # can be queued without being overwritten by the next frame
+                payload = await self.reader.readexactly(data_len)
+                self.header_time = parsed - start
+                self.payload_time = time.perf_counter() - parsed
+                return Frame(camera_id, sequence, timestamp, payload, flags,
+                             encoding=encoding, width=width, height=height)
+
+            header = head + await self.reader.readexactly(LEGACY_HEADER_SIZE - len(head))
+            start = time.perf_counter()
+            data_len, digits = split_legacy_header(header)
+            parsed = time.perf_counter()
+
+            # the bytes after the digits already belong to the image
+            initial = LEGACY_HEADER_SIZE - digits
+            if data_len < initial:
+                raise ValueError("frame length {} is smaller than the header".format(data_len))
+
+            payload = header[digits:] + await self.reader.readexactly(data_len - initial)
+            self.header_time = parsed - start
+            self.payload_time = time.perf_counter() - parsed
+
+            self.sequence += 1
+            return Frame(self.camera_id, self.sequence, None, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # closed or reset, a client that leaves replies unread resets the connection
+            return None
+
+
+class AsyncIngestServer:
+    # reads the frames of every camera on one event loop. decoding runs on a
+    # thread pool (see decoding.DecodeStage), frames wait for their decode in a
+    # per camera slot (see slots.AsyncFrameSlot) and a consumer task per camera
+    # sends them to the inference stage (see inference.BatchScheduler) one at a time
+    def __init__(self, submit_decode, submit_frame, handle_results, close_stream, make_slot,
+                 host='127.0.0.1', port=5500, max_connections=32, record_frame=None, observe=None):
+        # submit_decode(frame, payload) returns a concurrent Future with the image and its scale,
+        # submit_frame(camera_id, img) returns a concurrent Future with the detections,
+        # handle_results(frame, img, dets) returns the bytes to write back to the
+        # camera (or None) and False to stop the server,
+        # close_stream(camera_id) is called for every camera of a closed connection,
+        # record_frame(frame) for every frame as it arrives and
+        # observe(stage, camera_id, seconds) with the timings of the reader and the inference
+        self.submit_decode = submit_decode
+        self.submit_frame = submit_frame
+        self.handle_results = handle_results
+        self.close_stream = close_stream
+        self.make_slot = make_slot
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.record_frame = record_frame
+        self.observe = observe
+
+        self.logger = logging.getLogger("async_server")
+        self.clients = set()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self):
+        self.stop_event.set()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+
+        self.stop_event = asyncio.Event()
+
+        # results are tracked and displayed from a single thread
+        self.output_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="output")
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # windows, ctrl+c ends asyncio.run with a KeyboardInterrupt instead
+                pass
+
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+
+        self.logger.info("async server listening on port: {}:{} (max connections: {})".format(
+            self.host, self.port, self.max_connections))
+
+        try:
+            await self.stop_event.wait()
+        finally:
+            self.logger.info("terminating async server")
+
+            # stop accepting, then close the clients
+            server.close()
+            await server.wait_closed()
+
+            for task in list(self.clients):
+                task.cancel()
+            await asyncio.gather(*self.clients, return_exceptions=True)
+
+            self.output_executor.shutdown(wait=True)
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+
+        if len(self.clients) >= self.max_connections:
+            self.logger.warning("rejecting client {}, {} connections open".format(addr, len(self.clients)))
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self.clients.add(task)
+        self.logger.info("connected to client: {}".format(addr))
+
+        frame_reader = AsyncFrameReader(reader, camera_id="{}:{}".format(*addr[:2]))
+        stats = StreamStats()
+        cameras = set()
+
+        slot = self.make_slot()
+        # credits for cameras that ask for them, see flow.py
+        flow = FlowControl(window=slot.capacity)
+        consumer = asyncio.create_task(self.consume_frames(slot, stats, writer, flow))
+
+        try:
+            while not slot.closed:
+                frame = await frame_reader.receive()
+                if frame is None:
+                    break
+
+                stats.update(frame)
+                flow.received(frame)
+                cameras.add(frame.camera_id)
+                if self.observe is not None:
+                    self.observe('header', frame.camera_id, frame_reader.header_time)
+                    self.observe('receive', frame.camera_id, frame_reader.payload_time)
+                if self.record_frame is not None:
+                    self.record_frame(frame)
+
+                # the reader moves on to the next frame while this one decodes
+                slot.put((frame, self.submit_decode(frame, frame.payload)))
+        except ValueError as e:
+            self.logger.error(str(e))
+        except asyncio.CancelledError:
+            # the server is shutting down, the handler ends like a normal disconnect
+            consumer.cancel()
+        finally:
+            slot.close()
+            await asyncio.gather(consumer, return_exceptions=True)
+
+            for camera_id in cameras:
+                self.close_stream(camera_id)
+
+            self.clients.discard(task)
+            writer.close()
+            self.logger.info("client disconnected: {} {} {}".format(addr, stats.summary(), slot.summary()))
+            if flow.enabled:
+                self.logger.info(flow.summary())
+
+    async def send(self, writer, slot, frame, data):
+        # False when the camera is gone
+        try:
+            writer.write(data)
+            # a camera that stops reading its replies is not buffered without limit
+            await writer.drain()
+        except ConnectionError as e:
+            self.logger.warning("could not send the detections to {}: {}".format(frame.camera_id, e))
+            slot.close()
+            return False
+        return True
+
+    async def consume_frames(self, slot, stats, writer, flow):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            start = time.perf_counter()
+            item = await slot.get()
+            if item is None:
+                break
+
+            frame, decoding = item
+            # the camera sends its next frame while this one is processed
+            control = flow.taken(frame, time.perf_counter() - start)
+            if control is not None and not await self.send(writer, slot, frame, control):
+                break
+
+            img, scale = await asyncio.wrap_future(decoding)
+            if img is None:
+                self.logger.warning("could not decode frame {} of camera {}".format(frame.sequence, frame.camera_id))
+                continue
+            frame = frame._replace(payload=None, scale=scale)
+            flow.decoded(frame, img)
+
+            # submitting may block while the inference stage is full, keep it off the loop
+            start = time.perf_counter()
+            future = await loop.run_in_executor(None, self.submit_frame, frame.camera_id, img)
+            try:
+                dets = await asyncio.wrap_future(future)
+            except Exception as e:
+                # the frame is lost, not the camera
+                self.logger.warning("no detections for frame {} of camera {}: {!r}".format(
+                    frame.sequence, frame.camera_id, e))
+                slot.mark_processed()
+                continue
+            if self.observe is not None:
+                self.observe('inference', frame.camera_id, time.perf_counter() - start)
+            slot.mark_processed()
+            if dets is None:
+                continue
+
+            reply, keep_running = await loop.run_in_executor(self.output_executor, self.handle_results, frame, img, dets)
+            if reply is not None and not await self.send(writer, slot, frame, reply):
+                break
+            stats.update_latency(frame)
+
+            if not keep_running:
+                self.stop()
@@ -0,0 +1,93 @@
+# decode benchmark of decoding.DecodeStage, synthetic jpg frames at camera
+# resolution decoded at full size inline (the old path) and through the stage
+# with the reduced decoders on 1, 2, 4... threads, then the same frame sent as
+# raw rgb24 pixels, plain and lz4 compressed (when the lz4 package is installed)
+#
+#   python bench_decode.py --frames 300 --width 1920 --height 1080
+
+import argparse
+import os
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from decoding import DecodeStage, load_lz4
+from framing import ENCODING_JPEG, ENCODING_RGB24, ENCODING_RGB24_LZ4
+
+
+def make_frame(width, height):
+    # gradients and noise, compresses like a rendered scene rather than flat color
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = np.dstack([x + 0 * y, y + 0 * x, (x + y) / 2]).astype(np.uint8)
+    return cv2.add(img, np.random.randint(0, 40, img.shape, np.uint8))
+
+
+def make_jpeg(img):
+    return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 75])[1].tobytes()
+
+
+def run_inline(data, frames):
+    start = time.perf_counter()
+    for _ in range(frames):
+        cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    return frames / (time.perf_counter() - start)
+
+
+def run_stage(data, frames, threads, reduce, encoding=ENCODING_JPEG, width=0, height=0):
+    stage = DecodeStage(threads, reduce=reduce)
+
+    # a few frames in flight per thread, like the slots in front of inference
+    pending = deque()
+    start = time.perf_counter()
+    for _ in range(frames):
+        if len(pending) >= 2 * threads:
+            img, scale = pending.popleft().result()
+        pending.append(stage.submit(data, None, encoding, width, height, True))
+    while pending:
+        img, scale = pending.popleft().result()
+    elapsed = time.perf_counter() - start
+    stage.shutdown()
+    return frames / elapsed, img.shape, scale
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--max-threads', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    img = make_frame(args.width, args.height)
+    data = make_jpeg(img)
+    print("frame: {}x{} jpg {} bytes".format(args.width, args.height, len(data)))
+
+    fps = run_inline(data, args.frames)
+    print("before (inline, full):  {:>8.1f} frames/s {:.2f} ms/frame".format(fps, 1000 / fps))
+
+    threads = 1
+    while threads <= args.max_threads:
+        for reduce in (False, True):
+            fps, shape, scale = run_stage(data, args.frames, threads, reduce)
+            print("after  ({} threads, {}): {:>8.1f} frames/s {:.2f} ms/frame -> {}x{} scale {:.1f}".format(
+                threads, 'reduced' if reduce else 'full', fps, 1000 / fps, shape[1], shape[0], scale))
+        threads *= 2
+
+    # what a camera on the same machine sends instead, bottom row first like Unity
+    raw = {ENCODING_RGB24: cv2.cvtColor(img[::-1], cv2.COLOR_BGR2RGB).tobytes()}
+    lz4 = load_lz4()
+    if lz4 is not None:
+        raw[ENCODING_RGB24_LZ4] = lz4.compress(raw[ENCODING_RGB24], store_size=False)
+
+    for encoding, payload in raw.items():
+        name = 'rgb24' if encoding == ENCODING_RGB24 else 'rgb24-lz4'
+        fps, shape, scale = run_stage(payload, args.frames, 1, True, encoding, args.width, args.height)
+        print("raw    ({}, {} bytes): {:>8.1f} frames/s {:.2f} ms/frame -> {}x{} scale {:.1f}".format(
+            name, len(payload), fps, 1000 / fps, shape[1], shape[0], scale))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# microbenchmark of the frame receive path of handle_socket_client
+# sends legacy framed payloads over a local socket pair and measures how many
+# MB/s a single connection can receive with the old and the new code
+#
+#   python bench_receive.py --frames 500 --size 200000
+
+import argparse
+import socket
+import time
+from threading import Thread
+
+from framing import FrameReceiver, pack_header
+
+
+def get_numeric_data(buffer):
+    # copy of the original byte by byte header parser
+    numeric_buffer = b''
+    left_bytes = b''
+
+    for b in buffer:
+        if b >= 48 and b <= 57:
+            numeric_buffer += bytes([b])
+        else:
+            left_bytes += bytes([b])
+
+    return numeric_buffer, left_bytes
+
+
+def receive_before(client_socket):
+    # copy of the original receive loop, only the bytes_left computation was
+    # fixed so it can read more than one frame in a row
+    data = client_socket.recv(7)
+    if not data:
+        return None
+
+    numeric_data, initial_buffer = get_numeric_data(data)
+    data_len = int(numeric_data.decode('ascii'))
+
+    buffer = initial_buffer
+    bytes_left = data_len - len(buffer)
+
+    while True:
+        fragment = client_socket.recv(bytes_left)
+        if not fragment:
+            break
+
+        buffer += fragment
+        if len(buffer) == data_len:
+            break
+        else:
+            bytes_left = data_len - len(buffer)
+
+    return buffer
+
+
+def make_payload(size):
+    # fake jpeg, starts with the SOI marker like the frames from Unity
+    body = bytes(range(256)) * (size // 256 + 1)
+    return b'\xff\xd8' + body[:size - 2]
+
+
+def send_frames(sock, payload, frames, protocol):
+    length = bytes(str(len(payload)), 'ascii')
+    for sequence in range(frames):
+        if protocol == 'v2':
+            sock.sendall(pack_header(0, sequence, len(payload)))
+        else:
+            sock.sendall(length)
+        sock.sendall(payload)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def run(name, receive, payload, frames, protocol='legacy'):
+    server_side, client_side = socket.socketpair()
+    sender = Thread(target=send_frames, args=(client_side, payload, frames, protocol))
+
+    received = 0
+    start = time.perf_counter()
+    sender.start()
+
+    while received < frames:
+        buffer = receive(server_side)
+        if buffer is None:
+            break
+        if not isinstance(buffer, bytes):
+            buffer = buffer.payload
+        assert len(buffer) == len(payload)
+        received += 1
+
+    elapsed = time.perf_counter() - start
+    sender.join()
+    server_side.close()
+    client_side.close()
+
+    mb = received * len(payload) / 1e6
+    print("{:<10} {:>6} frames {:>9.1f} MB/s {:>9.1f} frames/s".format(
+        name, received, mb / elapsed, received / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--size', type=int, default=200000, help="frame size in bytes")
+    args = parser.parse_args()
+
+    payload = make_payload(args.size)
+
+    run('before', receive_before, payload, args.frames)
+
+    # a receiver keeps its buffer between frames, like one client connection
+    receivers = {}
+
+    def receive_after(sock):
+        if sock not in receivers:
+            receivers[sock] = FrameReceiver(sock)
+        return receivers[sock].receive()
+
+    run('after', receive_after, payload, args.frames)
+    run('after v2', receive_after, payload, args.frames, 'v2')
+
+
+if __name__ == '__main__':
+    main()
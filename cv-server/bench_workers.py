@@ -0,0 +1,73 @@
+# scaling benchmark of the process pool inference mode (workers.InferencePool)
+# a synthetic detector burns CPU while holding the GIL, like the python side
+# of YOLO inference does, so the numbers don't depend on having the weights.
+# frames/s should grow close to linearly with the workers up to the cores
+#
+#   python bench_workers.py --frames 400 --work 200000
+
+import argparse
+import os
+import time
+from functools import partial
+
+import numpy as np
+
+import detections
+from workers import InferencePool
+
+
+def make_busy_detector(work):
+    def detect(img):
+        # pure python loop, keeps the GIL for the whole "inference"
+        total = 0
+        for i in range(work):
+            total += i * i
+        # touch the frame so it is really read from the ring
+        int(img[0, 0, 0])
+        return detections.empty()
+
+    return detect
+
+
+def run(workers, frames, work, shape):
+    pool = InferencePool(partial(make_busy_detector, work), workers=workers, max_frame_shape=shape)
+    pool.start()
+
+    img = np.zeros(shape, np.uint8)
+
+    # warm up, waits for every worker to be running
+    for future in [pool.submit(0, img) for _ in range(workers)]:
+        future.result()
+
+    start = time.perf_counter()
+    futures = [pool.submit(i % 8, img) for i in range(frames)]
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+
+    pool.stop()
+    return frames / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=400)
+    parser.add_argument('--work', type=int, default=200000, help="loop iterations per frame")
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    args = parser.parse_args()
+
+    shape = (args.height, args.width, 3)
+
+    workers = 1
+    baseline = None
+    while workers <= args.max_workers:
+        fps = run(workers, args.frames, args.work, shape)
+        baseline = baseline or fps
+        print("workers: {:>3} {:>9.1f} frames/s speedup: {:.2f}x".format(workers, fps, fps / baseline))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import numpy as np
+
+import detections
+from detections import CLS, CONF, X1, X2, Y1, Y2
+from inference import chain
+
+
+class CameraFilters:
+    # class whitelist and confidence threshold of every camera. cameras maps a
+    # camera id to its (class names, confidence), the others get the default
+    # classes and confidence. None as class names keeps every class. the
+    # union of the whitelists is what the detectors are built with, so the
+    # classes no camera wants are dropped before nms
+    def __init__(self, classes=None, conf=0.0, cameras=None):
+        self.default = (classes, conf)
+        self.cameras = dict(cameras or {})
+        self.ids = {}
+
+    def union(self):
+        # class names every detector has to keep, None for all of them
+        whitelists = [classes for classes, _ in [self.default] + list(self.cameras.values())]
+        if any(classes is None for classes in whitelists):
+            return None
+        return sorted(set().union(*whitelists))
+
+    def class_ids(self, names):
+        # class ids of every whitelist in a model with these class names
+        by_name = {name: cls for cls, name in names.items()}
+        return {tuple(classes): np.array([by_name[name] for name in classes if name in by_name])
+                for classes, _ in [self.default] + list(self.cameras.values()) if classes is not None}
+
+    def prepare(self, names):
+        # class ids of the full model once it is loaded
+        self.ids = self.class_ids(names)
+
+    def apply(self, camera_id, dets, conf=None, ids=None):
+        # the detections the camera wants. conf replaces its threshold and ids
+        # the class ids of the full model, for the cheap pass of the cascade
+        classes, camera_conf = self.cameras.get(camera_id, self.default)
+        keep = dets[:, CONF] >= (camera_conf if conf is None else conf)
+        if classes is not None:
+            keep &= np.isin(dets[:, CLS], (self.ids if ids is None else ids).get(tuple(classes), ()))
+        return dets if keep.all() else dets[keep]
+
+
+class CameraCascade:
+    def __init__(self):
+        self.frames = 0
+        self.skipped = 0
+        self.cropped = 0
+
+
+class Cascade:
+    # runs a cheap detector first, a small model or the same one at a lower
+    # resolution, and the full detector only on the frames where the cheap
+    # one saw a class the camera cares about with at least trigger
+    # confidence. with crop the full detector only sees the region around
+    # those boxes when it is small enough. frames where the cheap pass found
+    # nothing get no detections. until the cheap detector is loaded every
+    # frame goes to the full one. the full detector is submitted to from the
+    # executor, submitting may block while the inference stage is full
+    def __init__(self, filters, trigger=0.15, crop=True, max_crop=0.5, margin=0.25, report_interval=10.0):
+        self.filters = filters
+        self.trigger = trigger
+        self.crop = crop
+        self.max_crop = max_crop
+        self.margin = margin
+        self.report_interval = report_interval
+
+        # submit(camera_id, img) of the cheap detector's inference stage and
+        # the class ids of its model, set by start() once it is loaded
+        self.submit_cheap = None
+        self.cheap_ids = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cascade")
+
+        self.logger = logging.getLogger("cascade")
+        self.cameras = {}
+        self.lock = Lock()
+        self.last_report = time.perf_counter()
+
+    def start(self, submit_cheap, names):
+        self.cheap_ids = self.filters.class_ids(names)
+        self.submit_cheap = submit_cheap
+
+    def stop(self):
+        # a full pass waiting for room in a stopped inference stage would never end
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def get(self, camera_id):
+        with self.lock:
+            camera = self.cameras.get(camera_id)
+            if camera is None:
+                camera = self.cameras[camera_id] = CameraCascade()
+            return camera
+
+    def reset(self, camera_id):
+        with self.lock:
+            camera = self.cameras.pop(camera_id, None)
+        if camera is not None and camera.frames:
+            self.logger.info("camera {} {}".format(camera_id, self.summary([camera])))
+
+    def submit(self, camera_id, img, submit_frame):
+        # same interface as the inference stage, submit_frame(camera_id, img)
+        # is the full detector
+        if self.submit_cheap is None:
+            return submit_frame(camera_id, img)
+
+        camera = self.get(camera_id)
+        camera.frames += 1
+        self.report()
+
+        def cheap_done(dets):
+            # on the executor, the full detector or the empty detections
+            found = self.filters.apply(camera_id, dets, self.trigger, self.cheap_ids)
+            if not len(found):
+                camera.skipped += 1
+                return detections.empty()
+
+            region = self.region(img, found) if self.crop else None
+            if region is None:
+                return submit_frame(camera_id, img)
+
+            camera.cropped += 1
+            x0, y0, x1, y1 = region
+
+            def offset(dets):
+                dets = dets.copy()
+                dets[:, [X1, X2]] += x0
+                dets[:, [Y1, Y2]] += y0
+                return dets
+
+            return chain(submit_frame(camera_id, np.ascontiguousarray(img[y0:y1, x0:x1])), offset)
+
+        return chain(self.submit_cheap(camera_id, img), cheap_done, self.executor)
+
+    def region(self, img, dets):
+        # the boxes the cheap pass found with a margin around them, None when
+        # that is too much of the frame to be worth cropping
+        height, width = img.shape[:2]
+        x0, y0 = dets[:, X1].min(), dets[:, Y1].min()
+        x1, y1 = dets[:, X2].max(), dets[:, Y2].max()
+        margin = self.margin * max(x1 - x0, y1 - y0)
+        x0, y0 = max(0, int(x0 - margin)), max(0, int(y0 - margin))
+        x1, y1 = min(width, int(x1 + margin)), min(height, int(y1 + margin))
+        if (x1 - x0) * (y1 - y0) > self.max_crop * width * height:
+            return None
+        return x0, y0, x1, y1
+
+    def report(self):
+        now = time.perf_counter()
+        if now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+
+        with self.lock:
+            cameras = list(self.cameras.values())
+        self.logger.info(self.summary(cameras))
+
+    def summary(self, cameras):
+        frames = sum(camera.frames for camera in cameras)
+        skipped = sum(camera.skipped for camera in cameras)
+        cropped = sum(camera.cropped for camera in cameras)
+        ratio = skipped / frames if frames else 0.0
+        return "cascade: frames: {} without the full detector: {} ({:.0f}%) cropped: {}".format(
+            frames, skipped, 100 * ratio, cropped)
@@ -1,29 +1,442 @@
-# start connection with client socket
-# send and receive data from client
-# close connection with client socket
+# synthetic cameras for load testing the server
+# every stream is one connection sending frames at a target fps, with the v2
+# header the server replies the detections of each frame and the latency from
+# sending a frame to receiving its detections is measured. the report is json
+#
+#   python client.py --streams 8 --fps 15 --duration 30 --source frames/
+#   python client.py --streams 4 --source video.mp4 --output run.json
+#   python client.py --protocol legacy --frames 1     # one frame, like the old client
+#   python client.py --encoding rgb24-lz4              # raw pixels instead of jpg
+#   python client.py --fps 0 --flow-control            # as fast as the server grants credits
 
+import argparse
+import glob
+import json
 import socket
+import sys
+import time
+from os import path
+from threading import Condition, Lock, Thread
 
-# create a socket object
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+import cv2
+import numpy as np
 
-# get local machine name
-host = "127.0.0.1"
+import detections
+import flow
+from decoding import jpeg_size
+from framing import ENCODING_RGB24, ENCODING_RGB24_LZ4, FLAG_FLOW_CONTROL, FLAG_RESULTS_BINARY, pack_header
 
-port = 5000
+DEFAULT_IMAGE = '../../assets/aerial-drone-pov.jpg'
 
-# connection to hostname on the port
-client_socket.connect((host, port))
+# quality of Texture2D.EncodeToJPG() in CameraStreamer.cs
+JPEG_QUALITY = [cv2.IMWRITE_JPEG_QUALITY, 75]
 
-# read jpg image
-with open('../../assets/aerial-drone-pov.jpg', 'rb') as f:
-    # bytes from image
-    image_data = f.read()
 
-    b = bytes(str(len(image_data)), 'ascii')
+def load_frames(source, max_frames, width, height):
+    # jpg payloads kept in memory, so reading them doesn't limit the send rate
+    if source is None and path.exists(DEFAULT_IMAGE):
+        source = DEFAULT_IMAGE
 
-    # convert the image bytes to string
-    client_socket.sendall(b)
+    if source is None:
+        # no image around, a synthetic frame: upscaled noise compresses like a camera frame
+        noise = np.random.randint(0, 255, (max(1, height // 16), max(1, width // 16), 3), np.uint8)
+        img = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+        return [cv2.imencode('.jpg', img, JPEG_QUALITY)[1].tobytes()]
 
-    # write
-    client_socket.sendall(image_data)
+    if path.isdir(source):
+        files = sorted(glob.glob(path.join(source, '*.jpg')) + glob.glob(path.join(source, '*.jpeg')))
+        frames = []
+        for file in files[:max_frames]:
+            with open(file, 'rb') as f:
+                frames.append(f.read())
+        return frames
+
+    if source.lower().endswith(('.jpg', '.jpeg')):
+        with open(source, 'rb') as f:
+            return [f.read()]
+
+    # a video, re-encoded frame by frame like CameraStreamer.cs does
+    cap = cv2.VideoCapture(source)
+    frames = []
+    while len(frames) < max_frames:
+        ret, img = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.imencode('.jpg', img, JPEG_QUALITY)[1].tobytes())
+    cap.release()
+    return frames
+
+
+def raw_frames(frames, encoding):
+    # the jpgs as rgb24 pixels, what a camera on the same machine sends with
+    # the v3 header. returns (payload, width, height) per frame
+    if encoding == ENCODING_RGB24_LZ4:
+        import lz4.block
+
+    raw = []
+    for frame in frames:
+        img = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+        payload = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).tobytes()
+        if encoding == ENCODING_RGB24_LZ4:
+            payload = lz4.block.compress(payload, store_size=False)
+        raw.append((payload, img.shape[1], img.shape[0]))
+    return raw
+
+
+def resize_frame(frame, encoding, size):
+    # a frame of the source at the size the server asked for, encoded the same way
+    if encoding is None:
+        img = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+        return cv2.imencode('.jpg', cv2.resize(img, size, interpolation=cv2.INTER_AREA), JPEG_QUALITY)[1].tobytes()
+
+    payload, width, height = frame
+    if encoding == ENCODING_RGB24_LZ4:
+        import lz4.block
+        payload = lz4.block.decompress(payload, uncompressed_size=width * height * 3)
+
+    img = cv2.resize(np.frombuffer(payload, np.uint8).reshape(height, width, 3), size, interpolation=cv2.INTER_AREA)
+    payload = img.tobytes()
+    if encoding == ENCODING_RGB24_LZ4:
+        payload = lz4.block.compress(payload, store_size=False)
+    return payload, size[0], size[1]
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class CameraStream:
+    # one connection: a sender paced at fps and, with v2, a receiver for the
+    # replies. with flow control the sender is also the reference for a
+    # camera following the server's credits (see flow.py): it only sends
+    # sequences up to the last allowed one, caps its fps at the max fps and
+    # scales its frames down to the max size the server asks for
+    def __init__(self, camera_id, frames, args):
+        self.camera_id = camera_id
+        self.frames = frames
+        self.args = args
+        self.replies = args.protocol == 'v2'
+        self.encoding = ENCODINGS[args.encoding]
+        self.flow_control = args.flow_control
+        self.flags = (FLAG_RESULTS_BINARY if self.replies else 0) | (FLAG_FLOW_CONTROL if self.flow_control else 0)
+
+        self.sock = None
+        self.lock = Lock()
+        self.sent_at = {}
+
+        # last control message, the first frame needs no credit
+        self.credits = Condition(self.lock)
+        self.allowed = 0
+        self.max_size = (0, 0)
+        self.max_fps = 0.0
+        self.resized = {}
+        self.control_messages = 0
+        self.credit_waits = 0
+        self.credit_wait_time = 0.0
+        self.closed = False
+
+        self.sent = 0
+        self.received = 0
+        self.not_ready = 0
+        self.detections = 0
+        self.latencies = []
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    def connect(self):
+        self.sock = socket.create_connection((self.args.host, self.args.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @property
+    def reads(self):
+        return self.replies or self.flow_control
+
+    def wait_credit(self, sequence, deadline):
+        # False when the deadline passed or the connection closed before a credit came
+        with self.credits:
+            if sequence <= self.allowed:
+                return True
+
+            self.credit_waits += 1
+            start = time.perf_counter()
+            while sequence > self.allowed and not self.closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.credits.wait(remaining)
+            self.credit_wait_time += time.perf_counter() - start
+            return sequence <= self.allowed
+
+    def frame(self, sequence):
+        index = sequence % len(self.frames)
+        frame = self.frames[index]
+
+        max_width, max_height = self.max_size
+        if not max_width:
+            return frame
+
+        width, height = frame[1:] if self.encoding is not None else jpeg_size(frame)
+        if width <= max_width and height <= max_height:
+            return frame
+
+        key = (index, max_width, max_height)
+        if key not in self.resized:
+            self.resized[key] = resize_frame(frame, self.encoding, (max_width, max_height))
+        return self.resized[key]
+
+    def send_frame(self, sequence, frame):
+        # frame is the jpg, or (payload, width, height) for raw encodings
+        payload, width, height = frame if self.encoding is not None else (frame, 0, 0)
+
+        if self.args.protocol != 'legacy':
+            header = pack_header(self.camera_id, sequence, len(payload), time.time(), self.flags,
+                                 self.encoding, width, height)
+            if self.replies:
+                with self.lock:
+                    self.sent_at[sequence] = time.perf_counter()
+        else:
+            header = str(len(payload)).encode('ascii')
+
+        self.sock.sendall(header)
+        self.sock.sendall(payload)
+
+    def run_sender(self):
+        interval = 1.0 / self.args.fps if self.args.fps > 0 else 0.0
+        self.started = time.perf_counter()
+        deadline = self.started + self.args.duration
+
+        try:
+            sequence = 0
+            next_send = self.started
+            while sequence < self.args.frames or not self.args.frames:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+
+                # paced from the start, a slow send doesn't push every later frame back
+                wait = next_send - now
+                if wait > 0:
+                    time.sleep(wait)
+
+                if self.flow_control:
+                    if not self.wait_credit(sequence, deadline):
+                        break
+                    # the server may have asked for less
+                    next_send += max(interval, 1.0 / self.max_fps if self.max_fps > 0 else 0.0)
+                else:
+                    next_send += interval
+
+                self.send_frame(sequence, self.frame(sequence))
+                sequence += 1
+                self.sent = sequence
+        except OSError as e:
+            self.error = str(e)
+
+        self.finished = time.perf_counter()
+
+    def receive_control(self, magic):
+        message = recv_exact(self.sock, flow.FLOW_MESSAGE.size - len(magic))
+        if message is None:
+            return False
+
+        allowed, max_width, max_height, max_fps = flow.unpack(magic + message)
+        with self.credits:
+            self.control_messages += 1
+            self.allowed = max(self.allowed, allowed)
+            self.max_size = (max_width, max_height)
+            self.max_fps = max_fps
+            self.credits.notify()
+        return True
+
+    def run_receiver(self):
+        # detection replies and control messages, told apart by their magic
+        header_size = detections.RESULT_HEADER.size
+        row_size = detections.COLUMNS * 4
+
+        try:
+            while True:
+                magic = recv_exact(self.sock, 4)
+                if magic is None:
+                    break
+                if magic == flow.FLOW_MAGIC:
+                    if not self.receive_control(magic):
+                        break
+                    continue
+
+                header = recv_exact(self.sock, header_size - len(magic))
+                if header is None:
+                    break
+                header = magic + header
+                count = detections.RESULT_HEADER.unpack(header)[2]
+                body = recv_exact(self.sock, count * row_size)
+                if body is None:
+                    break
+
+                now = time.perf_counter()
+                sequence, dets, flags = detections.unpack(header + body)
+                with self.lock:
+                    sent_at = self.sent_at.pop(sequence, None)
+
+                self.received += 1
+                if flags & detections.RESULT_NOT_READY:
+                    self.not_ready += 1
+                elif sent_at is not None:
+                    self.latencies.append(now - sent_at)
+                    self.detections += len(dets)
+        except OSError:
+            pass
+
+        # a sender waiting for credits gives up
+        with self.credits:
+            self.closed = True
+            self.credits.notify()
+
+    def report(self):
+        elapsed = (self.finished or time.perf_counter()) - (self.started or 0)
+        report = {
+            'camera_id': self.camera_id,
+            'sent': self.sent,
+            'fps': round(self.sent / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+        if self.replies:
+            report.update(
+                received=self.received,
+                # frames the server dropped, they never get a reply
+                dropped=self.sent - self.received,
+                not_ready=self.not_ready,
+                detections=self.detections,
+                latency_ms=percentiles(self.latencies),
+            )
+        if self.flow_control:
+            report['flow_control'] = {
+                'control_messages': self.control_messages,
+                'credit_waits': self.credit_waits,
+                'credit_wait_s': round(self.credit_wait_time, 3),
+                'max_fps': round(self.max_fps, 2),
+                'max_size': '{}x{}'.format(*self.max_size),
+            }
+        if self.error:
+            report['error'] = self.error
+        return report
+
+
+# --encoding to the v3 encoding, None sends the jpgs with the v2 header
+ENCODINGS = {'jpeg': None, 'rgb24': ENCODING_RGB24, 'rgb24-lz4': ENCODING_RGB24_LZ4}
+
+
+def percentiles(latencies):
+    if not latencies:
+        return None
+
+    values = np.array(latencies) * 1000
+    return {
+        'p50': round(float(np.percentile(values, 50)), 2),
+        'p95': round(float(np.percentile(values, 95)), 2),
+        'p99': round(float(np.percentile(values, 99)), 2),
+        'max': round(float(values.max()), 2),
+        'mean': round(float(values.mean()), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="synthetic camera streams for load testing the server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5500)
+    parser.add_argument('--streams', type=int, default=1, help="concurrent camera connections")
+    parser.add_argument('--fps', type=float, default=15, help="target frames per second per stream, 0 sends as fast as possible")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of sending")
+    parser.add_argument('--frames', type=int, default=0, help="stop each stream after this many frames, 0 is no limit")
+    parser.add_argument('--source', help="jpg file, directory of jpg files or video to replay")
+    parser.add_argument('--max-frames', type=int, default=300, help="frames of the source kept in memory")
+    parser.add_argument('--width', type=int, default=1280, help="size of the synthetic frame without a source")
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--protocol', choices=['v2', 'v2-noreply', 'legacy'], default='v2',
+                        help="v2 asks for the detections and measures latency, "
+                             "v2-noreply and legacy (old CameraStreamer.cs builds) only send")
+    parser.add_argument('--encoding', choices=list(ENCODINGS), default='jpeg',
+                        help="rgb24 and rgb24-lz4 send the pixels with the v3 header, like a camera on the same machine")
+    parser.add_argument('--flow-control', action='store_true',
+                        help="only send frames the server gave credits for, at its max fps and size (see flow.py)")
+    parser.add_argument('--camera-id', type=int, default=0, help="camera id of the first stream")
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to wait for the last replies")
+    parser.add_argument('--output', help="write the json report to this file instead of stdout")
+    args = parser.parse_args()
+    if args.encoding != 'jpeg' and args.protocol == 'legacy':
+        parser.error("legacy clients only send jpg")
+    if args.flow_control and args.protocol == 'legacy':
+        parser.error("legacy clients can't ask for flow control")
+
+    frames = load_frames(args.source, args.max_frames, args.width, args.height)
+    if not frames:
+        sys.exit("no frames in {}".format(args.source))
+    if args.encoding != 'jpeg':
+        frames = raw_frames(frames, ENCODINGS[args.encoding])
+
+    streams = [CameraStream(args.camera_id + i, frames, args) for i in range(args.streams)]
+    for stream in streams:
+        stream.connect()
+
+    receivers = [Thread(target=stream.run_receiver, daemon=True) for stream in streams if stream.reads]
+    senders = [Thread(target=stream.run_sender) for stream in streams]
+    for thread in receivers + senders:
+        thread.start()
+
+    start = time.perf_counter()
+    for thread in senders:
+        thread.join()
+    sent_elapsed = time.perf_counter() - start
+
+    # replies of the last frames are still on their way
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline and any(stream.sent_at for stream in streams if stream.replies):
+        time.sleep(0.05)
+
+    for stream in streams:
+        stream.sock.close()
+    for thread in receivers:
+        thread.join(1.0)
+
+    reports = [stream.report() for stream in streams]
+    sent = sum(report['sent'] for report in reports)
+    summary = {
+        'host': args.host,
+        'port': args.port,
+        'protocol': args.protocol,
+        'streams': args.streams,
+        'target_fps': args.fps,
+        'encoding': args.encoding,
+        'flow_control': args.flow_control,
+        'frame_bytes': int(np.mean([len(frame if args.encoding == 'jpeg' else frame[0]) for frame in frames])),
+        'duration': round(sent_elapsed, 2),
+        'sent': sent,
+        'sent_fps': round(sent / sent_elapsed, 2),
+    }
+    if args.protocol == 'v2':
+        latencies = [latency for stream in streams for latency in stream.latencies]
+        summary.update(
+            received=sum(report['received'] for report in reports),
+            dropped=sum(report['dropped'] for report in reports),
+            not_ready=sum(report['not_ready'] for report in reports),
+            # frames that went through the detector per second, the server throughput
+            throughput_fps=round(len(latencies) / sent_elapsed, 2),
+            latency_ms=percentiles(latencies),
+        )
+    summary['per_stream'] = reports
+
+    report = json.dumps(summary, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
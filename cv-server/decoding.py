@@ -0,0 +1,162 @@
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import cv2
+import numpy as np
+
+from framing import ENCODING_JPEG, ENCODING_RGB24_LZ4
+
+# long side of the image the model runs on, YOLO letterboxes every frame to it
+INFERENCE_SIZE = 640
+
+# jpeg start of frame markers, baseline, extended, progressive and lossless
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# decoders that scale down while decoding, the DCT skips the detail that
+# would be thrown away by the letterbox anyway
+REDUCED_FLAGS = ((4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def jpeg_size(buffer):
+    # width and height from the jpeg headers without decoding, None when the
+    # buffer is not a jpeg
+    data = memoryview(buffer)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', data, offset + 5)
+            return width, height
+
+        # every other segment carries its length after the marker
+        offset += 2 + struct.unpack_from('>H', data, offset + 2)[0]
+
+    return None
+
+
+def load_lz4():
+    # optional, only cameras sending compressed raw frames need it (pip install lz4)
+    try:
+        import lz4.block
+    except ImportError:
+        return None
+    return lz4.block
+
+
+class DecodeStage:
+    # decodes the frames on a thread pool, imdecode releases the GIL so several
+    # frames decode at once while the socket readers keep reading. frames much
+    # bigger than the inference size are decoded at 1/2 or 1/4 resolution.
+    # submit() returns a Future with the image and the factor from the decoded
+    # image back to the size the camera sent, observe(seconds) is called with
+    # the time the decode took. raw frames (see framing.ENCODING_RGB24) skip
+    # the jpg entirely, they are only converted to BGR into a new array.
+    # reduce=False on submit() keeps the full resolution of one frame
+    def __init__(self, threads=2, target_size=INFERENCE_SIZE, reduce=True):
+        self.target_size = target_size
+        self.reduce = reduce
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="decode")
+        self.lz4 = load_lz4()
+
+        # counters of the summary, updated from every decode thread
+        self.lock = Lock()
+        self.decoded = 0
+        self.reduced = 0
+        self.raw = 0
+
+    def reduction(self, size, reduce=True):
+        # biggest reduction that still leaves the long side at the inference size
+        if self.reduce and reduce:
+            for factor, flag in REDUCED_FLAGS:
+                if max(size) // factor >= self.target_size:
+                    return factor, flag
+
+        return 1, cv2.IMREAD_COLOR
+
+    def flag(self, buffer, reduce=True):
+        size = jpeg_size(buffer)
+        if size is not None:
+            factor, flag = self.reduction(size, reduce)
+            if factor > 1:
+                return flag, size
+
+        return cv2.IMREAD_COLOR, None
+
+    def decode(self, buffer, observe=None, reduce=True):
+        start = time.perf_counter()
+        flag, size = self.flag(buffer, reduce)
+
+        # np.frombuffer does not copy
+        img = cv2.imdecode(np.frombuffer(buffer, np.uint8), flag)
+        if observe is not None:
+            observe(time.perf_counter() - start)
+
+        with self.lock:
+            self.decoded += 1
+            if img is not None and size is not None:
+                self.reduced += 1
+
+        if img is None or size is None:
+            return img, 1.0
+        return img, size[0] / img.shape[1]
+
+    def decode_raw(self, buffer, encoding, width, height, bottom_up, observe=None, reduce=True):
+        start = time.perf_counter()
+        if encoding == ENCODING_RGB24_LZ4:
+            try:
+                buffer = self.lz4.decompress(buffer, uncompressed_size=width * height * 3)
+            except self.lz4.LZ4BlockError:
+                buffer = b''
+            if len(buffer) != width * height * 3:
+                # corrupt, like a jpg imdecode can't read
+                return None, 1.0
+        rgb = np.frombuffer(buffer, np.uint8).reshape(height, width, 3)
+
+        factor, _ = self.reduction((width, height), reduce)
+        if factor > 1:
+            rgb = cv2.resize(rgb, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+
+        # at most two passes over the pixels, both writing into one new array
+        if bottom_up:
+            img = cv2.flip(rgb, 0)
+            cv2.cvtColor(img, cv2.COLOR_RGB2BGR, dst=img)
+        else:
+            img = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+        if observe is not None:
+            observe(time.perf_counter() - start)
+
+        with self.lock:
+            self.raw += 1
+        return img, width / img.shape[1]
+
+    def supports(self, encoding):
+        return encoding != ENCODING_RGB24_LZ4 or self.lz4 is not None
+
+    def submit(self, buffer, observe=None, encoding=ENCODING_JPEG, width=0, height=0, bottom_up=False, reduce=True):
+        # the buffer must stay untouched until the future is done
+        if encoding == ENCODING_JPEG:
+            return self.executor.submit(self.decode, buffer, observe, reduce)
+
+        if not self.supports(encoding):
+            raise ValueError("lz4 frames need the lz4 package, pip install lz4")
+        return self.executor.submit(self.decode_raw, buffer, encoding, width, height, bottom_up, observe, reduce)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def summary(self):
+        return "decoded: {} reduced: {} raw: {}".format(self.decoded, self.reduced, self.raw)
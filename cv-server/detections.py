@@ -0,0 +1,105 @@
+import json
+import struct
+
+import cv2
+import numpy as np
+
+# detections of one frame as a float32 array, one row per object:
+# +----+----+----+----+------------+-------+----------+
+# | x1 | y1 | x2 | y2 | confidence | class | track id |
+# +----+----+----+----+------------+-------+----------+
+# track id is -1 when the object is not tracked. small enough to send between
+# processes and to the cameras without dragging the ultralytics Results along
+COLUMNS = 7
+X1, Y1, X2, Y2, CONF, CLS, TRACK_ID = range(COLUMNS)
+
+# binary reply sent to the camera after each frame, little endian
+# +-------+----------+-------+-------+---------------------------+
+# | magic | sequence | count | flags | count rows of 7 float32   |
+# |  4s   |    I     |   H   |   H   | same columns as the array |
+# +-------+----------+-------+-------+---------------------------+
+RESULT_HEADER = struct.Struct('<4sIHH')
+RESULT_MAGIC = b'CVDT'
+
+# the model is still loading, the frame was not run through it
+RESULT_NOT_READY = 0x01
+
+
+def empty():
+    return np.zeros((0, COLUMNS), np.float32)
+
+
+def from_result(result):
+    # convert one ultralytics Results object
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return empty()
+
+    dets = np.full((len(boxes), COLUMNS), -1, np.float32)
+    dets[:, X1:Y2 + 1] = boxes.xyxy.cpu().numpy()
+    dets[:, CONF] = boxes.conf.cpu().numpy()
+    dets[:, CLS] = boxes.cls.cpu().numpy()
+    if boxes.id is not None:
+        dets[:, TRACK_ID] = boxes.id.cpu().numpy()
+    return dets
+
+
+def rescale(dets, scale):
+    # boxes of a frame decoded at a reduced size, in the coordinates of the sent image
+    if scale == 1.0:
+        return dets
+
+    scaled = dets.copy()
+    scaled[:, X1:Y2 + 1] *= scale
+    return scaled
+
+
+def pack(sequence, dets, flags=0):
+    rows = np.ascontiguousarray(dets, '<f4')
+    return RESULT_HEADER.pack(RESULT_MAGIC, sequence, len(rows), flags) + rows.tobytes()
+
+
+def unpack(data):
+    # returns the sequence, the detections array and the flags of a binary reply
+    magic, sequence, count, flags = RESULT_HEADER.unpack_from(data)
+    if magic != RESULT_MAGIC:
+        raise ValueError("invalid result header: {!r}".format(bytes(data[:RESULT_HEADER.size])))
+
+    dets = np.frombuffer(data, '<f4', count * COLUMNS, RESULT_HEADER.size)
+    return sequence, dets.reshape(count, COLUMNS), flags
+
+
+def to_json(camera_id, sequence, dets, names, ready=True):
+    # one json line per frame
+    return json.dumps({
+        'camera': camera_id,
+        'sequence': sequence,
+        'ready': ready,
+        'detections': [
+            {
+                'class': int(cls),
+                'name': names.get(int(cls), str(int(cls))),
+                'conf': round(float(conf), 3),
+                'box': [round(float(v), 1) for v in (x1, y1, x2, y2)],
+                'track_id': int(track_id),
+            }
+            for x1, y1, x2, y2, conf, cls, track_id in dets
+        ],
+    }, separators=(',', ':')) + '\n'
+
+
+def draw(img, dets, names):
+    # annotated copy of the frame, names maps class ids to labels
+    annotated = img.copy()
+    for x1, y1, x2, y2, conf, cls, track_id in dets:
+        cls = int(cls)
+        color = (int(cls * 47 % 255), int(cls * 97 % 255), int(cls * 157 % 255))
+
+        label = "{} {:.2f}".format(names.get(cls, cls), conf)
+        if track_id >= 0:
+            label = "id:{} {}".format(int(track_id), label)
+
+        cv2.rectangle(annotated, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
+        cv2.putText(annotated, label, (int(x1), max(int(y1) - 5, 10)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
+    return annotated
@@ -0,0 +1,197 @@
+import ast
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+import detections
+from detections import CLS, CONF, X1, X2, Y1, Y2
+
+# the detectors every stage of the server runs on. a detector has the class
+# names of its model and turns BGR images into detections arrays (see
+# detections.py), so the inference stage, the worker processes and the
+# tracking never touch the runtime underneath. the runtimes are imported when
+# a detector is created, not at import time. classes is a whitelist of class
+# names applied before nms, the other classes cost nothing past the model
+
+
+class Detector:
+    names = {}
+
+    def class_ids(self, classes):
+        # class names to the ids of this model, None keeps every class
+        if classes is None:
+            return None
+        ids = sorted(cls for cls, name in self.names.items() if name in set(classes))
+        if not ids:
+            raise ValueError("none of the classes {} is in the model".format(', '.join(classes)))
+        return ids
+
+    def detect_batch(self, imgs):
+        return [self.detect(img) for img in imgs]
+
+    def detect(self, img):
+        return self.detect_batch([img])[0]
+
+    def __call__(self, img):
+        # workers.InferencePool calls the detector with one image
+        return self.detect(img)
+
+
+class UltralyticsDetector(Detector):
+    # the PyTorch model through ultralytics, what the server always used
+    def __init__(self, weights='yolov8s.pt', imgsz=640, conf=0.25, iou=0.7, classes=None):
+        from ultralytics import YOLO
+
+        self.model = YOLO(weights)
+        self.names = self.model.names
+        self.options = dict(imgsz=imgsz, conf=conf, iou=iou, classes=self.class_ids(classes), verbose=False)
+
+    def detect_batch(self, imgs):
+        return [detections.from_result(result) for result in self.model.predict(imgs, **self.options)]
+
+
+class OnnxDetector(Detector):
+    # a model exported with `yolo export model=yolov8s.pt format=onnx` run by
+    # ONNX Runtime on the CPU, without torch. threads=0 lets the runtime pick.
+    # exports with dynamic=True are padded only up to a multiple of the stride
+    # like ultralytics does with the PyTorch model, static ones to the full square
+    def __init__(self, weights='yolov8s.onnx', threads=0, imgsz=640, conf=0.25, iou=0.7, classes=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(weights, options, providers=['CPUExecutionProvider'])
+        self.conf = conf
+        self.iou = iou
+
+        # ultralytics keeps the class names and the export options in the metadata
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadata.get('names', '{}'))
+        self.end2end = metadata.get('end2end') == 'True'
+        self.stride = int(metadata.get('stride', 32))
+        self.classes = self.class_ids(classes)
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # exports without dynamic=True only take one image per run and one size
+        self.batched = not isinstance(model_input.shape[0], int)
+        self.dynamic = not isinstance(model_input.shape[2], int)
+        self.imgsz = (imgsz, imgsz) if self.dynamic else (model_input.shape[2], model_input.shape[3])
+
+    def letterbox(self, img):
+        # resize keeping the aspect ratio and pad to the model input, like ultralytics does
+        height, width = self.imgsz
+        ratio = min(height / img.shape[0], width / img.shape[1])
+        resized_w, resized_h = round(img.shape[1] * ratio), round(img.shape[0] * ratio)
+        if self.dynamic:
+            height = -(-resized_h // self.stride) * self.stride
+            width = -(-resized_w // self.stride) * self.stride
+        pad_x, pad_y = (width - resized_w) / 2, (height - resized_h) / 2
+
+        resized = cv2.resize(img, (resized_w, resized_h), interpolation=cv2.INTER_LINEAR)
+        top, left = round(pad_y - 0.1), round(pad_x - 0.1)
+        padded = cv2.copyMakeBorder(resized, top, height - resized_h - top, left, width - resized_w - left,
+                                    cv2.BORDER_CONSTANT, value=(114, 114, 114))
+
+        # BGR HWC uint8 to RGB CHW float
+        blob = padded[:, :, ::-1].transpose(2, 0, 1).astype(np.float32) / 255.0
+        return blob, ratio, left, top
+
+    def postprocess(self, output, ratio, left, top, shape):
+        if self.end2end:
+            # rows are already x1, y1, x2, y2, confidence, class after nms
+            rows = output[output[:, 4] >= self.conf]
+            if self.classes is not None:
+                rows = rows[np.isin(rows[:, 5], self.classes)]
+            boxes, scores, classes = rows[:, :4], rows[:, 4], rows[:, 5]
+        else:
+            # (4 + classes, anchors), box as center and size
+            output = output.T
+            class_scores = output[:, 4:]
+            if self.classes is not None:
+                # only the whitelisted columns
+                class_scores = class_scores[:, self.classes]
+            classes = class_scores.argmax(1)
+            scores = class_scores[np.arange(len(classes)), classes]
+            if self.classes is not None:
+                classes = np.asarray(self.classes)[classes]
+
+            keep = scores >= self.conf
+            xywh, scores, classes = output[keep, :4], scores[keep], classes[keep]
+
+            keep = cv2.dnn.NMSBoxesBatched(
+                xywh_to_tlwh(xywh).tolist(), scores.tolist(), classes.tolist(), self.conf, self.iou)
+            keep = np.asarray(keep, np.int64).reshape(-1)
+            boxes, scores, classes = xywh_to_xyxy(xywh[keep]), scores[keep], classes[keep]
+
+        dets = np.full((len(boxes), detections.COLUMNS), -1, np.float32)
+        dets[:, [X1, X2]] = ((boxes[:, [0, 2]] - left) / ratio).clip(0, shape[1])
+        dets[:, [Y1, Y2]] = ((boxes[:, [1, 3]] - top) / ratio).clip(0, shape[0])
+        dets[:, CONF] = scores
+        dets[:, CLS] = classes
+        return dets
+
+    def detect_batch(self, imgs):
+        prepared = [self.letterbox(img) for img in imgs]
+
+        if self.batched and len({blob.shape for blob, *_ in prepared}) == 1:
+            outputs = self.session.run(None, {self.input_name: np.stack([blob for blob, *_ in prepared])})[0]
+        else:
+            outputs = [self.session.run(None, {self.input_name: blob[None]})[0][0] for blob, *_ in prepared]
+
+        return [self.postprocess(output, ratio, left, top, img.shape)
+                for output, (_, ratio, left, top), img in zip(outputs, prepared, imgs)]
+
+
+def xywh_to_tlwh(xywh):
+    tlwh = xywh.copy()
+    tlwh[:, :2] -= tlwh[:, 2:] / 2
+    return tlwh
+
+
+def xywh_to_xyxy(xywh):
+    xyxy = xywh_to_tlwh(xywh)
+    xyxy[:, 2:] += xyxy[:, :2]
+    return xyxy
+
+
+class FakeDetector(Detector):
+    # no model at all: the same image always gets the same boxes, derived from
+    # a checksum of its pixels. cost simulates the inference time in seconds,
+    # to benchmark the pipeline and run the server without the weights
+    def __init__(self, boxes=3, cost=0.0, seed=0, classes=None):
+        self.boxes = boxes
+        self.cost = cost
+        self.seed = seed
+        self.names = {0: 'person', 1: 'bicycle', 2: 'car', 3: 'motorcycle'}
+        self.classes = self.class_ids(classes)
+
+    def detect(self, img):
+        if self.cost:
+            time.sleep(self.cost)
+
+        height, width = img.shape[:2]
+        checksum = zlib.adler32(np.ascontiguousarray(img[::16, ::16]).data)
+        rng = np.random.default_rng([self.seed, checksum])
+
+        dets = np.full((self.boxes, detections.COLUMNS), -1, np.float32)
+        corners = rng.uniform(0, 1, (self.boxes, 2)) * (width * 0.8, height * 0.8)
+        sizes = rng.uniform(0.05, 0.2, (self.boxes, 2)) * (width, height)
+        dets[:, [X1, Y1]] = corners
+        dets[:, [X2, Y2]] = corners + sizes
+        dets[:, CONF] = rng.uniform(0.3, 1.0, self.boxes)
+        dets[:, CLS] = rng.integers(0, len(self.names), self.boxes)
+        if self.classes is not None:
+            dets = dets[np.isin(dets[:, CLS], self.classes)]
+        return dets
+
+
+BACKENDS = {'ultralytics': UltralyticsDetector, 'onnx': OnnxDetector, 'fake': FakeDetector}
+
+
+def make_detector(backend='ultralytics', **options):
+    # options are the keyword arguments of the backend. picklable through
+    # functools.partial, the worker processes build their own detector with it
+    return BACKENDS[backend](**options)
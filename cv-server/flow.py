@@ -0,0 +1,114 @@
+import json
+import struct
+import time
+
+from framing import FLAG_FLOW_CONTROL, FLAG_RESULTS_JSON
+
+# credit based flow control between a camera and the server, on the same
+# socket as the detection replies. a camera asks for it with
+# framing.FLAG_FLOW_CONTROL in its frame headers. it sends one frame and from
+# then on only frames whose sequence is not above the last `allowed` it got.
+# every time the server takes a frame out of the camera's slot it allows the
+# sequence of that frame plus the size of the slot, so a camera that follows
+# it never sends a frame the drop policy would throw away (except with
+# --drop-policy nth). credits are sequences rather than a count so frames the
+# slot dropped anyway never leave the camera waiting for credits
+#
+# control message, little endian, sent before the reply of every frame taken
+# +-------+---------+-----------+------------+---------+
+# | magic | allowed | max width | max height | max fps |
+# |  4s   |    I    |     H     |     H      |    f    |
+# +-------+---------+-----------+------------+---------+
+# max width and height are 0 when any size is fine, the server asks for a
+# smaller size when the frames it gets are decoded at a reduced resolution
+# anyway (see decoding.DecodeStage). max fps is what the server measured it
+# can process for this camera, 0 before it knows. cameras that asked for json
+# replies get the same fields as a json line instead
+FLOW_MESSAGE = struct.Struct('<4sIHHf')
+FLOW_MAGIC = b'CVFC'
+
+
+def unpack(data):
+    # returns allowed, max width, max height and max fps of a control message
+    magic, allowed, max_width, max_height, max_fps = FLOW_MESSAGE.unpack_from(data)
+    if magic != FLOW_MAGIC:
+        raise ValueError("invalid control message: {!r}".format(bytes(data[:FLOW_MESSAGE.size])))
+
+    return allowed, max_width, max_height, max_fps
+
+
+class FlowControl:
+    # credits of one connection. received() is called by the socket reader for
+    # every frame, taken() by the consumer for every frame it takes from the
+    # slot and returns the control message to send right away, None when the
+    # camera did not ask for flow control. waited is how long the consumer was
+    # idle waiting for that frame, the rest of the time since the previous
+    # frame was spent processing it. decoded() is called once the image of
+    # the frame is known
+    def __init__(self, window=1, rate_interval=2.0):
+        self.window = window
+        self.rate_interval = rate_interval
+
+        self.enabled = False
+        self.allowed = None
+        self.overruns = 0
+        self.messages = 0
+
+        self.max_size = (0, 0)
+        self.max_fps = 0.0
+
+        self.last_taken = None
+        self.busy = 0.0
+        self.busy_frames = 0
+        self.rate_start = time.perf_counter()
+
+    def received(self, frame):
+        if not frame.flags & FLAG_FLOW_CONTROL:
+            return
+
+        if self.allowed is None:
+            # the first frame needs no credit
+            self.enabled = True
+            self.allowed = frame.sequence
+        elif frame.sequence > self.allowed:
+            self.overruns += 1
+
+    def decoded(self, frame, img):
+        if img is not None and frame.scale > 1.0:
+            # the extra pixels are thrown away while decoding, the camera can
+            # send the decoded size and skip encoding them
+            self.max_size = (img.shape[1], img.shape[0])
+
+    def taken(self, frame, waited=0.0):
+        now = time.perf_counter()
+        if self.last_taken is not None:
+            self.busy += max(0.0, now - self.last_taken - waited)
+            self.busy_frames += 1
+        self.last_taken = now
+
+        if not frame.flags & FLAG_FLOW_CONTROL:
+            return None
+
+        if now - self.rate_start >= self.rate_interval and self.busy > 0:
+            self.max_fps = self.busy_frames / self.busy
+            self.busy = 0.0
+            self.busy_frames = 0
+            self.rate_start = now
+
+        allowed = self.allowed = max(self.allowed or 0, frame.sequence + self.window)
+        self.messages += 1
+
+        if frame.flags & FLAG_RESULTS_JSON:
+            return (json.dumps({
+                'camera': frame.camera_id,
+                'flow': {'allowed': allowed, 'max_width': self.max_size[0], 'max_height': self.max_size[1],
+                         'max_fps': round(self.max_fps, 2)},
+            }) + '\n').encode()
+        return FLOW_MESSAGE.pack(FLOW_MAGIC, allowed, self.max_size[0], self.max_size[1], self.max_fps)
+
+    def summary(self):
+        if not self.enabled:
+            return "flow control: off"
+        return "flow control: allowed: {} overruns: {} messages: {} max size: {}x{} max fps: {:.1f}".format(
+            self.allowed, self.overruns, self.messages, self.max_size[0], self.max_size[1], self.max_fps)
+
@@ -0,0 +1,287 @@
+import struct
+import time
+from collections import namedtuple
+
+# the legacy header is the frame length written as ascii digits with no
+# delimiter, CameraStreamer.cs never sends more than 7 digits
+LEGACY_HEADER_SIZE = 7
+
+# protocol v2 header, little endian so Unity can write it with BitConverter
+# +-------+---------+-------+-----------+--------+----------+--------------+
+# | magic | version | flags | camera id | length | sequence | timestamp us |
+# |  4s   |    B    |   B   |     H     |   I    |    I     |      Q       |
+# +-------+---------+-------+-----------+--------+----------+--------------+
+# the magic never starts with a digit, so it can't be confused with a legacy
+# header and the protocol can be detected from the first bytes of a connection
+HEADER_V2 = struct.Struct('<4sBBHIIQ')
+MAGIC = b'CVFR'
+VERSION = 2
+
+# protocol v3 is the v2 header followed by the format of the payload, for
+# cameras on the same machine that send the pixels instead of a jpg
+# +-----------+----------+-------+--------+----------+
+# | v2 header | encoding |       | width  |  height  |
+# | 24 bytes  |    B     |  1x   |   H    |  H  2x   |
+# +-----------+----------+-------+--------+----------+
+# a camera picks it per connection, every frame it sends carries the extension
+HEADER_V3_EXTENSION = struct.Struct('<BxHH2x')
+VERSION_RAW = 3
+
+# encodings of the v3 payload. rgb24 is width * height * 3 bytes, lz4 is that
+# compressed as one lz4 block (LZ4Codec.Encode in C#, lz4.block.compress in python)
+ENCODING_JPEG = 0
+ENCODING_RGB24 = 1
+ENCODING_RGB24_LZ4 = 2
+ENCODINGS = (ENCODING_JPEG, ENCODING_RGB24, ENCODING_RGB24_LZ4)
+
+# flags of the v2 header, a client sets them to ask for the detections of its
+# frames on the same connection (see detections.pack and detections.to_json).
+# raw frames with FLAG_BOTTOM_UP start with the bottom row, the order of
+# Texture2D.GetRawTextureData(). with FLAG_FLOW_CONTROL the camera follows the
+# credits the server sends on the same connection, see flow.py
+FLAG_RESULTS_BINARY = 0x01
+FLAG_RESULTS_JSON = 0x02
+FLAG_BOTTOM_UP = 0x04
+FLAG_FLOW_CONTROL = 0x08
+
+# biggest payload a header may announce, a 4k rgb24 frame with room to
+# spare. the length is a 32 bit field, without a bound one corrupt header
+# would make the server allocate up to 4 GiB for its connection
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# starting size of the per connection buffer, it grows when a bigger frame arrives
+INITIAL_BUFFER_SIZE = 512 * 1024
+
+# timestamp is the capture time in seconds since the epoch, None for legacy
+# clients. payload is a bytes-like object, when it is a memoryview over a
+# receive buffer it is only valid until the next frame is received. scale
+# goes from the decoded image back to the size the camera sent, see decoding.py.
+# width and height are only known for raw encodings, jpgs carry their own size
+Frame = namedtuple('Frame', ['camera_id', 'sequence', 'timestamp', 'payload', 'flags', 'scale',
+                             'encoding', 'width', 'height'],
+                   defaults=(0, 1.0, ENCODING_JPEG, 0, 0))
+
+
+def recv_exact_into(sock, view, trace=None):
+    # fill the whole memoryview straight from the socket, without building
+    # intermediate byte strings. returns False if the client disconnected.
+    # trace(n, received, size) is called for every fragment, for debugging
+    size = len(view)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            return False
+        received += n
+        if trace is not None:
+            trace(n, received, size)
+    return True
+
+
+def split_legacy_header(header):
+    # the digits are followed directly by the jpeg bytes (0xFF 0xD8 ...)
+    # so the first non digit byte is where the image starts
+    digits = 0
+    while digits < len(header) and 48 <= header[digits] <= 57:
+        digits += 1
+
+    if digits == 0:
+        raise ValueError("invalid frame header: {!r}".format(bytes(header)))
+
+    return int(header[:digits]), digits
+
+
+def unpack_header(header):
+    # returns camera id, payload length, sequence, timestamp in seconds, flags
+    # and the version, v3 frames are followed by HEADER_V3_EXTENSION
+    magic, version, flags, camera_id, data_len, sequence, timestamp = HEADER_V2.unpack_from(header)
+    if magic != MAGIC or version not in (VERSION, VERSION_RAW):
+        raise ValueError("invalid frame header: {!r}".format(bytes(header)))
+    if data_len > MAX_FRAME_SIZE:
+        raise ValueError("frame length {} is bigger than {}".format(data_len, MAX_FRAME_SIZE))
+
+    return camera_id, data_len, sequence, timestamp / 1e6, flags, version
+
+
+def unpack_extension(extension, data_len):
+    # returns encoding, width and height of a v3 frame
+    encoding, width, height = HEADER_V3_EXTENSION.unpack_from(extension)
+    if encoding not in ENCODINGS:
+        raise ValueError("unknown frame encoding: {}".format(encoding))
+    if encoding == ENCODING_RGB24 and data_len != width * height * 3:
+        raise ValueError("rgb24 frame of {}x{} with {} bytes".format(width, height, data_len))
+
+    return encoding, width, height
+
+
+def pack_header(camera_id, sequence, length, timestamp=None, flags=0, encoding=None, width=0, height=0):
+    # used by python clients, CameraStreamer.cs builds the same bytes. with
+    # an encoding the header is v3
+    if timestamp is None:
+        timestamp = time.time()
+    if encoding is None:
+        return HEADER_V2.pack(MAGIC, VERSION, flags, camera_id, length, sequence, int(timestamp * 1e6))
+
+    return (HEADER_V2.pack(MAGIC, VERSION_RAW, flags, camera_id, length, sequence, int(timestamp * 1e6))
+            + HEADER_V3_EXTENSION.pack(encoding, width, height))
+
+
+class FrameReceiver:
+    # header_time and payload_time are the seconds the last frame took to
+    # parse its header and to receive its payload once the header was parsed.
+    # trace is passed to recv_exact_into
+    def __init__(self, sock, camera_id=None, capacity=INITIAL_BUFFER_SIZE, trace=None):
+        self.sock = sock
+        self.trace = trace
+
+        # camera id given to frames from legacy clients, v2 frames carry their own
+        self.camera_id = camera_id
+
+        # 1 or 2, detected from the first bytes of the connection
+        self.protocol = None
+        self.sequence = 0
+
+        # the buffer frames are received into, reused for every frame unless
+        # it is lent out, see lend()
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        # buffers lent out with the future that gives them back
+        self.lent = []
+
+        self.header = bytearray(HEADER_V2.size + HEADER_V3_EXTENSION.size)
+        self.header_view = memoryview(self.header)
+
+        self.header_time = 0.0
+        self.payload_time = 0.0
+
+    def reserve(self, size):
+        if size <= len(self.buffer):
+            return
+
+        # views handed out before keep the old buffer alive, so it is safe
+        # to swap it for a bigger one
+        self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+        self.view = memoryview(self.buffer)
+
+    def lend(self, future):
+        # the payload of the last frame stays untouched until future is done,
+        # the next frames are received into another buffer. a buffer whose
+        # future is done is taken back, so there are only as many buffers
+        # as frames in flight and none of them is copied
+        self.lent.append((self.buffer, future))
+        for i, (buffer, pending) in enumerate(self.lent):
+            if pending.done():
+                del self.lent[i]
+                break
+        else:
+            buffer = bytearray(len(self.buffer))
+
+        self.buffer = buffer
+        self.view = memoryview(self.buffer)
+
+    def detect_protocol(self):
+        # legacy clients start with the ascii length, v2 clients with the magic
+        if not recv_exact_into(self.sock, self.header_view[:len(MAGIC)], self.trace):
+            return False
+
+        self.protocol = VERSION if self.header[:len(MAGIC)] == MAGIC else 1
+        return True
+
+    def receive(self):
+        # returns the next Frame or None when the client disconnects
+        received = 0
+        if self.protocol is None:
+            if not self.detect_protocol():
+                return None
+            received = len(MAGIC)
+
+        if self.protocol == VERSION:
+            return self.receive_v2(received)
+        return self.receive_legacy(received)
+
+    def receive_v2(self, received):
+        if not recv_exact_into(self.sock, self.header_view[received:HEADER_V2.size], self.trace):
+            return None
+
+        start = time.perf_counter()
+        camera_id, data_len, sequence, timestamp, flags, version = unpack_header(self.header)
+
+        encoding, width, height = ENCODING_JPEG, 0, 0
+        if version == VERSION_RAW:
+            extension = self.header_view[HEADER_V2.size:]
+            if not recv_exact_into(self.sock, extension, self.trace):
+                return None
+            encoding, width, height = unpack_extension(extension, data_len)
+        parsed = time.perf_counter()
+
+        self.reserve(data_len)
+        if not recv_exact_into(self.sock, self.view[:data_len], self.trace):
+            return None
+
+        self.header_time = parsed - start
+        self.payload_time = time.perf_counter() - parsed
+
+        return Frame(camera_id, sequence, timestamp, self.view[:data_len], flags,
+                     encoding=encoding, width=width, height=height)
+
+    def receive_legacy(self, received):
+        if not recv_exact_into(self.sock, self.header_view[received:LEGACY_HEADER_SIZE], self.trace):
+            return None
+
+        start = time.perf_counter()
+        data_len, digits = split_legacy_header(self.header[:LEGACY_HEADER_SIZE])
+        parsed = time.perf_counter()
+
+        # the bytes after the digits already belong to the image
+        initial = LEGACY_HEADER_SIZE - digits
+        if data_len < initial:
+            raise ValueError("frame length {} is smaller than the header".format(data_len))
+
+        self.reserve(data_len)
+        self.view[:initial] = self.header_view[digits:LEGACY_HEADER_SIZE]
+
+        if not recv_exact_into(self.sock, self.view[initial:data_len], self.trace):
+            return None
+
+        self.header_time = parsed - start
+        self.payload_time = time.perf_counter() - parsed
+
+        # legacy clients don't number their frames, count them here
+        self.sequence += 1
+        return Frame(self.camera_id, self.sequence, None, self.view[:data_len])
+
+
+class StreamStats:
+    # frames lost before reaching the server (gaps in the sequence numbers)
+    # and capture to detection latency of one camera
+    def __init__(self):
+        self.frames = 0
+        self.lost = 0
+        self.last_sequence = None
+
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def update(self, frame):
+        # called when a frame arrives
+        self.frames += 1
+
+        if self.last_sequence is not None and frame.sequence > self.last_sequence + 1:
+            self.lost += frame.sequence - self.last_sequence - 1
+        self.last_sequence = frame.sequence
+
+    def update_latency(self, frame, now=None):
+        # called when the detections of a frame are ready
+        if frame.timestamp is None:
+            return
+
+        latency = (now if now is not None else time.time()) - frame.timestamp
+        self.latency_count += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def summary(self):
+        mean = self.latency_total / self.latency_count if self.latency_count else 0.0
+        return "frames: {} lost: {} latency avg: {:.1f} ms max: {:.1f} ms".format(
+            self.frames, self.lost, mean * 1000, self.latency_max * 1000)
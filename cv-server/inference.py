@@ -0,0 +1,239 @@
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
+from threading import Condition, Lock, Thread
+
+
+def resolved(result):
+    # a Future that is already done, for frames that skip the model
+    future = Future()
+    future.set_running_or_notify_cancel()
+    future.set_result(result)
+    return future
+
+
+def chain(future, finish, executor=None):
+    # a Future with finish(result) once future is done, how the stages in
+    # front of the detector build their result. None (a newer frame of the
+    # camera replaced this one), cancellation and errors are passed through
+    # without calling finish, an error raised by finish fails the result.
+    # finish may return a Future, the result follows it. with an executor
+    # finish runs there instead of on the thread that completed future
+    result = Future()
+    result.set_running_or_notify_cancel()
+
+    def settle(future):
+        if future.cancelled():
+            # result is already running, it can't be cancelled itself
+            result.set_exception(CancelledError())
+            return
+
+        error = future.exception()
+        if error is not None:
+            result.set_exception(error)
+            return
+        result.set_result(future.result())
+
+    def run(value):
+        try:
+            value = finish(value)
+        except Exception as e:
+            result.set_exception(e)
+            return
+
+        if isinstance(value, Future):
+            value.add_done_callback(settle)
+        else:
+            result.set_result(value)
+
+    def done(future):
+        if future.cancelled() or future.exception() is not None or future.result() is None:
+            settle(future)
+        elif executor is None:
+            run(future.result())
+        else:
+            try:
+                executor.submit(run, future.result())
+            except RuntimeError as e:
+                # the executor is shut down
+                result.set_exception(e)
+
+    future.add_done_callback(done)
+    return result
+
+
+def gather(futures):
+    # a Future with the list of results of futures, in order. None when one
+    # of them is None, failed as soon as one of them fails
+    result = Future()
+    result.set_running_or_notify_cancel()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def done(i, future):
+        with lock:
+            if result.done():
+                return
+
+            if future.cancelled():
+                result.set_exception(CancelledError())
+                return
+
+            error = future.exception()
+            if error is not None:
+                result.set_exception(error)
+                return
+
+            results[i] = future.result()
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+
+        result.set_result(None if any(value is None for value in results) else results)
+
+    if not futures:
+        result.set_result(results)
+    for i, future in enumerate(futures):
+        future.add_done_callback(lambda future, i=i: done(i, future))
+    return result
+
+
+class PendingFrame:
+    def __init__(self, img):
+        self.img = img
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+
+class BatchScheduler:
+    # central inference stage shared by every camera. it keeps the newest frame
+    # of each camera and runs them through the model in one forward pass once
+    # batch_size frames are waiting or the oldest one waited max_wait seconds
+    def __init__(self, detect_batch, batch_size=1, max_wait=0.01, report_interval=10.0):
+        # detect_batch receives a list of images and returns one result per image
+        self.detect_batch = detect_batch
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.report_interval = report_interval
+
+        self.logger = logging.getLogger("batch_scheduler")
+        self.condition = Condition()
+        self.pending = OrderedDict()
+        self.running = False
+        self.thread = None
+
+        # counters for the periodic report
+        self.frames = 0
+        self.batches = 0
+        self.replaced = 0
+        self.inference_time = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.run, name="batch_scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        # nobody is going to run what is left
+        for item in self.pending.values():
+            item.future.cancel()
+        self.pending.clear()
+
+    def submit(self, camera_id, img):
+        # returns a Future with the result for this frame, or None if a newer
+        # frame of the same camera replaced it before it was processed
+        item = PendingFrame(img)
+
+        with self.condition:
+            older = self.pending.pop(camera_id, None)
+            if older is not None:
+                self.replaced += 1
+                if older.future.set_running_or_notify_cancel():
+                    older.future.set_result(None)
+
+            self.pending[camera_id] = item
+            self.condition.notify()
+
+        return item.future
+
+    def next_batch(self):
+        with self.condition:
+            while self.running and not self.pending:
+                self.condition.wait()
+
+            if not self.running:
+                return None
+
+            # wait for more cameras until the batch is full or the oldest
+            # frame has waited long enough
+            deadline = next(iter(self.pending.values())).arrival + self.max_wait
+            while self.running and len(self.pending) < self.batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = []
+            while self.pending and len(batch) < self.batch_size:
+                item = self.pending.popitem(last=False)[1]
+
+                # skip frames whose stream stopped waiting for them
+                if item.future.set_running_or_notify_cancel():
+                    batch.append(item)
+            return batch
+
+    def run(self):
+        last_report = time.perf_counter()
+        report_frames = 0
+        report_batches = 0
+
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                results = self.detect_batch([item.img for item in batch])
+            except Exception as e:
+                self.logger.exception("inference failed")
+                for item in batch:
+                    item.future.set_exception(e)
+                continue
+            self.inference_time += time.perf_counter() - start
+
+            # route every result back to the stream that sent the frame
+            for item, result in zip(batch, results):
+                item.future.set_result(result)
+
+            self.frames += len(batch)
+            self.batches += 1
+
+            now = time.perf_counter()
+            if now - last_report >= self.report_interval:
+                frames = self.frames - report_frames
+                batches = self.batches - report_batches
+                self.logger.info(self.summary(frames, batches, now - last_report, self.inference_time))
+
+                last_report = now
+                report_frames = self.frames
+                report_batches = self.batches
+                self.inference_time = 0.0
+
+    def summary(self, frames, batches, elapsed, inference_time):
+        occupancy = frames / batches if batches else 0.0
+        batch_ms = 1000 * inference_time / batches if batches else 0.0
+        return "inference: {:.1f} frames/s {:.1f} batches/s {:.1f} ms/batch occupancy: {:.2f}/{} ({:.0f}%) replaced: {}".format(
+            frames / elapsed, batches / elapsed, batch_ms, occupancy, self.batch_size,
+            100 * occupancy / self.batch_size, self.replaced)
@@ -0,0 +1,240 @@
+import logging
+import math
+import time
+from threading import Lock
+
+import cv2
+import numpy as np
+
+from detections import X1, X2, Y1, Y2
+from inference import chain, resolved
+
+# width of the grayscale copy the boxes are followed on
+FLOW_WIDTH = 320
+
+# points followed inside every box, a GRID x GRID grid like the median flow tracker
+GRID = 5
+
+# forward-backward error in pixels of the small frame above which a point is not trusted
+MAX_FB_ERROR = 1.0
+
+# a box needs this many trusted points to be moved, otherwise it is dropped
+# and the tracker keeps its track alive on its own prediction
+MIN_POINTS = 4
+
+LK_PARAMS = dict(winSize=(15, 15), maxLevel=2,
+                 criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+
+class CameraKeyframes:
+    def __init__(self, every):
+        # small gray frame the detections in dets belong to
+        self.previous = None
+        self.dets = None
+        self.since_detect = 0
+        self.every = every
+        self.force = False
+
+        # moving averages: box motion per frame relative to the box size,
+        # detector latency and time between frames, in seconds
+        self.motion = None
+        self.detect_time = None
+        self.frame_interval = None
+        self.last_frame = None
+
+        self.frames = 0
+        self.detected = 0
+        self.propagated = 0
+        self.scene_changes = 0
+        self.lost = 0
+
+
+class KeyframeTracker:
+    # runs the detector on keyframes only and moves the boxes of the last
+    # keyframe along with the image in between, with sparse optical flow on a
+    # small gray copy of the frames. the propagated boxes keep their class and
+    # confidence and go to the same per camera tracker as detected ones, so
+    # the tracks and their ids continue through the frames without detection.
+    # a camera runs the detector at least every `every` frames, as soon as
+    # the scene changes or too many boxes are lost, and more often than that
+    # when its boxes move fast: the interval is sized so the boxes drift at
+    # most max_drift of their size before the next detection. it never goes
+    # below what the detector latency allows at the camera's frame rate
+    def __init__(self, every=8, max_drift=0.1, scene_change=25, max_lost=0.5, report_interval=10.0):
+        self.max_every = every
+        self.max_drift = max_drift
+        self.scene_change = scene_change
+        self.max_lost = max_lost
+        self.report_interval = report_interval
+
+        self.logger = logging.getLogger("keyframes")
+        self.cameras = {}
+        self.lock = Lock()
+        self.last_report = time.perf_counter()
+
+    def get(self, camera_id):
+        with self.lock:
+            camera = self.cameras.get(camera_id)
+            if camera is None:
+                camera = self.cameras[camera_id] = CameraKeyframes(self.max_every)
+            return camera
+
+    def reset(self, camera_id):
+        with self.lock:
+            camera = self.cameras.pop(camera_id, None)
+        if camera is not None and camera.frames:
+            self.logger.info("camera {} {}".format(camera_id, self.summary([camera])))
+
+    def downsample(self, img):
+        height = max(1, img.shape[0] * FLOW_WIDTH // img.shape[1])
+        small = cv2.resize(img, (FLOW_WIDTH, height), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def submit(self, camera_id, img, submit_frame):
+        # same interface as the inference stage, submit_frame(camera_id, img)
+        # is called only for keyframes
+        camera = self.get(camera_id)
+        camera.frames += 1
+        self.report()
+
+        now = time.perf_counter()
+        if camera.last_frame is not None:
+            camera.frame_interval = average(camera.frame_interval, now - camera.last_frame)
+        camera.last_frame = now
+
+        small = self.downsample(img)
+        keyframe = (camera.dets is None or camera.force or camera.since_detect + 1 >= camera.every
+                    or small.shape != camera.previous.shape)
+
+        if not keyframe and cv2.absdiff(small, camera.previous).mean() > self.scene_change:
+            camera.scene_changes += 1
+            keyframe = True
+
+        if keyframe:
+            camera.force = False
+            camera.detected += 1
+            return self.chain(submit_frame(camera_id, img), camera, small, now)
+
+        dets = self.propagate(camera, small, img.shape)
+        camera.previous = small
+        camera.dets = dets
+        camera.since_detect += 1
+        camera.propagated += 1
+        return resolved(dets)
+
+    def propagate(self, camera, small, shape):
+        # the boxes of the previous frame moved by the median flow of a grid
+        # of points inside each, scaled by the median change of the distances
+        # between those points
+        dets = camera.dets
+        if not len(dets):
+            return dets
+
+        scale = shape[1] / small.shape[1]
+        boxes = dets[:, [X1, Y1, X2, Y2]] / scale
+        steps = (np.arange(GRID) + 0.5) / GRID
+        gx, gy = np.meshgrid(steps, steps)
+        width = (boxes[:, 2] - boxes[:, 0])[:, None]
+        height = (boxes[:, 3] - boxes[:, 1])[:, None]
+        points = np.stack([boxes[:, 0:1] + gx.ravel() * width, boxes[:, 1:2] + gy.ravel() * height], axis=2)
+        points = points.reshape(-1, 1, 2).astype(np.float32)
+
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(camera.previous, small, points, None, **LK_PARAMS)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(small, camera.previous, moved, None, **LK_PARAMS)
+        error = np.linalg.norm((back - points).reshape(-1, 2), axis=1)
+        good = ((status.ravel() == 1) & (back_status.ravel() == 1) & (error < MAX_FB_ERROR)).reshape(len(dets), -1)
+
+        points = points.reshape(len(dets), -1, 2)
+        moved = moved.reshape(len(dets), -1, 2)
+
+        propagated = dets.copy()
+        keep = np.zeros(len(dets), bool)
+        motion = []
+        for i in range(len(dets)):
+            if good[i].sum() < MIN_POINTS:
+                continue
+
+            before, after = points[i][good[i]], moved[i][good[i]]
+            dx, dy = np.median(after - before, axis=0)
+            pairs = np.triu_indices(len(before), 1)
+            distances = np.linalg.norm(before[pairs[0]] - before[pairs[1]], axis=1)
+            valid = distances > 1e-3
+            ratio = 1.0
+            if valid.any():
+                ratio = float(np.median(np.linalg.norm(after[pairs[0]] - after[pairs[1]], axis=1)[valid] / distances[valid]))
+
+            cx = (boxes[i, 0] + boxes[i, 2]) / 2 + dx
+            cy = (boxes[i, 1] + boxes[i, 3]) / 2 + dy
+            half_w = (boxes[i, 2] - boxes[i, 0]) * ratio / 2
+            half_h = (boxes[i, 3] - boxes[i, 1]) * ratio / 2
+            propagated[i, [X1, Y1, X2, Y2]] = np.array([cx - half_w, cy - half_h, cx + half_w, cy + half_h]) * scale
+            keep[i] = True
+
+            size = math.hypot(boxes[i, 2] - boxes[i, 0], boxes[i, 3] - boxes[i, 1])
+            if size > 0:
+                motion.append(math.hypot(dx, dy) / size + abs(ratio - 1.0))
+
+        propagated[:, [X1, X2]] = propagated[:, [X1, X2]].clip(0, shape[1])
+        propagated[:, [Y1, Y2]] = propagated[:, [Y1, Y2]].clip(0, shape[0])
+
+        lost = len(dets) - keep.sum()
+        camera.lost += lost
+        if lost > self.max_lost * len(dets):
+            # the boxes can't be followed anymore, detect on the next frame
+            camera.force = True
+
+        if motion:
+            camera.motion = average(camera.motion, float(np.median(motion)))
+            camera.every = self.interval(camera)
+        return propagated[keep]
+
+    def interval(self, camera):
+        # frames until the next detection
+        every = self.max_every
+        if camera.motion:
+            every = min(every, int(self.max_drift / camera.motion))
+
+        # a detector slower than the frames arrive can't run on every one
+        if camera.detect_time is not None and camera.frame_interval:
+            every = max(every, math.ceil(camera.detect_time / camera.frame_interval))
+        return max(1, min(self.max_every, every))
+
+    def chain(self, future, camera, small, started):
+        # detections of the keyframe once the detector is done, they are the
+        # ones the next frames move along
+        def update(dets):
+            camera.previous = small
+            camera.dets = dets
+            camera.since_detect = 0
+            camera.detect_time = average(camera.detect_time, time.perf_counter() - started)
+            camera.every = self.interval(camera)
+            return dets
+
+        return chain(future, update)
+
+    def report(self):
+        now = time.perf_counter()
+        if now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+
+        with self.lock:
+            cameras = list(self.cameras.values())
+        self.logger.info(self.summary(cameras))
+
+    def summary(self, cameras):
+        frames = sum(camera.frames for camera in cameras)
+        detected = sum(camera.detected for camera in cameras)
+        scene_changes = sum(camera.scene_changes for camera in cameras)
+        lost = sum(camera.lost for camera in cameras)
+        every = np.mean([camera.every for camera in cameras]) if cameras else 0.0
+        ratio = detected / frames if frames else 0.0
+        return "keyframes: frames: {} detected: {} ({:.0f}%) scene changes: {} boxes lost: {} every: {:.1f}".format(
+            frames, detected, 100 * ratio, scene_changes, lost, every)
+
+
+def average(current, value, weight=0.2):
+    # exponential moving average, the first value as is
+    if current is None:
+        return value
+    return current + weight * (value - current)
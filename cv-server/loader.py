@@ -0,0 +1,67 @@
+import logging
+import time
+from threading import Event, Thread
+
+import numpy as np
+
+# size of the warm-up frames, what CameraStreamer.cs sends at 720p
+DEFAULT_WARMUP_SHAPE = (720, 1280, 3)
+
+
+def warm_up(detect_batch, frames=2, shape=DEFAULT_WARMUP_SHAPE, batch_size=1):
+    # the first passes through a model allocate and pick kernels, run them on
+    # gray frames so the first camera frame gets the steady state latency
+    imgs = [np.full(shape, 114, np.uint8)] * batch_size
+    for _ in range(frames):
+        detect_batch(imgs)
+
+
+def warmed_up_detector(make_detector, frames=2, shape=DEFAULT_WARMUP_SHAPE):
+    # for the worker processes, they build and warm up their own detector
+    detector = make_detector()
+    warm_up(detector.detect_batch, frames, shape)
+    return detector
+
+
+class ModelLoader:
+    # builds the detector on a background thread so the listener binds right
+    # away, the server doesn't take inference work until ready is set.
+    # failed is set instead when the model can't be loaded. prepare(detector)
+    # runs after the warm-up, still on the loader thread
+    def __init__(self, make_detector, warmup=2, warmup_shape=DEFAULT_WARMUP_SHAPE, batch_size=1, prepare=None):
+        self.make_detector = make_detector
+        self.warmup = warmup
+        self.warmup_shape = warmup_shape
+        self.batch_size = batch_size
+        self.prepare = prepare
+
+        self.logger = logging.getLogger("model_loader")
+        self.detector = None
+        self.ready = Event()
+        self.failed = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.load, name="model_loader", daemon=True)
+        self.thread.start()
+
+    def load(self):
+        try:
+            start = time.perf_counter()
+            detector = self.make_detector()
+            loaded = time.perf_counter()
+
+            warm_up(detector.detect_batch, self.warmup, self.warmup_shape, self.batch_size)
+            self.logger.info("model load: {:.2f} s warm-up: {:.2f} s ({} frames of {}x{})".format(
+                loaded - start, time.perf_counter() - loaded, self.warmup, self.warmup_shape[1], self.warmup_shape[0]))
+
+            if self.prepare is not None:
+                self.prepare(detector)
+        except Exception:
+            # the server keeps answering without detections
+            self.logger.exception("could not load the model")
+            self.failed.set()
+            return
+
+        self.detector = detector
+        self.ready.set()
@@ -0,0 +1,209 @@
+import bisect
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# stages of a frame through the server, in order
+#   header:     parsing the frame header
+#   receive:    reading the payload from the socket once the header is parsed
+#   decode:     jpg to image on the decode threads
+#   inference:  from submitting the image until its detections are back, batching included
+#   tracking:   the tracker update of the camera
+#   annotation: drawing the boxes and handing the frame to the window or the viewer
+STAGES = ('header', 'receive', 'decode', 'inference', 'tracking', 'annotation')
+
+# upper bounds in seconds, from the microseconds of a header to a slow inference
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    def __init__(self):
+        # the last count is for the values above every bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def add(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.count += other.count
+
+    def subtract(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] -= count
+        self.total -= other.total
+        self.count -= other.count
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.add(self)
+        return histogram
+
+    def quantile(self, q):
+        # interpolated inside the bucket, like histogram_quantile() in Prometheus
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if i == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[i - 1] if i else 0.0
+                return lower + (BUCKETS[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return BUCKETS[-1]
+
+
+class StageMetrics:
+    # time per frame in every stage, one histogram per stage and camera.
+    # observe() is a bisect and a few additions under a lock, cheap enough
+    # to call for every frame from the socket, decode and consumer threads
+    def __init__(self, report_interval=10.0):
+        self.report_interval = report_interval
+
+        self.logger = logging.getLogger("metrics")
+        self.lock = Lock()
+        self.histograms = {}
+        self.last_report = {}
+
+    def observe(self, stage, camera_id, seconds):
+        key = (stage, str(camera_id))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def forget(self, camera_id):
+        camera_id = str(camera_id)
+        with self.lock:
+            for key in [key for key in self.histograms if key[1] == camera_id]:
+                del self.histograms[key]
+
+    def snapshot(self):
+        with self.lock:
+            return {key: histogram.copy() for key, histogram in self.histograms.items()}
+
+    def per_stage(self, histograms):
+        stages = {}
+        for (stage, _), histogram in histograms.items():
+            stages.setdefault(stage, Histogram()).add(histogram)
+        return stages
+
+    def summary(self, histograms):
+        stages = self.per_stage(histograms)
+        parts = []
+        for stage in STAGES:
+            histogram = stages.get(stage)
+            if histogram is None or not histogram.count:
+                continue
+            parts.append("{}: {:.2f} ms p95 {:.2f} ms".format(
+                stage, histogram.total / histogram.count * 1000, histogram.quantile(0.95) * 1000))
+
+        cameras = len({camera_id for _, camera_id in histograms})
+        frames = stages['decode'].count if 'decode' in stages else 0
+        return "{} frames of {} cameras | {}".format(frames, cameras, " | ".join(parts))
+
+    def report(self):
+        # logs the stages of the frames since the last report. a camera that
+        # reconnected has a new histogram, nothing is subtracted from it
+        with self.lock:
+            current = {key: (histogram, histogram.copy()) for key, histogram in self.histograms.items()}
+
+        interval = {}
+        for key, (histogram, copy) in current.items():
+            previous = self.last_report.get(key)
+            if previous is not None and previous[0] is histogram:
+                copy = copy.copy()
+                copy.subtract(previous[1])
+            if copy.count:
+                interval[key] = copy
+        self.last_report = current
+
+        if interval:
+            self.logger.info(self.summary(interval))
+
+    def run_reports(self):
+        while True:
+            time.sleep(self.report_interval)
+            self.report()
+
+    def start(self):
+        Thread(target=self.run_reports, name="metrics", daemon=True).start()
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = [
+            '# HELP cv_stage_seconds Time a frame spent in each stage of the server.',
+            '# TYPE cv_stage_seconds histogram',
+        ]
+        for (stage, camera_id), histogram in sorted(self.snapshot().items()):
+            labels = 'stage="{}",camera="{}"'.format(stage, escape_label(camera_id))
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append('cv_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+            lines.append('cv_stage_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, histogram.count))
+            lines.append('cv_stage_seconds_sum{{{}}} {}'.format(labels, repr(histogram.total)))
+            lines.append('cv_stage_seconds_count{{{}}} {}'.format(labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsServer:
+    # GET /metrics for Prometheus, same http server as viewer.FrameViewer
+    def __init__(self, metrics, host='127.0.0.1', port=9100):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.logger = logging.getLogger("metrics")
+
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        # the handler class is instantiated per request, it reaches the metrics through a class attribute
+        handler = type('Handler', (MetricsHandler,), {'metrics': self.metrics, 'logger': self.logger})
+
+        self.server = ThreadingHTTPServer((self.host, self.port), handler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, name="metrics_server", daemon=True)
+        self.thread.start()
+        self.logger.info("metrics on http://{}:{}/metrics".format(self.host, self.port))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+    logger = None
+
+    def log_message(self, format, *args):
+        self.logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
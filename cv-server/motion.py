@@ -0,0 +1,164 @@
+import logging
+import time
+from threading import Lock
+
+import cv2
+import numpy as np
+
+from detections import X1, X2, Y1, Y2
+from inference import chain, resolved
+
+# width of the grayscale copy the frames are compared on
+GATE_WIDTH = 160
+
+
+class CameraMotion:
+    def __init__(self):
+        # downsampled frame the last detections were computed on
+        self.reference = None
+        self.dets = None
+        self.since_detect = 0
+
+        self.frames = 0
+        self.skipped = 0
+        self.cropped = 0
+
+
+class MotionGate:
+    # skips the detector for cameras that see nothing new. every frame is
+    # compared, downsampled and blurred, against the frame the detections of
+    # its camera come from; when less than min_area of it changed by more
+    # than threshold gray levels the last detections are reused. with crop the
+    # detector only runs on the changed region when it is small enough, the
+    # detections outside of it are kept. a camera runs the detector at least
+    # once every refresh frames no matter what
+    def __init__(self, threshold=25, min_area=0.002, refresh=30, crop=False, max_crop=0.5,
+                 report_interval=10.0):
+        self.threshold = threshold
+        self.min_area = min_area
+        self.refresh = refresh
+        self.crop = crop
+        self.max_crop = max_crop
+        self.report_interval = report_interval
+
+        self.logger = logging.getLogger("motion_gate")
+        self.cameras = {}
+        self.lock = Lock()
+        self.last_report = time.perf_counter()
+
+    def get(self, camera_id):
+        with self.lock:
+            camera = self.cameras.get(camera_id)
+            if camera is None:
+                camera = self.cameras[camera_id] = CameraMotion()
+            return camera
+
+    def reset(self, camera_id):
+        with self.lock:
+            camera = self.cameras.pop(camera_id, None)
+
+        if camera is not None and camera.frames:
+            self.logger.info("camera {} {}".format(camera_id, self.summary([camera])))
+
+    def downsample(self, img):
+        height = max(1, img.shape[0] * GATE_WIDTH // img.shape[1])
+        small = cv2.resize(img, (GATE_WIDTH, height), interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def changed_region(self, camera, small):
+        # fraction of the frame that changed and its bounding box in the small frame
+        diff = cv2.absdiff(small, camera.reference)
+        _, mask = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+
+        changed = cv2.countNonZero(mask)
+        if not changed:
+            return 0.0, None
+        return changed / mask.size, cv2.boundingRect(mask)
+
+    def submit(self, camera_id, img, submit_frame):
+        # same interface as the inference stage, submit_frame(camera_id, img)
+        # is called only when the frame has to go through the detector
+        camera = self.get(camera_id)
+        camera.frames += 1
+        self.report()
+
+        small = self.downsample(img)
+
+        region = None
+        if camera.dets is not None and camera.since_detect < self.refresh and small.shape == camera.reference.shape:
+            area, box = self.changed_region(camera, small)
+            if area < self.min_area:
+                camera.skipped += 1
+                camera.since_detect += 1
+                return resolved(camera.dets)
+
+            if self.crop:
+                region = self.crop_region(img, small, box)
+
+        if region is None:
+            future = submit_frame(camera_id, img)
+            return self.chain(future, camera, small, lambda dets: dets)
+
+        camera.cropped += 1
+        x0, y0, x1, y1 = region
+        previous = camera.dets
+
+        def merge(dets):
+            # new detections of the region, the previous ones outside of it
+            dets = dets.copy()
+            dets[:, [X1, X2]] += x0
+            dets[:, [Y1, Y2]] += y0
+
+            cx = (previous[:, X1] + previous[:, X2]) / 2
+            cy = (previous[:, Y1] + previous[:, Y2]) / 2
+            outside = (cx < x0) | (cx >= x1) | (cy < y0) | (cy >= y1)
+            return np.concatenate([previous[outside], dets])
+
+        future = submit_frame(camera_id, np.ascontiguousarray(img[y0:y1, x0:x1]))
+        return self.chain(future, camera, small, merge)
+
+    def crop_region(self, img, small, box):
+        # changed box in image coordinates with some margin, None when it is
+        # too big to be worth cropping
+        x, y, w, h = box
+        if w * h > self.max_crop * small.size:
+            return None
+
+        scale = img.shape[1] / small.shape[1]
+        margin = max(w, h) // 4 + 2
+        x0 = max(0, int((x - margin) * scale))
+        y0 = max(0, int((y - margin) * scale))
+        x1 = min(img.shape[1], int((x + w + margin) * scale))
+        y1 = min(img.shape[0], int((y + h + margin) * scale))
+        return x0, y0, x1, y1
+
+    def chain(self, future, camera, small, finish):
+        # detections of the frame once the detector is done, the frame becomes
+        # the new reference of its camera
+        def update(dets):
+            dets = finish(dets)
+            camera.reference = small
+            camera.dets = dets
+            camera.since_detect = 0
+            return dets
+
+        return chain(future, update)
+
+    def report(self):
+        now = time.perf_counter()
+        if now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+
+        with self.lock:
+            cameras = list(self.cameras.values())
+        self.logger.info(self.summary(cameras))
+
+    def summary(self, cameras):
+        frames = sum(camera.frames for camera in cameras)
+        skipped = sum(camera.skipped for camera in cameras)
+        cropped = sum(camera.cropped for camera in cameras)
+        ratio = skipped / frames if frames else 0.0
+        return "motion gate: frames: {} skipped: {} ({:.0f}%) cropped: {}".format(
+            frames, skipped, 100 * ratio, cropped)
@@ -0,0 +1,272 @@
+import importlib.util
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+
+import cv2
+import numpy as np
+
+from detections import CLS, CONF, TRACK_ID, X1, X2, Y1, Y2
+
+# Detect codes of the security agents (pruebas/Multiagent.py CameraAgent.see,
+# Security_AgentPy.py CamAgent.update_state), the same Unity posts
+DETECT_NOTHING = 0
+DETECT_ANIMAL = 1
+DETECT_FUGITIVE = 2
+
+# model class names to Detect codes, coco names by default. the calibration
+# file can replace them with its own "classes"
+CLASS_CODES = {'person': DETECT_FUGITIVE}
+CLASS_CODES.update(dict.fromkeys(
+    ['bird', 'cat', 'dog', 'horse', 'sheep', 'cow', 'elephant', 'bear', 'zebra', 'giraffe'], DETECT_ANIMAL))
+
+# size of the agents' grid, pruebas/Multiagent.py works on 100 x 100 cells
+GRID_SIZE = (100, 100)
+
+
+class Calibration:
+    # image pixels of one camera to cells of the agents' grid, through the
+    # homography of the floor plane. position is where the camera itself is
+    # on the grid. without a homography the image is stretched over the whole
+    # grid, good enough for a camera looking straight down like the drone's
+    def __init__(self, homography=None, position=(0, 0), grid_size=GRID_SIZE):
+        self.homography = None if homography is None else np.asarray(homography, np.float64).reshape(3, 3)
+        self.position = [int(v) for v in position]
+        self.grid_size = grid_size
+
+    @classmethod
+    def from_json(cls, options, grid_size=GRID_SIZE):
+        # {"homography": 3x3} or four or more point pairs {"image": [[u, v], ...], "grid": [[x, y], ...]}
+        homography = options.get('homography')
+        if homography is None and 'image' in options:
+            image = np.asarray(options['image'], np.float32)
+            grid = np.asarray(options['grid'], np.float32)
+            homography, _ = cv2.findHomography(image, grid)
+            if homography is None:
+                raise ValueError("the image and grid points of the calibration don't define a homography")
+        return cls(homography, options.get('position', (0, 0)), grid_size)
+
+    def to_grid(self, points, image_size):
+        # (n, 2) pixel coordinates to integer grid cells, clipped to the grid
+        points = np.asarray(points, np.float64).reshape(-1, 1, 2)
+        if self.homography is not None:
+            cells = cv2.perspectiveTransform(points, self.homography).reshape(-1, 2)
+        else:
+            cells = points.reshape(-1, 2) / image_size * self.grid_size
+        cells = np.floor(cells).astype(int)
+        return np.clip(cells, 0, np.array(self.grid_size) - 1)
+
+
+def load_calibration(path):
+    # {"grid_size": [100, 100], "classes": {"person": 2}, "cameras": {"0": {...}, ...}}
+    # returns the calibrations by camera id, the class codes and the grid size
+    with open(path) as f:
+        options = json.load(f)
+
+    grid_size = tuple(options.get('grid_size', GRID_SIZE))
+    cameras = {int(camera_id): Calibration.from_json(camera, grid_size)
+               for camera_id, camera in options.get('cameras', {}).items()}
+    return cameras, options.get('classes', CLASS_CODES), grid_size
+
+
+class PerceptionBridge:
+    # turns the tracked detections of every camera into the perception the
+    # security agents expect and hands them to the agent system in the same
+    # process, no json and no http in between. publish() is called by the
+    # consumer of each camera and never waits: it keeps only the newest
+    # perception of the camera, and only when the Detect code or the cell of
+    # the object changed. a thread passes everything waiting, one perception
+    # per camera, to consume(batch) at once, so a slow agent step coalesces
+    # frames instead of queueing them. prepare(names) runs once the class
+    # names of the model are known, before the first publish()
+    def __init__(self, consume, calibrations=None, class_codes=None, grid_size=GRID_SIZE,
+                 min_confidence=0.4, report_interval=10.0):
+        self.consume = consume
+        self.calibrations = calibrations or {}
+        self.class_codes = CLASS_CODES if class_codes is None else class_codes
+        self.grid_size = grid_size
+        self.min_confidence = min_confidence
+        self.report_interval = report_interval
+
+        # class ids of the model to Detect codes
+        self.codes = {}
+
+        self.logger = logging.getLogger("perception")
+        self.condition = Condition()
+        self.pending = OrderedDict()
+        self.last = {}
+        self.running = False
+        self.thread = None
+
+        self.published = 0
+        self.batches = 0
+        self.alarms = 0
+        self.latency = 0.0
+
+    def prepare(self, names):
+        self.codes = {cls: self.class_codes[name] for cls, name in names.items() if name in self.class_codes}
+        if not self.codes:
+            self.logger.warning("no class of the model maps to a Detect code")
+
+    def calibration(self, camera_id):
+        calibration = self.calibrations.get(camera_id)
+        if calibration is None:
+            calibration = self.calibrations[camera_id] = Calibration(grid_size=self.grid_size)
+        return calibration
+
+    def perceive(self, camera_id, dets, image_size):
+        # the perception of one frame: the most confident fugitive, else the
+        # most confident animal. its cell is under the bottom center of the
+        # box, where the object touches the floor
+        calibration = self.calibration(camera_id)
+        perception = {'id': camera_id, 'position': calibration.position, 'Detect': DETECT_NOTHING,
+                      'DetectPosition': None, 'track_id': -1}
+        if not len(dets) or not self.codes:
+            return perception
+
+        codes = np.array([self.codes.get(int(cls), DETECT_NOTHING) for cls in dets[:, CLS]])
+        candidates = np.flatnonzero((codes > DETECT_NOTHING) & (dets[:, CONF] >= self.min_confidence))
+        if not len(candidates):
+            return perception
+
+        best = candidates[np.lexsort((-dets[candidates, CONF], -codes[candidates]))[0]]
+        x1, y1, x2, y2 = dets[best, [X1, Y1, X2, Y2]]
+        cell = calibration.to_grid([[(x1 + x2) / 2, y2]], image_size)[0]
+        perception.update(Detect=int(codes[best]), DetectPosition=[int(cell[0]), int(cell[1])],
+                          track_id=int(dets[best, TRACK_ID]))
+        return perception
+
+    def publish(self, camera_id, dets, image_size):
+        # image_size is (width, height) of the image the boxes are in
+        perception = self.perceive(camera_id, dets, image_size)
+        key = (perception['Detect'], perception['DetectPosition'])
+        if self.last.get(camera_id) == key:
+            return
+        self.last[camera_id] = key
+
+        with self.condition:
+            self.pending.pop(camera_id, None)
+            self.pending[camera_id] = (perception, time.perf_counter())
+            self.condition.notify()
+
+    def forget(self, camera_id):
+        # the camera disconnected, its next perception is sent even if it is the same
+        self.last.pop(camera_id, None)
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.run, name="perception", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.logger.info(self.summary())
+
+    def next_batch(self):
+        with self.condition:
+            while self.running and not self.pending:
+                self.condition.wait()
+            if not self.running:
+                return None
+
+            batch = list(self.pending.values())
+            self.pending.clear()
+            return batch
+
+    def run(self):
+        last_report = time.perf_counter()
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+
+            try:
+                self.consume([perception for perception, _ in batch])
+            except Exception:
+                self.logger.exception("agents failed on {} perceptions".format(len(batch)))
+
+            now = time.perf_counter()
+            self.batches += 1
+            self.published += len(batch)
+            self.alarms += sum(perception['Detect'] == DETECT_FUGITIVE for perception, _ in batch)
+            self.latency += sum(now - published for _, published in batch)
+
+            if now - last_report >= self.report_interval:
+                last_report = now
+                self.logger.info(self.summary())
+
+    def summary(self):
+        latency = 1000 * self.latency / self.published if self.published else 0.0
+        return "perception: {} perceptions in {} batches, {} fugitives, {:.2f} ms to the agents".format(
+            self.published, self.batches, self.alarms, latency)
+
+
+def load_module(path):
+    # the agents' module runs from its own directory, it opens its ontology
+    # with a relative path
+    directory = os.path.dirname(os.path.abspath(path))
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+def load_agents(path):
+    # consume(batch) for the agent system in path, pruebas/Multiagent.py or
+    # Security_AgentPy.py, told apart by what the module defines
+    module = load_module(path)
+    if hasattr(module, 'MultiAgentSystem'):
+        return multiagent_consumer(module.MultiAgentSystem())
+    if hasattr(module, 'SecurityDepartmentModel'):
+        return security_consumer(module.SecurityDepartmentModel)
+    raise ValueError("{} has no MultiAgentSystem or SecurityDepartmentModel".format(path))
+
+
+def multiagent_consumer(mas):
+    # the batch is what Unity posts as "Camera" to /detect in pruebas/Server.py,
+    # during the camera phase. the drone and guard phases keep coming from Unity
+    logger = logging.getLogger("perception")
+
+    def consume(batch):
+        if mas.simulation_phase != 'camera':
+            return
+
+        results, drone = mas.process_detection(batch, None)
+        for result in results:
+            if result['action'] == 'alarm':
+                logger.info("camera {} raised the alarm, drone: {}".format(result['id'], drone['action']))
+
+    return consume
+
+
+def security_consumer(model_class, cameras=5):
+    # every camera that sees something steps its CamAgent, like a POST /gmes
+    # does in Security_AgentPy's Server.py. update_state() parses a json string
+    logger = logging.getLogger("perception")
+    model = model_class({'num_cams': cameras, 'num_dron': 1, 'num_secper': 1})
+    model.setup()
+    agents = {camera.onto_camera.has_id: camera for camera in model.cams}
+
+    def consume(batch):
+        for perception in batch:
+            camera = agents.get(perception['id'])
+            if camera is None or perception['Detect'] == DETECT_NOTHING:
+                continue
+            camera.step(json.dumps({'id': perception['id'], 'per': perception['Detect'],
+                                    'per_ubi': perception['DetectPosition']}))
+            if perception['Detect'] == DETECT_FUGITIVE:
+                logger.info("camera {} sees a fugitive at {}".format(perception['id'], perception['DetectPosition']))
+
+    return consume
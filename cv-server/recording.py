@@ -0,0 +1,141 @@
+import json
+import mmap
+import time
+from threading import Lock
+
+import numpy as np
+
+# a recording is three files next to each other:
+#   <path>.frames        the payloads (jpg or raw pixels) one after the other, append only
+#   <path>.index         a fixed size row per frame, see INDEX_ENTRY
+#   <path>.cameras.json  the camera ids, rows refer to them by position
+# the payloads are never parsed again, replay maps the frames file once and
+# slices it with the offsets of the index
+INDEX_MAGIC = b'CVRI'
+INDEX_VERSION = 2
+INDEX_HEADER_SIZE = 8
+
+# timestamp is the capture time sent by the camera (nan for legacy clients),
+# arrival the time the server received the frame, both in seconds since the epoch.
+# encoding, width and height as in the v3 header, see framing.py
+INDEX_ENTRY = np.dtype([
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('camera', '<u2'),
+    ('flags', '<u2'),
+    ('sequence', '<u4'),
+    ('encoding', '<u2'),
+    ('width', '<u2'),
+    ('height', '<u2'),
+    ('timestamp', '<f8'),
+    ('arrival', '<f8'),
+])
+
+
+class FrameRecorder:
+    # appends the frames of every camera to one recording, safe to call from
+    # every client thread. a frame is written before its index row, so a
+    # recording cut short still has a valid index up to its last whole row
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+
+        self.frames_file = open(path + '.frames', 'ab')
+        self.index_file = open(path + '.index', 'ab')
+        if self.index_file.tell() == 0:
+            self.index_file.write(INDEX_MAGIC + np.uint32(INDEX_VERSION).tobytes())
+
+        self.offset = self.frames_file.tell()
+        self.cameras = {}
+        try:
+            with open(path + '.cameras.json') as f:
+                self.cameras = {camera_id: i for i, camera_id in enumerate(json.load(f))}
+        except FileNotFoundError:
+            pass
+
+        self.row = np.zeros(1, INDEX_ENTRY)
+        self.frames = 0
+
+    def camera_number(self, camera_id):
+        number = self.cameras.get(camera_id)
+        if number is None:
+            number = self.cameras[camera_id] = len(self.cameras)
+            with open(self.path + '.cameras.json', 'w') as f:
+                json.dump(list(self.cameras), f)
+        return number
+
+    def write(self, frame, arrival=None):
+        with self.lock:
+            length = len(frame.payload)
+            self.frames_file.write(frame.payload)
+
+            row = self.row[0]
+            row['offset'] = self.offset
+            row['length'] = length
+            row['camera'] = self.camera_number(frame.camera_id)
+            row['flags'] = frame.flags
+            row['sequence'] = frame.sequence
+            row['encoding'] = frame.encoding
+            row['width'] = frame.width
+            row['height'] = frame.height
+            row['timestamp'] = np.nan if frame.timestamp is None else frame.timestamp
+            row['arrival'] = time.time() if arrival is None else arrival
+            self.index_file.write(self.row.tobytes())
+
+            self.offset += length
+            self.frames += 1
+
+    def close(self):
+        with self.lock:
+            self.frames_file.close()
+            self.index_file.close()
+
+
+class Recording:
+    # read side of a recording. index is a structured array with a row per
+    # frame, payload(i) a memoryview into the mapped frames file
+    def __init__(self, path):
+        with open(path + '.index', 'rb') as f:
+            header = f.read(INDEX_HEADER_SIZE)
+            if header[:4] != INDEX_MAGIC:
+                raise ValueError("{}.index is not a frame index".format(path))
+            if np.frombuffer(header, '<u4', 1, 4)[0] != INDEX_VERSION:
+                raise ValueError("{}.index was written by another version of the server".format(path))
+            data = f.read()
+
+        # a torn last row from a recording that was cut short is ignored
+        rows = len(data) // INDEX_ENTRY.itemsize
+        self.index = np.frombuffer(data, INDEX_ENTRY, rows)
+
+        with open(path + '.cameras.json') as f:
+            self.cameras = json.load(f)
+
+        self.frames_file = open(path + '.frames', 'rb')
+        # an empty file can't be mapped
+        self.map = mmap.mmap(self.frames_file.fileno(), 0, access=mmap.ACCESS_READ) if rows else b''
+        self.view = memoryview(self.map)
+
+        # rows whose payload did not make it to disk
+        self.index = self.index[self.index['offset'] + self.index['length'] <= len(self.map)]
+
+    def __len__(self):
+        return len(self.index)
+
+    def payload(self, i):
+        row = self.index[i]
+        return self.view[row['offset']:row['offset'] + row['length']]
+
+    def camera_id(self, i):
+        return self.cameras[self.index[i]['camera']]
+
+    def duration(self):
+        if not len(self.index):
+            return 0.0
+        return float(self.index['arrival'][-1] - self.index['arrival'][0])
+
+    def close(self):
+        # the views handed out by payload() must be gone before this
+        self.view.release()
+        if self.map:
+            self.map.close()
+        self.frames_file.close()
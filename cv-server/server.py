@@ -1,118 +1,417 @@
-from ultralytics import YOLO
+import time
+
+# startup times are reported from here, before the imports below
+started = time.perf_counter()
+
+import argparse
 import socket
 import logging
 import cv2
-import numpy as np
-from threading import Thread, Event as ThreadEvent
-
-model = YOLO('yolov8s.pt')
+from threading import Lock, Thread, Event as ThreadEvent
+from framing import FLAG_BOTTOM_UP, FLAG_RESULTS_BINARY, FLAG_RESULTS_JSON, Frame, FrameReceiver, StreamStats
+from async_server import AsyncIngestServer
+from decoding import DecodeStage
+from motion import MotionGate
+from keyframes import KeyframeTracker
+from tiles import TiledInference
+from cascade import Cascade, CameraFilters
+from inference import BatchScheduler, resolved
+from slots import FrameSlot, AsyncFrameSlot
+from workers import InferencePool
+from detectors import BACKENDS, make_detector
+from loader import ModelLoader, warmed_up_detector
+from functools import partial
+from trackers import TrackerPool, make_tracker, tracker_available
+from viewer import FrameViewer
+from video import VideoRecorder
+from perception import GRID_SIZE, PerceptionBridge, load_agents, load_calibration
+from recording import FrameRecorder, Recording
+from metrics import MetricsServer, StageMetrics
+from flow import FlowControl
+import detections
+
+imported = time.perf_counter()
+
+# set once the model is loaded and warmed up, before that frames get empty
+# replies marked as not ready. names are the class names of the model
+ready = ThreadEvent()
+names = {}
+
+# the ModelLoader or InferencePool loading the model, its failed event is set
+# when the model can't be loaded. set in main()
+model_loader = None
+
+# central inference stage. either a BatchScheduler running the model in this
+# process, created once the model is loaded, or an InferencePool of worker
+# processes created in main(). both return a Future with the detections
+# array of a frame from submit()
+scheduler = None
+
+# skips the detector for cameras where nothing moved, None when disabled. set in main()
+gate = None
+
+# runs the detector on overlapping tiles of big frames, None when disabled. set in main()
+tiles = None
+
+# class whitelist and confidence threshold of every camera, set in main()
+filters = CameraFilters()
+
+# runs a cheap detector first and the full one only where it found something, None when disabled. set in main()
+cascade = None
+
+# inference stage of the cheap detector of the cascade, created once it is loaded
+cheap_scheduler = None
+
+# runs the detector on keyframes only and follows the boxes in between, None when disabled. set in main()
+keyframes = None
+
+# thread pool decoding the frames off the socket readers, set in main()
+decoder = None
+
+# drop policy of the per camera slots, set in main()
+slot_options = {}
+
+# one tracker per camera, None when tracking is disabled. set in main()
+trackers = None
+
+# appends every received frame to a recording, None when not recording. set in main()
+recorder = None
+
+# hands what the cameras see to the security agents in this process, None when disabled. set in main()
+perception = None
+
+# writes annotated video of the cameras switched on, None when disabled. set in main()
+video = None
+
+# time per frame in every stage, per camera. set in main()
+metrics = None
+
+# logs every frame and every recv fragment of the socket readers, set in main()
+log_frames = False
+
+# without a window the detections only go back to the cameras that asked for
+# them and, when enabled, to the browsers watching the FrameViewer. set in main()
+headless = False
+viewer = None
+
+def inference_ready(model_names):
+    # runs once the model is warmed up, right before frames go to inference
+    global names
+    names = model_names
+
+    if trackers is not None:
+        # imports the tracker code now instead of on the first frame
+        make_tracker(trackers.name)
+    filters.prepare(model_names)
+    if perception is not None:
+        perception.prepare(model_names)
+
+    ready.set()
+    logging.getLogger("main").info("detections live: {:.2f} s after start".format(time.perf_counter() - started))
+
+def wait_ready(poll=0.5):
+    # blocks until the model is ready, False when it could not be loaded
+    while not ready.wait(poll):
+        if model_loader.failed.is_set():
+            return False
+    return True
+
+def start_batch_scheduler(batch_size, max_wait, detector):
+    global scheduler
+    scheduler = BatchScheduler(detector.detect_batch, batch_size=batch_size, max_wait=max_wait)
+    scheduler.start()
+    inference_ready(detector.names)
+
+def start_cheap_scheduler(batch_size, max_wait, size, detector):
+    # the full detector takes every frame until this runs
+    global cheap_scheduler
+    if getattr(detector, 'dynamic', True) is False and detector.imgsz != (size, size):
+        logging.getLogger("main").warning("--cascade-size {} ignored, the cheap model only takes {}x{}".format(
+            size, detector.imgsz[1], detector.imgsz[0]))
+
+    cheap_scheduler = BatchScheduler(detector.detect_batch, batch_size=batch_size, max_wait=max_wait)
+    cheap_scheduler.start()
+    # the cheap model may number its classes differently than the full one
+    cascade.start(cheap_scheduler.submit, detector.names)
+    logging.getLogger("main").info("cascade live: {:.2f} s after start".format(time.perf_counter() - started))
+
+def submit_decode(frame, payload):
+    # Future with the decoded image and its scale. raises ValueError for an
+    # encoding this server can't decode, the connection is closed. tiled
+    # cameras are decoded at full resolution, the tiles are cut from it
+    reduce = tiles is None or not tiles.tiled(frame.camera_id)
+    return decoder.submit(payload, partial(metrics.observe, 'decode', frame.camera_id),
+                          frame.encoding, frame.width, frame.height, bool(frame.flags & FLAG_BOTTOM_UP), reduce)
+
+def submit_frame(camera_id, img):
+    # Future with the detections of a frame, through the keyframe tracker, the
+    # motion gate, the cascade and the tiling when enabled
+    if not ready.is_set():
+        return resolved(detections.empty())
+
+    submit = scheduler.submit
+    if tiles is not None:
+        submit = partial(tiles.submit, submit_frame=submit)
+    if cascade is not None:
+        submit = partial(cascade.submit, submit_frame=submit)
+    if gate is not None:
+        submit = partial(gate.submit, submit_frame=submit)
+    if keyframes is not None:
+        return keyframes.submit(camera_id, img, submit)
+    return submit(camera_id, img)
+
+def cancel_decode(item):
+    # a frame dropped by the slot is not decoded if its turn did not come yet
+    frame, decoding = item
+    decoding.cancel()
+
+def encode_results(frame, dets):
+    # the reply the camera asked for in the flags of its frame header, None
+    # for legacy clients, they never read from the socket
+    if not frame.flags & (FLAG_RESULTS_BINARY | FLAG_RESULTS_JSON):
+        return None
+
+    # boxes in the coordinates of the image the camera sent
+    dets = detections.rescale(dets, frame.scale)
+    if frame.flags & FLAG_RESULTS_BINARY:
+        return detections.pack(frame.sequence, dets, 0 if ready.is_set() else detections.RESULT_NOT_READY)
+    return detections.to_json(frame.camera_id, frame.sequence, dets, names, ready.is_set()).encode()
+
+def handle_results(frame, img, dets):
+    # track and display the detections of one frame
+    # returns the reply for the camera and False when the user asked to quit from the window
+    if ready.is_set():
+        # the detectors only drop the classes no camera wants
+        dets = filters.apply(frame.camera_id, dets)
+
+    if trackers is not None and ready.is_set():
+        start = time.perf_counter()
+        dets = trackers.update(frame.camera_id, dets, img)
+        metrics.observe('tracking', frame.camera_id, time.perf_counter() - start)
+
+    reply = encode_results(frame, dets)
+
+    if perception is not None and ready.is_set():
+        # the calibration is in pixels of the image the camera sent
+        size = (img.shape[1] * frame.scale, img.shape[0] * frame.scale)
+        perception.publish(frame.camera_id, detections.rescale(dets, frame.scale), size)
+
+    if video is not None and ready.is_set() and video.recording(frame.camera_id):
+        # drawn and encoded on the recorder thread
+        video.offer(frame.camera_id, img, dets, names)
+
+    watched = viewer is not None and viewer.watching(frame.camera_id)
+    if headless and not watched:
+        # nothing to draw
+        return reply, True
+
+    start = time.perf_counter()
+    annotated_frame = detections.draw(img, dets, names)
+    if watched:
+        viewer.publish(frame.camera_id, annotated_frame)
+    if headless:
+        metrics.observe('annotation', frame.camera_id, time.perf_counter() - start)
+        return reply, True
+
+    # display results
+    cv2.imshow('YOLOv8 Tracking', annotated_frame)
+    metrics.observe('annotation', frame.camera_id, time.perf_counter() - start)
+
+    return reply, cv2.waitKey(1) & 0xFF != ord('q')
+
+def close_stream(camera_id):
+    # a camera disconnected, forget its tracks
+    if trackers is not None:
+        trackers.reset(camera_id)
+    if gate is not None:
+        gate.reset(camera_id)
+    if keyframes is not None:
+        keyframes.reset(camera_id)
+    if tiles is not None:
+        tiles.reset(camera_id)
+    if cascade is not None:
+        cascade.reset(camera_id)
+    if viewer is not None:
+        viewer.forget(camera_id)
+    if video is not None:
+        video.forget(camera_id)
+    if perception is not None:
+        perception.forget(camera_id)
+    if isinstance(camera_id, str):
+        # legacy cameras are named after their connection, the name never comes back
+        metrics.forget(camera_id)
+
+def send_reply(client_socket, slot, frame, reply):
+    # False when the camera is gone
+    try:
+        client_socket.sendall(reply)
+    except OSError as e:
+        logging.getLogger("consume_frames").warning(
+            "could not send the detections to {}: {}".format(frame.camera_id, e))
+        slot.close()
+        return False
+    return True
+
+def consume_frames(slot, stats, client_socket, flow=None):
+    # inference side of one camera, takes frames from the slot while the
+    # client thread keeps reading the socket
+    logger = logging.getLogger("consume_frames")
 
-def clean_buffer(original_buffer):
-    buffer = b''
-    for b in original_buffer:
-        if b == 255:
+    while True:
+        start = time.perf_counter()
+        item = slot.get()
+        if item is None:
             break
-        buffer += bytes([b])
-    return buffer
-
-def get_numeric_data(buffer):
-    numeric_buffer = b''
-    left_bytes = b''
 
-    for b in buffer:
-        if b >= 48 and b <= 57:
-            numeric_buffer += bytes([b])
-        else:
-            left_bytes += bytes([b])
+        frame, decoding = item
+        if flow is not None:
+            # the camera sends its next frame while this one is processed
+            control = flow.taken(frame, time.perf_counter() - start)
+            if control is not None and not send_reply(client_socket, slot, frame, control):
+                break
 
-    return numeric_buffer, left_bytes
+        img, scale = decoding.result()
+        if img is None:
+            logger.warning("could not decode frame {} of camera {}".format(frame.sequence, frame.camera_id))
+            continue
+        frame = frame._replace(scale=scale)
+        if flow is not None:
+            flow.decoded(frame, img)
 
-def handle_socket_client(client_socket, addr):
-    logger = logging.getLogger("handle_socket_client")
-    logger.info("connected to client: {}".format(addr))
+        # wait for the batch this frame ends up in
+        start = time.perf_counter()
+        try:
+            dets = submit_frame(frame.camera_id, img).result()
+        except Exception as e:
+            # the frame is lost, not the camera
+            logger.warning("no detections for frame {} of camera {}: {!r}".format(frame.sequence, frame.camera_id, e))
+            slot.mark_processed()
+            continue
+        metrics.observe('inference', frame.camera_id, time.perf_counter() - start)
+        slot.mark_processed()
+        if dets is None:
+            continue
 
-    while True:
-        # the payload is composed of two parts:
-        # +---------------------------------+-----------------+
-        # | length of bytes to be received  | image bytes     |
-        # +---------------------------------+-----------------+
-
-        # receive the length of bytes to be received
-        # we assumed the number of bytes at most will be in 7 bytes
-        # in practice, this number will be less than 7 bytes, probably 6
-        data = client_socket.recv(7)
-        if not data:
+        reply, keep_running = handle_results(frame, img, dets)
+        if reply is not None and not send_reply(client_socket, slot, frame, reply):
             break
+        stats.update_latency(frame)
 
-        # get the numeric data from the received bytes
-        # telling us how many bytes we should expect
-        # the rest of the buffer is part of the image bytes
-        numeric_data, initial_buffer = get_numeric_data(data)
-
-        # convert the received bytes to integer
-        data_len = int(numeric_data.decode('ascii'))
-        logger.info("data_len: {}".format(data_len))
+        if not keep_running:
+            slot.close()
+            break
 
-        buffer = initial_buffer
-        bytes_left = data_len - len(buffer)
+def handle_socket_client(client_socket, addr):
+    logger = logging.getLogger("handle_socket_client")
+    logger.info("connected to client: {}".format(addr))
 
-        while True:
-            # receive the image bytes
-            logger.info('bytes left: {}'.format(bytes_left))
-            fragment = client_socket.recv(bytes_left)
-            logger.info('read bytes: {}'.format(len(fragment)))
-            if not fragment:
+    # two framings are accepted, detected from the first bytes of the connection
+    #
+    # legacy, sent by older CameraStreamer.cs builds:
+    # +---------------------------------+-----------------+
+    # | length of bytes to be received  | image bytes     |
+    # +---------------------------------+-----------------+
+    #
+    # v2, a fixed size binary header (see framing.HEADER_V2):
+    # +---------------------------------------------------------------+-------------+
+    # | magic, version, flags, camera id, length, sequence, timestamp | image bytes |
+    # +---------------------------------------------------------------+-------------+
+    #
+    # with the flags a v2 client asks for the detections of its frames, they
+    # are written back on this socket (see encode_results)
+    #
+    # v3, the v2 header with the encoding, width and height of the payload
+    # (see framing.HEADER_V3_EXTENSION), for cameras sending raw rgb24 pixels
+    # instead of a jpg, optionally lz4 compressed
+    #
+    # the receiver reads both parts into a buffer reused once the decode of
+    # its frame is done (see FrameReceiver.lend)
+    trace = None
+    if log_frames:
+        trace = lambda n, received, size: logger.debug("{} fragment: {} bytes, {}/{}".format(addr, n, received, size))
+    receiver = FrameReceiver(client_socket, camera_id="{}:{}".format(*addr), trace=trace)
+    stats = StreamStats()
+    cameras = set()
+
+    # frames wait for inference in a bounded slot, see slots.POLICIES
+    slot = FrameSlot(on_drop=cancel_decode, **slot_options)
+    # credits for cameras that ask for them, see flow.py
+    flow = FlowControl(window=slot.capacity)
+    consumer = Thread(target=consume_frames, args=(slot, stats, client_socket, flow))
+    consumer.start()
+
+    try:
+        while not slot.closed:
+            try:
+                frame = receiver.receive()
+            except ValueError as e:
+                logger.error(str(e))
                 break
-
-            buffer += fragment
-            if len(buffer) == data_len:
+            except OSError:
+                # reset, a client that leaves replies unread resets the
+                # connection, or shut down by stop_clients()
                 break
-            else:
-                bytes_left = data_len - len(fragment)
 
-        if len(buffer) != data_len:
-            logger.error("received data length does not match the expected length")
-            break
-
-        # save the received image
-        # with open('images/{}.jpg'.format(counter), 'wb') as fw:
-        #     fw.write(buffer)
-
-        nparr = np.frombuffer(buffer, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-        # For now, let's just display the received image
-        results = model.track(img, persist=True)
-
-        annotated_frame = results[0].plot()
-
-        # display results
-        cv2.imshow('YOLOv8 Tracking', annotated_frame)
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-
-
-    client_socket.close()
-    cv2.destroyAllWindows()
-    logger.info("client disconnected")
+            if frame is None:
+                break
 
-def socket_server():
+            stats.update(frame)
+            flow.received(frame)
+            cameras.add(frame.camera_id)
+            metrics.observe('header', frame.camera_id, receiver.header_time)
+            metrics.observe('receive', frame.camera_id, receiver.payload_time)
+
+            buffer = frame.payload
+            if log_frames:
+                logger.debug("camera: {} sequence: {} data_len: {}".format(frame.camera_id, frame.sequence, len(buffer)))
+
+            # save the received image, see --record and --replay
+            if recorder is not None:
+                recorder.write(frame)
+
+            # the decode reads the receive buffer in place, the next frames go
+            # to another one until it is done
+            try:
+                decoding = submit_decode(frame, buffer)
+            except (ValueError, RuntimeError) as e:
+                # RuntimeError: the decoder is shut down
+                logger.error(str(e))
+                break
+            receiver.lend(decoding)
+            slot.put((frame._replace(payload=None), decoding))
+    finally:
+        # the consumer ends whatever stopped the reader
+        slot.close()
+        consumer.join()
+
+        for camera_id in cameras:
+            close_stream(camera_id)
+
+        client_socket.close()
+        with clients_lock:
+            clients.pop(client_socket, None)
+        if not headless:
+            cv2.destroyAllWindows()
+        logger.info("client disconnected: {} {} {}".format(addr, stats.summary(), slot.summary()))
+        if flow.enabled:
+            logger.info(flow.summary())
+
+def socket_server(host, port):
     logger = logging.getLogger("socket_server")
 
-    HOST = '127.0.0.1'
-    PORT = 5500
-
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((HOST, PORT))
+    server_socket.bind((host, port))
     server_socket.listen(5)
     server_socket.settimeout(1)
 
-    logger.info("server listening on port: {}:{}".format(HOST, PORT))
+    logger.info("server listening on port: {}:{}".format(host, port))
     while not exit_socket_server_flag.is_set():
         try:
             client_socket, addr = server_socket.accept()
-            Thread(target=handle_socket_client, args=(client_socket, addr)).start()
+            thread = Thread(target=handle_socket_client, args=(client_socket, addr))
+            with clients_lock:
+                clients[client_socket] = thread
+            thread.start()
         except socket.timeout:
             continue
 
@@ -122,16 +421,406 @@ def socket_server():
 
 exit_socket_server_flag = ThreadEvent()
 
-socket_server_thread = Thread(target=socket_server)
-socket_server_thread.start()
+# socket of every connected camera to the thread handling it, see stop_clients
+clients = {}
+clients_lock = Lock()
+
+def stop_clients():
+    # shuts the camera sockets down so their readers return, then waits for
+    # every handler to close its slot and join its consumer. the shared
+    # stages are only stopped after this
+    with clients_lock:
+        connected = list(clients.items())
+
+    for client_socket, thread in connected:
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # already gone
+            pass
+
+    for client_socket, thread in connected:
+        thread.join()
 
-while True:
-    # if user presses 'q' then exit
-    if input("press 'q' to exit\n") == 'q':
-        # set flag to be able to terminate the socket server
-        exit_socket_server_flag.set()
-        break
+def run_threads(args):
+    # one thread per camera connection
+    socket_server_thread = Thread(target=socket_server, args=(args.host, args.port))
+    socket_server_thread.start()
 
-# join threads
-# event_thread.join()
-socket_server_thread.join()
+    while True:
+        # if user presses 'q' then exit
+        if input("press 'q' to exit\n") == 'q':
+            # set flag to be able to terminate the socket server
+            exit_socket_server_flag.set()
+            break
+
+    # join threads, no camera connects after this
+    socket_server_thread.join()
+    stop_clients()
+
+def run_async(args):
+    # every camera on one event loop, stops with ctrl+c or SIGTERM
+    server = AsyncIngestServer(
+        submit_decode, submit_frame, handle_results, close_stream,
+        lambda: AsyncFrameSlot(on_drop=cancel_decode, **slot_options),
+        host=args.host, port=args.port, max_connections=args.max_connections,
+        record_frame=recorder.write if recorder is not None else None, observe=metrics.observe)
+    server.run()
+    if not headless:
+        cv2.destroyAllWindows()
+
+def run_replay(args):
+    # feeds a recording through the same slots, decoding, inference and output
+    # as the live cameras. the frames file is mapped once, every frame is a
+    # slice of it. speed 1 keeps the original timing, 0 goes as fast as the
+    # pipeline takes frames without dropping any
+    logger = logging.getLogger("replay")
+    recording = Recording(args.replay)
+    logger.info("replaying {} frames of {} cameras, {:.1f} s recorded".format(
+        len(recording), len(recording.cameras), recording.duration()))
+
+    if not wait_ready():
+        logger.error("the model could not be loaded, nothing to replay the frames through")
+        recording.close()
+        return False
+
+    streams = {}
+    arrivals = recording.index['arrival']
+    start = time.perf_counter()
+
+    for i, row in enumerate(recording.index):
+        if args.replay_speed > 0:
+            wait = (arrivals[i] - arrivals[0]) / args.replay_speed - (time.perf_counter() - start)
+            if wait > 0:
+                time.sleep(wait)
+
+        camera_id = recording.cameras[row['camera']]
+        stream = streams.get(camera_id)
+        if stream is None:
+            slot = FrameSlot(on_drop=cancel_decode, **slot_options)
+            stats = StreamStats()
+            consumer = Thread(target=consume_frames, args=(slot, stats, None))
+            consumer.start()
+            stream = streams[camera_id] = (slot, stats, consumer)
+
+        slot, stats, consumer = stream
+        if slot.closed:
+            # the user quit from the window
+            break
+        if args.replay_speed == 0:
+            slot.wait_room()
+
+        # no capture time, the latency to a recorded timestamp means nothing,
+        # and no reply flags, there is nobody to reply to
+        frame = Frame(camera_id, int(row['sequence']), None, None, int(row['flags']) & FLAG_BOTTOM_UP,
+                      encoding=int(row['encoding']), width=int(row['width']), height=int(row['height']))
+        stats.update(frame)
+        slot.put((frame, submit_decode(frame, recording.payload(i))))
+
+    for camera_id, (slot, stats, consumer) in streams.items():
+        slot.wait_empty()
+        slot.close()
+        consumer.join()
+        close_stream(camera_id)
+        logger.info("camera {} {} {}".format(camera_id, stats.summary(), slot.summary()))
+
+    elapsed = time.perf_counter() - start
+    processed = sum(slot.processed for slot, _, _ in streams.values())
+    logger.info("replayed {} frames in {:.1f} s, {:.1f} frames/s processed".format(
+        len(recording), elapsed, processed / elapsed))
+
+    streams.clear()
+    recording.close()
+    if not headless:
+        cv2.destroyAllWindows()
+    return True
+
+def tile_camera(value):
+    # --tile-camera 3=1280:0.25, the camera id of the v2 header
+    try:
+        camera_id, options = value.split('=')
+        size, _, overlap = options.partition(':')
+        return int(camera_id), int(size), float(overlap) if overlap else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected ID=SIZE[:OVERLAP], got {!r}".format(value))
+
+def camera_filter(value):
+    # --camera-filter 3=person,dog:0.5, the camera id of the v2 header
+    try:
+        camera_id, options = value.split('=')
+        classes, _, conf = options.partition(':')
+        return int(camera_id), parse_classes(classes), float(conf) if conf else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected ID=CLASSES[:CONF], got {!r}".format(value))
+
+def parse_classes(value):
+    # comma separated class names, 'all' keeps every class
+    return None if value == 'all' else [name for name in value.split(',') if name]
+
+def main():
+    parser = argparse.ArgumentParser(description="vision server for the Unity camera streams")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5500)
+    parser.add_argument('--mode', choices=['threads', 'async'], default='threads',
+                        help="threads: one thread per camera, async: every camera on one event loop")
+    parser.add_argument('--max-connections', type=int, default=32,
+                        help="cameras accepted at the same time in async mode")
+    parser.add_argument('--detector', choices=sorted(BACKENDS), default='ultralytics',
+                        help="ultralytics: PyTorch model, onnx: exported model on ONNX Runtime, "
+                             "fake: deterministic boxes without a model")
+    parser.add_argument('--weights', help="model file, yolov8s.pt or yolov8s.onnx by default")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="ONNX Runtime threads per detector, 0 lets the runtime pick")
+    parser.add_argument('--fake-cost', type=float, default=0,
+                        help="milliseconds the fake detector takes per frame")
+    parser.add_argument('--warmup', type=int, default=2,
+                        help="passes on gray frames before the model takes camera frames")
+    parser.add_argument('--warmup-size', default='1280x720', help="size of the warm-up frames, WIDTHxHEIGHT")
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="frames from different cameras run through the model in one pass")
+    parser.add_argument('--max-wait', type=float, default=10,
+                        help="milliseconds a frame waits for the batch to fill up")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="worker processes with their own model fed through shared memory, "
+                             "0 runs the model in this process")
+    parser.add_argument('--decode-threads', type=int, default=2,
+                        help="threads decoding the jpg frames")
+    parser.add_argument('--full-decode', action='store_true',
+                        help="always decode at full resolution, by default big frames are decoded at 1/2 or 1/4")
+    parser.add_argument('--drop-policy', choices=['latest', 'fifo', 'nth'], default='latest',
+                        help="latest: only the newest frame waits for inference, fifo: up to --slot-size frames in order, "
+                             "nth: only every --every frames")
+    parser.add_argument('--slot-size', type=int, default=4, help="frames kept per camera with the fifo policy")
+    parser.add_argument('--every', type=int, default=2, help="frames skipped per camera with the nth policy")
+    parser.add_argument('--tracker', choices=['bytetrack', 'botsort', 'none'], default='bytetrack',
+                        help="tracker used for every camera")
+    parser.add_argument('--max-streams', type=int, default=64,
+                        help="tracker contexts kept in memory, the least recently used are dropped")
+    parser.add_argument('--motion-gate', action='store_true',
+                        help="reuse the last detections of a camera while nothing moves in front of it")
+    parser.add_argument('--motion-threshold', type=int, default=25,
+                        help="gray levels a pixel has to change to count as motion")
+    parser.add_argument('--motion-area', type=float, default=0.002,
+                        help="fraction of the frame that has to change to run the detector")
+    parser.add_argument('--motion-refresh', type=int, default=30,
+                        help="the detector runs at least once every this many frames")
+    parser.add_argument('--motion-crop', action='store_true',
+                        help="run the detector only on the region that changed")
+    parser.add_argument('--detect-every', type=int, default=0,
+                        help="run the detector at most every this many frames per camera and follow the "
+                             "boxes with optical flow in between, 0 detects on every frame")
+    parser.add_argument('--max-drift', type=float, default=0.1,
+                        help="detect sooner when the boxes would move more than this fraction of their size")
+    parser.add_argument('--scene-change', type=float, default=25,
+                        help="mean gray level change between frames that forces a detection")
+    parser.add_argument('--tile', type=int, default=0,
+                        help="run the detector on overlapping tiles of this size for frames bigger than it, "
+                             "0 disables tiling")
+    parser.add_argument('--tile-overlap', type=float, default=0.2, help="fraction of a tile shared with its neighbours")
+    parser.add_argument('--tile-camera', type=tile_camera, action='append', default=[], metavar='ID=SIZE[:OVERLAP]',
+                        help="tile size and overlap of one camera, repeatable, a size of 0 disables tiling for it")
+    parser.add_argument('--tiles-only', action='store_true',
+                        help="don't run the whole frame next to the tiles, objects bigger than a tile may be split")
+    parser.add_argument('--classes', type=parse_classes, default=None,
+                        help="comma separated class names the cameras get, all of them by default")
+    parser.add_argument('--min-conf', type=float, default=0.0,
+                        help="detections below this confidence are dropped, on top of the detector's own threshold")
+    parser.add_argument('--camera-filter', type=camera_filter, action='append', default=[],
+                        metavar='ID=CLASSES[:CONF]',
+                        help="classes ('all' for every class) and confidence of one camera, repeatable")
+    parser.add_argument('--cascade', action='store_true',
+                        help="run a cheap detector first and the full one only on the frames where it found "
+                             "a class the camera wants")
+    parser.add_argument('--cascade-weights', help="model file of the cheap detector, the same as --weights by default")
+    parser.add_argument('--cascade-size', type=int, default=320, help="input size of the cheap detector")
+    parser.add_argument('--cascade-trigger', type=float, default=0.15,
+                        help="confidence of the cheap detector that runs the full one")
+    parser.add_argument('--cascade-no-crop', action='store_true',
+                        help="run the full detector on the whole frame, by default only on the region around "
+                             "what the cheap one found when it is small enough")
+    parser.add_argument('--record', help="append every received frame to this recording "
+                                         "(PATH.frames, PATH.index, PATH.cameras.json)")
+    parser.add_argument('--agents', help="run the security agents of this file in the server and feed them what "
+                                         "the cameras see, pruebas/Multiagent.py or Security_AgentPy.py")
+    parser.add_argument('--calibration', help="json with the grid position and the homography of each camera, "
+                                              "see perception.py")
+    parser.add_argument('--perception-confidence', type=float, default=0.4,
+                        help="detections below this confidence are not passed to the agents")
+    parser.add_argument('--video-dir', help="write annotated video of the recorded cameras to this directory, "
+                                            "cameras are switched on and off from the viewer")
+    parser.add_argument('--video-cameras', default='',
+                        help="cameras recorded from the start, comma separated ids or 'all'")
+    parser.add_argument('--video-segment', type=float, default=300, help="seconds of video per file")
+    parser.add_argument('--video-fps', type=float, default=15, help="frame rate written to the video files")
+    parser.add_argument('--video-codec', default='mp4v', help="fourcc of the video files")
+    parser.add_argument('--video-queue', type=int, default=64,
+                        help="frames waiting to be written, newer frames are dropped when it is full")
+    parser.add_argument('--replay', help="run a recording through the pipeline instead of listening")
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help="1 replays with the original timing, 0 as fast as the pipeline takes frames")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve the stage timings in Prometheus format on http://host:port/metrics")
+    parser.add_argument('--metrics-interval', type=float, default=10,
+                        help="seconds between the stage timing summaries in the log, 0 disables them")
+    parser.add_argument('--log-frames', action='store_true',
+                        help="log every frame and every recv fragment at debug level, costly at high frame rates")
+    parser.add_argument('--headless', action='store_true',
+                        help="no window, detections are only sent back to the cameras that ask for them")
+    parser.add_argument('--viewer-port', type=int, default=0,
+                        help="serve the annotated frames as mjpeg on this port, only drawn while a browser watches")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("main").info("import: {:.2f} s".format(imported - started))
+
+    global metrics, log_frames
+    metrics = StageMetrics(args.metrics_interval)
+    if args.metrics_interval > 0:
+        metrics.start()
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = MetricsServer(metrics, args.host, args.metrics_port)
+        metrics_server.start()
+
+    log_frames = args.log_frames
+    if log_frames:
+        logging.getLogger("handle_socket_client").setLevel(logging.DEBUG)
+
+    global gate
+    if args.motion_gate:
+        gate = MotionGate(args.motion_threshold, args.motion_area, args.motion_refresh, args.motion_crop)
+
+    global tiles
+    if args.tile or args.tile_camera:
+        cameras = {camera_id: (size, args.tile_overlap if overlap is None else overlap)
+                   for camera_id, size, overlap in args.tile_camera}
+        tiles = TiledInference(args.tile, args.tile_overlap, cameras, full_frame=not args.tiles_only)
+
+    global filters, cascade
+    cameras = {camera_id: (classes, args.min_conf if conf is None else conf)
+               for camera_id, classes, conf in args.camera_filter}
+    filters = CameraFilters(args.classes, args.min_conf, cameras)
+    if args.cascade:
+        cascade = Cascade(filters, args.cascade_trigger, crop=not args.cascade_no_crop)
+
+    global keyframes
+    if args.detect_every > 0:
+        keyframes = KeyframeTracker(args.detect_every, args.max_drift, args.scene_change)
+
+    global decoder
+    decoder = DecodeStage(args.decode_threads, reduce=not args.full_decode)
+
+    slot_options.update(policy=args.drop_policy, capacity=args.slot_size, every=args.every)
+
+    global trackers
+    if args.tracker != 'none' and not tracker_available():
+        logging.getLogger("main").warning("--tracker {} needs ultralytics, running with --tracker none".format(args.tracker))
+    elif args.tracker != 'none':
+        trackers = TrackerPool(args.tracker, max_streams=args.max_streams)
+
+    global perception
+    if args.agents:
+        calibrations, class_codes, grid_size = {}, None, GRID_SIZE
+        if args.calibration:
+            calibrations, class_codes, grid_size = load_calibration(args.calibration)
+        perception = PerceptionBridge(load_agents(args.agents), calibrations, class_codes, grid_size,
+                                      args.perception_confidence)
+        perception.start()
+
+    global video
+    if args.video_dir:
+        cameras = [camera_id for camera_id in args.video_cameras.split(',') if camera_id and camera_id != 'all']
+        video = VideoRecorder(args.video_dir, args.video_segment, args.video_fps, args.video_codec, args.video_queue,
+                              all_cameras=args.video_cameras == 'all', cameras=cameras)
+        video.start()
+
+    global headless, viewer
+    headless = args.headless
+    if args.viewer_port:
+        viewer = FrameViewer(args.host, args.viewer_port, ready=ready, recorder=video)
+        viewer.start()
+
+    detector_options = {}
+    if args.weights:
+        detector_options['weights'] = args.weights
+    if args.detector == 'onnx':
+        detector_options['threads'] = args.threads
+    if args.detector == 'fake':
+        detector_options['cost'] = args.fake_cost / 1000
+    # the classes no camera wants are dropped inside the detector, before nms
+    detector_options['classes'] = filters.union()
+
+    width, height = map(int, args.warmup_size.split('x'))
+    warmup_shape = (height, width, 3)
+
+    # the model loads and warms up in the background while the listener
+    # already accepts cameras. one forward pass for the newest frames of
+    # several cameras, tracking happens afterwards per camera (see trackers.TrackerPool)
+    build_detector = partial(make_detector, args.detector, **detector_options)
+    global scheduler, model_loader
+    if args.workers > 0:
+        scheduler = model_loader = InferencePool(partial(warmed_up_detector, build_detector, args.warmup, warmup_shape),
+                                                 workers=args.workers, prepare=inference_ready)
+        scheduler.start()
+    else:
+        model_loader = ModelLoader(build_detector, args.warmup, warmup_shape, args.batch_size,
+                                   prepare=partial(start_batch_scheduler, args.batch_size, args.max_wait / 1000))
+        model_loader.start()
+
+    if cascade is not None:
+        cheap_options = dict(detector_options)
+        if args.detector == 'fake':
+            # cost of a model with a cascade_size input
+            cheap_options['cost'] = detector_options['cost'] * (args.cascade_size / 640) ** 2
+        else:
+            cheap_options['imgsz'] = args.cascade_size
+            if args.cascade_weights:
+                cheap_options['weights'] = args.cascade_weights
+        cheap_loader = ModelLoader(partial(make_detector, args.detector, **cheap_options), args.warmup, warmup_shape,
+                                   args.batch_size, prepare=partial(start_cheap_scheduler, args.batch_size,
+                                                                    args.max_wait / 1000, args.cascade_size))
+        cheap_loader.start()
+
+    global recorder
+    if args.record:
+        recorder = FrameRecorder(args.record)
+
+    replayed = True
+    if args.replay:
+        replayed = run_replay(args)
+    elif args.mode == 'async':
+        run_async(args)
+    else:
+        run_threads(args)
+
+    # the frames since the last summary
+    if args.metrics_interval > 0:
+        metrics.report()
+
+    if recorder is not None:
+        recorder.close()
+        logging.getLogger("main").info("recorded {} frames to {}".format(recorder.frames, args.record))
+
+    if video is not None:
+        video.stop()
+    if perception is not None:
+        perception.stop()
+
+    if scheduler is not None:
+        scheduler.stop()
+    if cascade is not None:
+        cascade.stop()
+    if cheap_scheduler is not None:
+        cheap_scheduler.stop()
+    decoder.shutdown()
+    logging.getLogger("main").info(decoder.summary())
+    if viewer is not None:
+        viewer.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+
+    if not replayed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
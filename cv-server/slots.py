@@ -0,0 +1,142 @@
+import asyncio
+import time
+from collections import deque
+from threading import Condition
+
+# what happens when frames arrive faster than the detector consumes them
+#   latest: keep only the newest frame, older ones are dropped
+#   fifo:   keep up to `capacity` frames in order, the oldest is dropped when full
+#   nth:    only every `every` frames is considered, the newest of those is kept
+POLICIES = ('latest', 'fifo', 'nth')
+
+
+class FrameSlot:
+    # per camera hand off between the socket reader and the inference stage.
+    # put never blocks, so the reader keeps draining the socket and the
+    # detection latency stays bounded by the slot size instead of the kernel
+    # buffers. on_drop(item) is called for every item the policy drops
+    def __init__(self, policy='latest', capacity=4, every=2, on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError("unknown drop policy: {}".format(policy))
+
+        self.policy = policy
+        self.capacity = capacity if policy == 'fifo' else 1
+        self.every = every if policy == 'nth' else 1
+        self.on_drop = on_drop
+
+        self.items = deque()
+        self.closed = False
+        self.condition = Condition()
+
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.wait_total = 0.0
+
+    def offer(self, item):
+        # applies the drop policy, returns False if the item was dropped
+        self.received += 1
+
+        if (self.received - 1) % self.every:
+            self.drop(item)
+            return False
+
+        if len(self.items) >= self.capacity:
+            self.drop(self.items.popleft()[0])
+
+        self.items.append((item, time.perf_counter()))
+        return True
+
+    def drop(self, item):
+        self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    def take(self):
+        if not self.items:
+            return None
+
+        item, arrival = self.items.popleft()
+        self.wait_total += time.perf_counter() - arrival
+        return item
+
+    def put(self, item):
+        with self.condition:
+            accepted = self.offer(item)
+            self.condition.notify()
+        return accepted
+
+    def get(self, timeout=None):
+        # returns the next item, or None when the slot was closed or the timeout expired
+        with self.condition:
+            while not self.closed and not self.items:
+                if not self.condition.wait(timeout):
+                    return None
+
+            if self.closed:
+                return None
+
+            item = self.take()
+            # wakes a producer waiting for room
+            self.condition.notify_all()
+            return item
+
+    def wait_room(self):
+        # blocks while the slot is full, for producers that must not drop frames
+        with self.condition:
+            while not self.closed and len(self.items) >= self.capacity:
+                self.condition.wait()
+
+    def wait_empty(self):
+        with self.condition:
+            while not self.closed and self.items:
+                self.condition.wait()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def mark_processed(self):
+        self.processed += 1
+
+    def counters(self):
+        return {
+            'received': self.received,
+            'dropped': self.dropped,
+            'processed': self.processed,
+        }
+
+    def summary(self):
+        taken = self.received - self.dropped - len(self.items)
+        wait = self.wait_total / taken if taken else 0.0
+        return "received: {} dropped: {} processed: {} slot wait avg: {:.1f} ms ({})".format(
+            self.received, self.dropped, self.processed, wait * 1000, self.policy)
+
+
+class AsyncFrameSlot(FrameSlot):
+    # same policies for readers and consumers running on one event loop
+    def __init__(self, policy='latest', capacity=4, every=2, on_drop=None):
+        super().__init__(policy, capacity, every, on_drop)
+        self.event = asyncio.Event()
+
+    def put(self, item):
+        accepted = self.offer(item)
+        self.event.set()
+        return accepted
+
+    async def get(self):
+        while True:
+            if self.closed:
+                return None
+
+            item = self.take()
+            if item is not None:
+                return item
+
+            self.event.clear()
+            await self.event.wait()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
@@ -0,0 +1,177 @@
+import logging
+import math
+import time
+from threading import Lock
+
+import numpy as np
+
+from detections import CLS, CONF, X1, X2, Y1, Y2
+from inference import chain, gather
+
+# a box is the same object as a better one of the same class when this much
+# of the smaller of the two is covered by the other. intersection over the
+# smaller box rather than iou, an object cut by a tile border leaves a piece
+# of a box inside the full one
+MERGE_THRESHOLD = 0.6
+
+
+class CameraTiles:
+    def __init__(self, tile, overlap):
+        self.tile = tile
+        self.overlap = overlap
+
+        self.frames = 0
+        self.tiles = 0
+        self.merged = 0
+
+
+class TiledInference:
+    # runs the detector on overlapping tiles of the frames bigger than a tile,
+    # so small objects are seen at their native resolution instead of shrunk
+    # with the whole frame to the model input. every tile goes to the
+    # inference stage on its own, keyed (camera_id, tile number): the batch
+    # scheduler runs the tiles of a frame in one forward pass when
+    # --batch-size allows it, the worker pool spreads them over its processes.
+    # with full_frame the whole frame is run as well for the objects bigger
+    # than a tile. the boxes are moved to frame coordinates and the
+    # duplicates of neighbouring tiles merged. tile size and overlap are per
+    # camera, cameras maps a camera id to its (tile, overlap), every other
+    # camera gets the defaults. a tile of 0 disables tiling for that camera
+    def __init__(self, tile=640, overlap=0.2, cameras=None, full_frame=True, report_interval=10.0):
+        self.tile = tile
+        self.overlap = overlap
+        self.camera_options = dict(cameras or {})
+        self.full_frame = full_frame
+        self.report_interval = report_interval
+
+        self.logger = logging.getLogger("tiles")
+        self.cameras = {}
+        self.lock = Lock()
+        self.last_report = time.perf_counter()
+
+    def tiled(self, camera_id):
+        return self.camera_options.get(camera_id, (self.tile, self.overlap))[0] > 0
+
+    def get(self, camera_id):
+        with self.lock:
+            camera = self.cameras.get(camera_id)
+            if camera is None:
+                tile, overlap = self.camera_options.get(camera_id, (self.tile, self.overlap))
+                camera = self.cameras[camera_id] = CameraTiles(tile, overlap)
+            return camera
+
+    def reset(self, camera_id):
+        with self.lock:
+            camera = self.cameras.pop(camera_id, None)
+        if camera is not None and camera.frames:
+            self.logger.info("camera {} {}".format(camera_id, self.summary([camera])))
+
+    def submit(self, camera_id, img, submit_frame):
+        # same interface as the inference stage, submit_frame(key, img) is
+        # called once per tile
+        camera = self.get(camera_id)
+        camera.frames += 1
+        self.report()
+
+        regions = tile_regions(img.shape, camera.tile, camera.overlap)
+        if len(regions) == 1:
+            return submit_frame(camera_id, img)
+
+        if self.full_frame:
+            regions.append((0, 0, img.shape[1], img.shape[0]))
+        camera.tiles += len(regions)
+
+        futures = []
+        for i, (x0, y0, x1, y1) in enumerate(regions):
+            futures.append(submit_frame((camera_id, i), np.ascontiguousarray(img[y0:y1, x0:x1])))
+        return self.gather(futures, regions, camera)
+
+    def gather(self, futures, regions, camera):
+        # one Future with the merged detections of every tile
+        def merge(tiles):
+            counts = [len(dets) for dets in tiles]
+            offsets = np.repeat(np.array(regions, np.float32)[:, :2], counts, axis=0)
+            dets = np.concatenate(tiles)
+            dets[:, [X1, X2]] += offsets[:, :1]
+            dets[:, [Y1, Y2]] += offsets[:, 1:]
+            merged = merge_boxes(dets)
+            camera.merged += len(dets) - len(merged)
+            return merged
+
+        return chain(gather(futures), merge)
+
+    def report(self):
+        now = time.perf_counter()
+        if now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+
+        with self.lock:
+            cameras = list(self.cameras.values())
+        self.logger.info(self.summary(cameras))
+
+    def summary(self, cameras):
+        frames = sum(camera.frames for camera in cameras)
+        tiles = sum(camera.tiles for camera in cameras)
+        merged = sum(camera.merged for camera in cameras)
+        return "tiles: frames: {} tiles: {} ({:.1f} per frame) merged boxes: {}".format(
+            frames, tiles, tiles / frames if frames else 0.0, merged)
+
+
+def tile_regions(shape, tile, overlap):
+    # x0, y0, x1, y1 of tiles covering the frame, evenly spread so they
+    # overlap at least overlap of a tile. the frame itself when it fits in one
+    height, width = shape[:2]
+    if not tile or (width <= tile and height <= tile):
+        return [(0, 0, width, height)]
+
+    stride = max(1, int(tile * (1 - overlap)))
+    xs = starts(width, tile, stride)
+    ys = starts(height, tile, stride)
+    return [(x, y, min(x + tile, width), min(y + tile, height)) for y in ys for x in xs]
+
+
+def starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - tile) / stride) + 1
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def merge_boxes(dets, threshold=MERGE_THRESHOLD):
+    # greedy non maximum merging across tiles: the most confident box of a
+    # class absorbs the boxes it covers, growing to their union so an object
+    # split between tiles ends up with one whole box
+    if len(dets) < 2:
+        return dets
+
+    dets = dets[np.argsort(-dets[:, CONF], kind='stable')]
+    areas = (dets[:, X2] - dets[:, X1]) * (dets[:, Y2] - dets[:, Y1])
+    alive = np.ones(len(dets), bool)
+    keep = []
+
+    for i in range(len(dets)):
+        if not alive[i]:
+            continue
+        alive[i] = False
+        keep.append(i)
+
+        candidates = np.flatnonzero(alive & (dets[:, CLS] == dets[i, CLS]))
+        if not len(candidates):
+            continue
+
+        others = dets[candidates]
+        width = np.minimum(dets[i, X2], others[:, X2]) - np.maximum(dets[i, X1], others[:, X1])
+        height = np.minimum(dets[i, Y2], others[:, Y2]) - np.maximum(dets[i, Y1], others[:, Y1])
+        intersection = width.clip(0) * height.clip(0)
+        smaller = np.minimum(areas[i], areas[candidates]).clip(1e-6)
+        covered = candidates[intersection / smaller > threshold]
+        if not len(covered):
+            continue
+
+        dets[i, [X1, Y1]] = np.minimum(dets[i, [X1, Y1]], dets[covered][:, [X1, Y1]].min(0))
+        dets[i, [X2, Y2]] = np.maximum(dets[i, [X2, Y2]], dets[covered][:, [X2, Y2]].max(0))
+        areas[i] = (dets[i, X2] - dets[i, X1]) * (dets[i, Y2] - dets[i, Y1])
+        alive[covered] = False
+
+    return dets[keep]
@@ -0,0 +1,137 @@
+import importlib
+import importlib.util
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+import detections
+from detections import CLS, CONF, TRACK_ID, X1, Y2
+
+# the trackers of ultralytics, imported with the first tracker so importing
+# this module does not pull torch in
+TRACKERS = {
+    'bytetrack': ('ultralytics.trackers.byte_tracker', 'BYTETracker'),
+    'botsort': ('ultralytics.trackers.bot_sort', 'BOTSORT'),
+}
+
+
+def tracker_available():
+    # the trackers come with ultralytics, found without importing it
+    return importlib.util.find_spec('ultralytics') is not None
+
+
+def make_tracker(name='bytetrack'):
+    # same trackers and settings model.track() uses
+    import yaml
+    from ultralytics.utils import IterableSimpleNamespace
+    from ultralytics.utils.checks import check_yaml
+
+    module, cls = TRACKERS[name]
+    tracker_class = getattr(importlib.import_module(module), cls)
+
+    with open(check_yaml('{}.yaml'.format(name))) as f:
+        cfg = IterableSimpleNamespace(**yaml.safe_load(f))
+    return tracker_class(args=cfg)
+
+
+class TrackerInput:
+    # the attributes of ultralytics Boxes the trackers read, over a detections array
+    def __init__(self, dets):
+        self.dets = dets
+
+    def __len__(self):
+        return len(self.dets)
+
+    def __getitem__(self, index):
+        return TrackerInput(self.dets[index])
+
+    @property
+    def conf(self):
+        return self.dets[:, CONF]
+
+    @property
+    def cls(self):
+        return self.dets[:, CLS]
+
+    @property
+    def xyxy(self):
+        return self.dets[:, X1:Y2 + 1]
+
+    @property
+    def xywh(self):
+        xywh = self.xyxy.copy()
+        xywh[:, 2] -= xywh[:, 0]
+        xywh[:, 3] -= xywh[:, 1]
+        xywh[:, 0] += xywh[:, 2] / 2
+        xywh[:, 1] += xywh[:, 3] / 2
+        return xywh
+
+
+class TrackerContext:
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.lock = Lock()
+        self.last_used = time.monotonic()
+
+
+class TrackerPool:
+    # one tracker per camera instead of the single tracker persisted inside
+    # the model, so frames of different cameras never mix their track ids and
+    # detection can run for several streams at once. contexts idle for more
+    # than idle_timeout seconds or past max_streams (least recently used
+    # first) are dropped to cap memory
+    def __init__(self, name='bytetrack', max_streams=64, idle_timeout=60.0):
+        self.name = name
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+
+        self.contexts = OrderedDict()
+        self.lock = Lock()
+        self.evicted = 0
+
+    def get(self, camera_id):
+        now = time.monotonic()
+
+        with self.lock:
+            context = self.contexts.pop(camera_id, None)
+            if context is None:
+                context = TrackerContext(make_tracker(self.name))
+            context.last_used = now
+            self.contexts[camera_id] = context
+
+            # the least recently used contexts are at the front
+            while self.contexts:
+                oldest_id, oldest = next(iter(self.contexts.items()))
+                if len(self.contexts) <= self.max_streams and now - oldest.last_used <= self.idle_timeout:
+                    break
+                del self.contexts[oldest_id]
+                self.evicted += 1
+
+            return context
+
+    def update(self, camera_id, dets, img):
+        # returns the tracked detections of this frame with their track ids
+        context = self.get(camera_id)
+
+        # different cameras update concurrently, frames of one camera in order
+        with context.lock:
+            tracks = context.tracker.update(TrackerInput(dets), img)
+
+        if len(tracks) == 0:
+            return detections.empty()
+
+        # tracker rows: x1, y1, x2, y2, track id, score, class, detection index
+        tracks = np.asarray(tracks, np.float32)
+        tracked = np.empty((len(tracks), detections.COLUMNS), np.float32)
+        tracked[:, X1:Y2 + 1] = tracks[:, 0:4]
+        tracked[:, TRACK_ID] = tracks[:, 4]
+        tracked[:, CONF] = tracks[:, 5]
+        tracked[:, CLS] = tracks[:, 6]
+        return tracked
+
+    def reset(self, camera_id):
+        # the stream is gone, its tracks won't continue
+        with self.lock:
+            self.contexts.pop(camera_id, None)
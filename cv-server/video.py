@@ -0,0 +1,164 @@
+import logging
+import os
+import queue
+import re
+import time
+from threading import Lock, Thread
+
+import cv2
+
+import detections
+
+STOP = None
+
+
+class Segment:
+    def __init__(self, writer, path, size):
+        self.writer = writer
+        self.path = path
+        self.size = size
+        self.started = time.monotonic()
+        self.frames = 0
+
+
+class VideoRecorder:
+    # writes the annotated frames of the cameras being recorded to video
+    # files, one file per camera every segment seconds. the pipeline only
+    # offers the decoded image and its detections, drawing and encoding run on
+    # the recorder thread (cv2 releases the GIL for both). the queue between
+    # them is bounded, when the recorder falls behind new frames are dropped
+    # instead of holding up inference. which cameras are recorded can change at
+    # any time with switch(), every camera by default with all_cameras
+    def __init__(self, directory, segment=300.0, fps=15.0, codec='mp4v', queue_size=64,
+                 all_cameras=False, cameras=()):
+        self.directory = directory
+        self.segment = segment
+        self.fps = fps
+        self.codec = codec
+        self.queue = queue.Queue(queue_size)
+
+        self.logger = logging.getLogger("video")
+        self.lock = Lock()
+        self.all_cameras = all_cameras
+        self.switched = {str(camera_id): True for camera_id in cameras}
+        self.segments = {}
+        self.thread = None
+
+        self.written = 0
+        self.dropped = 0
+        self.files = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = Thread(target=self.run, name="video", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # waits for the queued frames, closes every file
+        self.queue.put(STOP)
+        self.thread.join()
+        self.logger.info("video: {} frames written to {} files, {} dropped".format(
+            self.written, self.files, self.dropped))
+
+    def recording(self, camera_id):
+        with self.lock:
+            return self.switched.get(str(camera_id), self.all_cameras)
+
+    def switch(self, camera_id, on):
+        # the open file of a camera switched off is closed by the recorder thread
+        with self.lock:
+            self.switched[str(camera_id)] = on
+        self.logger.info("{} camera {}".format("recording" if on else "stopped recording", camera_id))
+
+    def status(self):
+        # camera id to True while recording, for the cameras switched at runtime
+        with self.lock:
+            return dict(self.switched)
+
+    def offer(self, camera_id, img, dets, names):
+        # never blocks, the frame is dropped when the queue is full. every
+        # decoded image is a new array, the queue can hold it as it is
+        try:
+            self.queue.put_nowait((str(camera_id), img, dets, names))
+        except queue.Full:
+            self.dropped += 1
+
+    def forget(self, camera_id):
+        # the camera disconnected, its file is closed once the queue gets to it
+        try:
+            self.queue.put_nowait((str(camera_id), None, None, None))
+        except queue.Full:
+            # closed anyway when its segment ends or the recorder stops
+            pass
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                item = ()
+
+            if item is STOP:
+                break
+            if item:
+                camera_id, img, dets, names = item
+                if img is None:
+                    self.close(camera_id)
+                else:
+                    self.write(camera_id, img, dets, names)
+
+            # cameras switched off, and segments of cameras that stopped sending
+            for camera_id, segment in list(self.segments.items()):
+                if not self.recording(camera_id) or time.monotonic() - segment.started >= self.segment:
+                    self.close(camera_id)
+
+        for camera_id in list(self.segments):
+            self.close(camera_id)
+
+    def write(self, camera_id, img, dets, names):
+        if not self.recording(camera_id):
+            # switched off while the frame was queued
+            return
+
+        segment = self.segments.get(camera_id)
+        size = (img.shape[1], img.shape[0])
+        if segment is not None and (segment.size != size or time.monotonic() - segment.started >= self.segment):
+            self.close(camera_id)
+            segment = None
+
+        if segment is None:
+            segment = self.open(camera_id, size)
+            if segment is None:
+                return
+
+        segment.writer.write(detections.draw(img, dets, names))
+        segment.frames += 1
+        self.written += 1
+
+    def open(self, camera_id, size):
+        # legacy cameras are named after their address
+        name = "camera-{}-{}".format(re.sub(r'[^\w.-]+', '_', camera_id).strip('_'), time.strftime("%Y%m%d-%H%M%S"))
+        path = os.path.join(self.directory, name + '.mp4')
+        number = 1
+        while os.path.exists(path):
+            # a new segment in the same second, the frame size changed
+            number += 1
+            path = os.path.join(self.directory, "{}-{}.mp4".format(name, number))
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.codec), self.fps, size)
+        if not writer.isOpened():
+            self.logger.error("can't write {} with codec {}, camera {} is not recorded".format(
+                path, self.codec, camera_id))
+            self.switch(camera_id, False)
+            return None
+
+        segment = self.segments[camera_id] = Segment(writer, path, size)
+        self.files += 1
+        return segment
+
+    def close(self, camera_id):
+        segment = self.segments.pop(camera_id, None)
+        if segment is None:
+            return
+
+        segment.writer.release()
+        self.logger.info("camera {}: {} frames in {}".format(camera_id, segment.frames, segment.path))
@@ -0,0 +1,183 @@
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Thread
+
+import cv2
+
+BOUNDARY = 'frame'
+
+
+class FrameViewer:
+    # annotated frames as an mjpeg stream per camera over http, open
+    # http://host:port/ in a browser. the pipeline asks watching() before
+    # drawing, so frames are only annotated and encoded while a browser is
+    # connected to that camera. GET /ready answers 200 once the ready event
+    # is set, 503 before. with a video.VideoRecorder, POST /record/<camera>/on
+    # and /record/<camera>/off switch the recording of a camera, the index
+    # has a button for each
+    def __init__(self, host='127.0.0.1', port=8080, quality=80, ready=None, recorder=None):
+        self.host = host
+        self.port = port
+        self.quality = quality
+        self.ready = ready
+        self.recorder = recorder
+
+        self.logger = logging.getLogger("viewer")
+
+        self.condition = Condition()
+        self.watchers = {}
+        self.latest = {}
+        self.cameras = set()
+        self.closed = False
+
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        # the handler class is instantiated per request, it reaches the viewer through a class attribute
+        handler = type('Handler', (ViewerHandler,), {'viewer': self})
+
+        self.server = ThreadingHTTPServer((self.host, self.port), handler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, name="viewer", daemon=True)
+        self.thread.start()
+        self.logger.info("viewer on http://{}:{}/".format(self.host, self.port))
+
+    def stop(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def watching(self, camera_id):
+        camera_id = str(camera_id)
+        with self.condition:
+            self.cameras.add(camera_id)
+            return self.watchers.get(camera_id, 0) > 0
+
+    def publish(self, camera_id, annotated):
+        ok, jpeg = cv2.imencode('.jpg', annotated, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return
+
+        with self.condition:
+            self.latest[str(camera_id)] = jpeg.tobytes()
+            self.condition.notify_all()
+
+    def forget(self, camera_id):
+        # the camera disconnected
+        with self.condition:
+            self.cameras.discard(str(camera_id))
+            self.latest.pop(str(camera_id), None)
+
+    def subscribe(self, camera_id):
+        with self.condition:
+            self.watchers[camera_id] = self.watchers.get(camera_id, 0) + 1
+
+    def unsubscribe(self, camera_id):
+        with self.condition:
+            self.watchers[camera_id] -= 1
+            if not self.watchers[camera_id]:
+                del self.watchers[camera_id]
+                self.latest.pop(camera_id, None)
+
+    def next_frame(self, camera_id, last, timeout=1.0):
+        # waits for a frame newer than `last`, None when the viewer stops
+        with self.condition:
+            while not self.closed:
+                jpeg = self.latest.get(camera_id)
+                if jpeg is not None and jpeg is not last:
+                    return jpeg
+                self.condition.wait(timeout)
+            return None
+
+
+class ViewerHandler(BaseHTTPRequestHandler):
+    viewer = None
+
+    def log_message(self, format, *args):
+        self.viewer.logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path == '/':
+            self.send_index()
+        elif self.path == '/ready':
+            self.send_ready()
+        elif self.path.startswith('/camera/'):
+            self.send_stream(self.path[len('/camera/'):])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        recorder = self.viewer.recorder
+        if recorder is None or len(parts) != 3 or parts[0] != 'record' or parts[2] not in ('on', 'off'):
+            self.send_error(404)
+            return
+
+        recorder.switch(parts[1], parts[2] == 'on')
+
+        # back to the index, the form posts from there
+        self.send_response(303)
+        self.send_header('Location', '/')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_index(self):
+        with self.viewer.condition:
+            cameras = sorted(self.viewer.cameras)
+
+        links = ''.join('<li><a href="/camera/{0}">{0}</a>{1}</li>'.format(camera_id, self.record_button(camera_id))
+                        for camera_id in cameras)
+        body = '<html><body><h3>cameras</h3><ul>{}</ul></body></html>'.format(links).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def record_button(self, camera_id):
+        recorder = self.viewer.recorder
+        if recorder is None:
+            return ''
+
+        action, label = ('off', 'stop recording') if recorder.recording(camera_id) else ('on', 'record')
+        return ' <form style="display:inline" method="post" action="/record/{}/{}"><button>{}</button></form>'.format(
+            camera_id, action, label)
+
+    def send_ready(self):
+        ready = self.viewer.ready is None or self.viewer.ready.is_set()
+        body = b'ready\n' if ready else b'loading\n'
+
+        self.send_response(200 if ready else 503)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, camera_id):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary={}'.format(BOUNDARY))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        self.viewer.subscribe(camera_id)
+        try:
+            jpeg = None
+            while True:
+                jpeg = self.viewer.next_frame(camera_id, jpeg)
+                if jpeg is None:
+                    break
+
+                self.wfile.write('--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n'.format(
+                    BOUNDARY, len(jpeg)).encode())
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.viewer.unsubscribe(camera_id)
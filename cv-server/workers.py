@@ -0,0 +1,324 @@
+import itertools
+import logging
+import multiprocessing as mp
+import queue
+import signal
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+from threading import Event, Lock, Thread
+
+import numpy as np
+
+
+# biggest frame that fits in a ring slot, bigger frames are pickled through
+# the task queue instead
+DEFAULT_MAX_FRAME_SHAPE = (1080, 1920, 3)
+
+
+def worker_main(make_detector, index, shm_name, slot_bytes, tasks, results, current):
+    # ctrl+c reaches the whole process group, the parent stops the workers
+    # through the task queue once the clients are closed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        detect = make_detector()
+    except Exception as e:
+        # tells the pool this worker won't take frames
+        results.put((None, index, None, repr(e)))
+        return
+
+    shm = SharedMemory(name=shm_name)
+
+    # tells the pool this worker takes frames, with the class names of its model
+    results.put((None, index, getattr(detect, 'names', {}), None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        task_id, slot, shape, img = task
+        # the task this worker is on, failed by the pool if the worker dies on it
+        current[index] = task_id
+        if img is None:
+            # read the frame in place from the ring, no copy
+            img = np.ndarray(shape, np.uint8, buffer=shm.buf, offset=slot * slot_bytes)
+
+        try:
+            results.put((task_id, slot, detect(img), None))
+        except Exception as e:
+            results.put((task_id, slot, None, repr(e)))
+        current[index] = -1
+
+        # the array points into the shared memory, it must be gone before close()
+        img = None
+
+    shm.close()
+
+
+class FrameRing:
+    # shared memory split in fixed size slots, one decoded frame per slot.
+    # the ingest process owns it and hands out free slots, a slot goes back
+    # to the free list when the worker that used it sends its result
+    def __init__(self, slots, max_frame_shape=DEFAULT_MAX_FRAME_SHAPE):
+        self.slots = slots
+        self.slot_bytes = int(np.prod(max_frame_shape))
+        self.shm = SharedMemory(create=True, size=self.slots * self.slot_bytes)
+
+        self.free = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def fits(self, img):
+        return img.dtype == np.uint8 and img.nbytes <= self.slot_bytes
+
+    def write(self, slot, img):
+        view = np.ndarray(img.shape, np.uint8, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+        view[...] = img
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class InferencePool:
+    # N worker processes, each with its own model, so inference is not capped
+    # at one core by the GIL. same submit() interface as inference.BatchScheduler.
+    # ready is set once every worker that could build its model reported in,
+    # prepare(names) runs right before, failed when none could. a worker that dies fails the frame it
+    # was on, once none is left every frame fails
+    def __init__(self, make_detector, workers=2, slots=None, max_frame_shape=DEFAULT_MAX_FRAME_SHAPE,
+                 report_interval=10.0, prepare=None, poll_interval=0.5):
+        # make_detector must be picklable, it is called once inside each worker
+        # and returns a callable from an image to its detections array, like
+        # partial(detectors.make_detector, 'onnx'). every worker holds its own model
+        self.make_detector = make_detector
+        self.workers = workers
+        self.ring = FrameRing(slots or 2 * workers, max_frame_shape)
+        self.report_interval = report_interval
+        self.prepare = prepare
+        # seconds the collector waits for a result before it looks for dead workers
+        self.poll_interval = poll_interval
+
+        self.logger = logging.getLogger("inference_pool")
+
+        # spawn, forking a process that already loaded torch is not safe
+        self.context = mp.get_context('spawn')
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        self.processes = []
+        # task id each worker is on, -1 when it waits for one
+        self.current = self.context.Array('q', [-1] * workers, lock=False)
+
+        # task id to its (future, ring slot) until the result comes back
+        self.futures = {}
+        self.task_ids = itertools.count()
+        self.lock = Lock()
+        self.collector = None
+
+        self.frames = 0
+        self.oversized = 0
+
+        self.names = {}
+        self.ready = Event()
+        self.failed = Event()
+        self.ready_workers = 0
+        self.failed_workers = 0
+        # workers that sent their ready or error message
+        self.reported = set()
+        # workers still running, only the collector changes it
+        self.alive = set(range(workers))
+        self.stopping = False
+
+    def start(self):
+        self.started = time.perf_counter()
+        for index in range(self.workers):
+            process = self.context.Process(
+                target=worker_main,
+                args=(self.make_detector, index, self.ring.shm.name, self.ring.slot_bytes, self.tasks,
+                      self.results, self.current),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        self.collector = Thread(target=self.collect_results, name="inference_pool", daemon=True)
+        self.collector.start()
+
+    def stop(self):
+        # the workers exit from here on, that is not a crash
+        self.stopping = True
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+        self.results.put(None)
+        self.collector.join()
+
+        with self.lock:
+            for future, _ in self.futures.values():
+                future.cancel()
+            self.futures.clear()
+
+        self.ring.close()
+
+    def submit(self, camera_id, img):
+        # returns a Future with the detections array of this frame. blocks
+        # while every ring slot is in use, which bounds the frames in flight
+        future = Future()
+        future.set_running_or_notify_cancel()
+        if not self.alive:
+            future.set_exception(RuntimeError("no inference worker left"))
+            return future
+
+        slot = self.ring.free.get()
+        if self.ring.fits(img):
+            self.ring.write(slot, img)
+            task_img = None
+        else:
+            # too big for a slot, send a pickled copy instead
+            self.oversized += 1
+            task_img = img
+
+        task_id = next(self.task_ids)
+        with self.lock:
+            self.futures[task_id] = (future, slot)
+
+        self.tasks.put((task_id, slot, img.shape, task_img))
+        return future
+
+    def worker_ready(self, index, names):
+        self.reported.add(index)
+        self.names = names
+        self.ready_workers += 1
+        self.check_ready()
+
+    def worker_failed(self, index, error):
+        # the worker could not build its model and exited
+        self.logger.error("worker {} could not load the model: {}".format(index, error))
+        self.reported.add(index)
+        self.failed_workers += 1
+        self.alive.discard(index)
+        self.check_ready()
+
+    def check_ready(self):
+        if self.ready_workers + self.failed_workers < self.workers:
+            return
+
+        if not self.ready_workers:
+            self.logger.error("no worker could load the model, frames get no detections")
+            self.fail_all()
+            self.failed.set()
+            return
+
+        self.logger.info("{} workers ready: {:.2f} s".format(self.ready_workers, time.perf_counter() - self.started))
+        if self.prepare is not None:
+            self.prepare(self.names)
+        self.ready.set()
+
+    def finish(self, task_id, dets=None, error=None):
+        # resolves the future of a task and gives its slot back. a task is
+        # finished once, by its result or by the death of its worker
+        with self.lock:
+            entry = self.futures.pop(task_id, None)
+        if entry is None:
+            return
+
+        future, slot = entry
+        self.ring.free.put(slot)
+        if error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(dets)
+
+    def fail_all(self):
+        # no worker left to take the queued tasks, their slots are not coming back otherwise
+        with self.lock:
+            task_ids = list(self.futures)
+        for task_id in task_ids:
+            self.finish(task_id, error="no inference worker left")
+
+    def check_workers(self):
+        # fails the task of every worker that exited without being stopped
+        if self.stopping:
+            return
+        dead = wait([self.processes[index].sentinel for index in self.alive], timeout=0)
+        if not dead:
+            return
+
+        # results a worker sent before it died are still in the queue
+        self.drain_results()
+
+        for index in list(self.alive):
+            process = self.processes[index]
+            if process.sentinel not in dead:
+                continue
+
+            if index not in self.reported:
+                # died while building its model
+                self.worker_failed(index, "exit code {}".format(process.exitcode))
+                continue
+
+            self.alive.discard(index)
+            task_id = self.current[index]
+            self.logger.error("worker {} died with exit code {}{}".format(
+                index, process.exitcode, "" if task_id < 0 else " on task {}".format(task_id)))
+            if task_id >= 0:
+                self.finish(task_id, error="inference worker {} died".format(index))
+
+        if not self.alive:
+            self.logger.error("no inference worker left, frames get no detections")
+            self.fail_all()
+
+    def drain_results(self):
+        while True:
+            try:
+                item = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                # stop() is waiting, put it back for the main loop
+                self.results.put(None)
+                return
+            self.handle(item)
+
+    def handle(self, item):
+        task_id, slot, dets, error = item
+        if task_id is None:
+            # slot is the index of the worker reporting in
+            if error is not None:
+                self.worker_failed(slot, error)
+            else:
+                self.worker_ready(slot, dets)
+            return
+
+        self.finish(task_id, dets, error)
+        self.frames += 1
+
+    def collect_results(self):
+        last_report = time.perf_counter()
+        report_frames = 0
+
+        while True:
+            try:
+                item = self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+
+            if item:
+                self.handle(item)
+            if self.alive:
+                self.check_workers()
+
+            now = time.perf_counter()
+            if now - last_report >= self.report_interval:
+                elapsed = now - last_report
+                self.logger.info("inference: {:.1f} frames/s on {} workers, slots free: {}/{} oversized: {}".format(
+                    (self.frames - report_frames) / elapsed, len(self.alive),
+                    self.ring.free.qsize(), self.ring.slots, self.oversized))
+                last_report = now
+                report_frames = self.frames
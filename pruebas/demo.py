@@ -1,36 +1,224 @@
-from ultralytics import YOLO
-from os import path
+import argparse
+import json
+import multiprocessing as mp
+import queue
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import makedirs, path
+from threading import Thread
+
 import cv2
+import numpy as np
+
+# los detectores, el tracking y el dibujo son los mismos del servidor
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), '..', 'cv-server'))
+
+import detections
+from detectors import BACKENDS, make_detector
+from trackers import TrackerPool, tracker_available
+
+
+def detector_options(args):
+    options = {}
+    if args.weights:
+        options['weights'] = args.weights
+    if args.detector == 'onnx':
+        options['threads'] = args.threads
+    if args.detector == 'fake':
+        options['cost'] = args.fake_cost / 1000
+    return options
+
+
+def mostrar(args):
+    detector = make_detector(args.detector, **detector_options(args))
+    trackers = TrackerPool(args.tracker) if args.tracker != 'none' else None
+
+    # construir el path hacia el video de demo
+    video_path = path.join(args.video[0])
+
+    # abrir el video con opencv
+    cap = cv2.VideoCapture(video_path)
+
+    # revisamos si el video se abrio correctamente
+    while cap.isOpened():
+        # leemos un frame del video
+        ret, frame = cap.read()
+
+        # verificamos si el frame se leyo correctamente
+        if not ret:
+            break
+
+        # detectar objetos en el frame y seguirlos entre frames
+        dets = detector.detect(frame)
+        if trackers is not None:
+            dets = trackers.update(0, dets, frame)
+
+        # obtenemos el frame con los objetos detectados y ya graficados
+        # con su bounding box y etiqueta
+        annotated_frame = detections.draw(frame, dets, detector.names)
+
+        # display results
+        cv2.imshow('YOLOv8 Tracking', annotated_frame)
+
+        # si se presiona la tecla 'q' se cierra el video
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+
+def leer_frames(cap, frames):
+    # hilo lector: decodifica mientras el modelo corre sobre el lote anterior,
+    # la cola acotada lo detiene si va muy adelante. None marca el final
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.put(frame)
+    frames.put(None)
+
+
+def siguiente_lote(frames, batch_size):
+    # espera el primer frame y toma los que ya esten decodificados, hasta batch_size
+    lote = []
+    frame = frames.get()
+    while frame is not None:
+        lote.append(frame)
+        if len(lote) == batch_size:
+            break
+        try:
+            frame = frames.get_nowait()
+        except queue.Empty:
+            break
+    return lote, frame is None
+
+
+def analizar(video, salida, formato, detector, options, batch_size, prefetch, tracker):
+    # corre en un proceso por video. regresa el resumen del video
+    detector = make_detector(detector, **options)
+    trackers = TrackerPool(tracker) if tracker != 'none' else None
+
+    cap = cv2.VideoCapture(video)
+    if not cap.isOpened():
+        return {'video': video, 'error': "no se pudo abrir el video"}
+
+    frames = queue.Queue(prefetch)
+    lector = Thread(target=leer_frames, args=(cap, frames), daemon=True)
+
+    inicio = time.perf_counter()
+    lector.start()
+
+    procesados = 0
+    cajas = []
+    indices = []
+    nombre = path.basename(video)
+    jsonl = open(salida, 'w') if formato == 'jsonl' else None
+    try:
+        fin = False
+        while not fin:
+            lote, fin = siguiente_lote(frames, batch_size)
+            if not lote:
+                break
+
+            # una sola pasada del modelo por lote, el tracking va en orden frame por frame
+            for frame, dets in zip(lote, detector.detect_batch(lote)):
+                if trackers is not None:
+                    dets = trackers.update(0, dets, frame)
+
+                if jsonl is not None:
+                    jsonl.write(detections.to_json(nombre, procesados, dets, detector.names))
+                else:
+                    cajas.append(dets)
+                    indices.append(np.full(len(dets), procesados, np.int32))
+                procesados += 1
+    finally:
+        if jsonl is not None:
+            jsonl.close()
+        cap.release()
+
+    if formato == 'npz':
+        # columnas de detections.py, frame dice a que frame pertenece cada fila
+        np.savez_compressed(salida,
+                            detections=np.concatenate(cajas) if cajas else detections.empty(),
+                            frame=np.concatenate(indices) if indices else np.zeros(0, np.int32),
+                            names=json.dumps(detector.names))
+
+    segundos = time.perf_counter() - inicio
+    return {'video': video, 'salida': salida, 'frames': procesados, 'segundos': segundos,
+            'fps': procesados / segundos if segundos else 0.0}
+
+
+def nombres_salida(videos, formato):
+    # un archivo por video con su nombre; si dos videos se llaman igual
+    # (cam1/v.mp4 y cam2/v.mp4) llevan su posicion en la lista para no pisarse
+    bases = [path.splitext(path.basename(video))[0] for video in videos]
+    return ["{}.{}".format(base if bases.count(base) == 1 else "{}-{}".format(base, i), formato)
+            for i, base in enumerate(bases)]
+
 
-model = YOLO('yolov8s.pt')
+def procesar_lote(args):
+    # varios videos sin ventana, cada uno en su propio proceso con su propio modelo
+    makedirs(args.output, exist_ok=True)
+    options = detector_options(args)
 
-# construir el path hacia el video de demo
-video_path = path.join('d2.mp4')
+    inicio = time.perf_counter()
+    total = 0
+    # spawn, torch no es seguro despues de un fork
+    with ProcessPoolExecutor(args.processes, mp_context=mp.get_context('spawn')) as pool:
+        trabajos = []
+        for video, nombre in zip(args.video, nombres_salida(args.video, args.format)):
+            salida = path.join(args.output, nombre)
+            trabajos.append(pool.submit(analizar, video, salida, args.format, args.detector, options,
+                                        args.batch_size, args.prefetch, args.tracker))
 
-# abrir el video con opencv
-cap = cv2.VideoCapture(video_path)
+        for video, trabajo in zip(args.video, trabajos):
+            try:
+                resumen = trabajo.result()
+            except Exception as e:
+                # un video que falla no detiene a los demas
+                resumen = {'video': video, 'error': repr(e)}
+            if 'error' in resumen:
+                print("{}: {}".format(resumen['video'], resumen['error']))
+                continue
+            total += resumen['frames']
+            print("{}: {} frames en {:.1f} s, {:.1f} fps -> {}".format(
+                resumen['video'], resumen['frames'], resumen['segundos'], resumen['fps'], resumen['salida']))
 
-# revisamos si el video se abrio correctamente
-while cap.isOpened():
-    # leemos un frame del video
-    ret, frame = cap.read()
+    segundos = time.perf_counter() - inicio
+    print("total: {} frames de {} videos en {:.1f} s, {:.1f} fps".format(
+        total, len(args.video), segundos, total / segundos if segundos else 0.0))
 
-    # verificamos si el frame se leyo correctamente
-    if not ret:
-        break
 
-    # detectar objetos en el frame
-    results = model.track(frame, persist=True)
+def main():
+    parser = argparse.ArgumentParser(description="demo de deteccion y tracking sobre un video")
+    parser.add_argument('--video', nargs='+', default=['d2.mp4'],
+                        help="video a mostrar, o varios con --batch")
+    parser.add_argument('--detector', choices=sorted(BACKENDS), default='ultralytics',
+                        help="ultralytics: modelo de PyTorch, onnx: modelo exportado en ONNX Runtime, "
+                             "fake: cajas deterministas sin modelo")
+    parser.add_argument('--weights', help="archivo del modelo, yolov8s.pt o yolov8s.onnx por default")
+    parser.add_argument('--threads', type=int, default=0, help="hilos de ONNX Runtime")
+    parser.add_argument('--batch', action='store_true',
+                        help="sin ventana: procesa los videos y guarda las detecciones en --output")
+    parser.add_argument('--output', default='resultados', help="carpeta de resultados con --batch")
+    parser.add_argument('--format', choices=['jsonl', 'npz'], default='jsonl',
+                        help="jsonl: una linea por frame, npz: arreglos de numpy comprimidos")
+    parser.add_argument('--batch-size', type=int, default=8, help="frames por pasada del modelo")
+    parser.add_argument('--prefetch', type=int, default=32, help="frames decodificados por adelantado")
+    parser.add_argument('--processes', type=int, default=2, help="videos procesados al mismo tiempo")
+    parser.add_argument('--tracker', choices=['bytetrack', 'botsort', 'none'], default='bytetrack')
+    parser.add_argument('--fake-cost', type=float, default=0, help="ms por frame del detector fake")
+    args = parser.parse_args()
 
-    # solo enviamos un frame por lo que solo hay un resultado
-    # obtenemos el frame con los objetos detectados y ya graficados
-    # con su bounding box y etiqueta
-    annotated_frame = results[0].plot()
+    if args.tracker != 'none' and not tracker_available():
+        # los trackers vienen con ultralytics, igual que en server.py
+        print("--tracker {} necesita ultralytics, se usa --tracker none".format(args.tracker))
+        args.tracker = 'none'
 
-    # display results
-    cv2.imshow('YOLOv8 Tracking', annotated_frame)
+    if args.batch:
+        procesar_lote(args)
+    else:
+        mostrar(args)
 
-    # si se presiona la tecla 'q' se cierra el video
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
 
+if __name__ == '__main__':
+    main()